@@ -93,7 +93,7 @@ from freenasUI.storage.forms import (
     ZFSDatasetCreateForm,
     ZFSDatasetEditForm
 )
-from freenasUI.storage.models import Disk, Replication, VMWarePlugin
+from freenasUI.storage.models import Disk, VMWarePlugin
 from freenasUI.system.alert import alert_node, alertPlugins, Alert
 from freenasUI.system.forms import (
     BootEnvAddForm,
@@ -1400,6 +1400,9 @@ class ReplicationResourceMixin(object):
         bundle.data['repl_remote_cipher'] = (
             bundle.obj.repl_remote.ssh_cipher
         )
+        bundle.data['repl_remote_parallel'] = (
+            bundle.obj.repl_remote.ssh_remote_parallel
+        )
         if 'repl_remote' in bundle.data:
             del bundle.data['repl_remote']
         result = bundle.obj.repl_lastresult or {}
@@ -1423,6 +1426,8 @@ class ReplicationResourceMixin(object):
                 bundle.data['repl_remote_dedicateduser'] = bundle.obj.repl_remote.ssh_remote_dedicateduser
             if 'repl_remote_cipher' not in bundle.data:
                 bundle.data['repl_remote_cipher'] = bundle.obj.repl_remote.ssh_cipher
+            if 'repl_remote_parallel' not in bundle.data:
+                bundle.data['repl_remote_parallel'] = bundle.obj.repl_remote.ssh_remote_parallel
             if 'repl_remote_hostkey' not in bundle.data:
                 bundle.data['repl_remote_hostkey'] = bundle.obj.repl_remote.ssh_remote_hostkey
         else:
@@ -2475,6 +2480,38 @@ class PluginsResourceMixin(NestedMixin):
         return bundle
 
 
+class SnapshotQuery(object):
+    """
+    Lazy list of snapshots for the paginator.
+
+    Only the count and the requested page are fetched from the
+    middleware snapshot index.
+    """
+
+    def __init__(self, order_by=None, replication=False):
+        self.order_by = order_by or []
+        self.replication = replication
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = notifier().zfs_snapshot_query(options={'count': True})
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        options = {'order_by': self.order_by, 'offset': key.start or 0}
+        if key.stop is not None:
+            options['limit'] = key.stop - options['offset']
+            if options['limit'] <= 0:
+                return []
+        return notifier().zfs_snapshot_query(options=options, replication=self.replication)
+
+
 class SnapshotResource(DojoResource):
 
     id = fields.CharField(attribute='fullname')
@@ -2557,51 +2594,29 @@ class SnapshotResource(DojoResource):
 
     def get_list(self, request, **kwargs):
 
-        # Get a list of snapshots in remote sides to show whether it has been
-        # transfered already or not
-        repli = {}
-        for repl in Replication.objects.all():
-            """
-            Multiple replications tasks can have the same remote host.
-            We can't get the list of snapshots on the remote side multiple
-            times, make sure we don't do that.
-            """
-            found = False
-            for _repl, snaps in list(repli.items()):
-                if (
-                    _repl.repl_remote.ssh_remote_hostname == repl.repl_remote.ssh_remote_hostname and
-                    _repl.repl_remote.ssh_remote_port == repl.repl_remote.ssh_remote_port
-                ):
-                    found = True
-                    repli[repl] = snaps
-                    break
-            if found is False:
-                repli[repl] = set(notifier().repl_remote_snapshots(repl))
-
-        snapshots = notifier().zfs_snapshot_list(replications=repli)
-
-        results = []
-        for snaps in list(snapshots.values()):
-            results.extend(snaps)
         FIELD_MAP = {
             'extra': 'mostrecent',
+            'name': 'snapshot_name',
+            'filesystem': 'dataset',
+            'fullname': 'name',
+            'refer': 'referenced',
+            'parent_type': 'type',
         }
 
+        order_by = []
         for sfield in self._apply_sorting(request.GET):
             if sfield.startswith('-'):
                 field = sfield[1:]
-                reverse = True
+                reverse = '-'
             else:
                 field = sfield
-                reverse = False
-            field = FIELD_MAP.get(field, field)
-            apifield = self.fields.get(field)
-            default = ''
-            if apifield and isinstance(apifield, fields.IntegerField):
-                default = 0
-            results.sort(
-                key=lambda item: getattr(item, field) or default,
-                reverse=reverse)
+                reverse = ''
+            # Replication status is not known by the snapshot index
+            if field == 'replication':
+                continue
+            order_by.append(reverse + FIELD_MAP.get(field, field))
+
+        results = SnapshotQuery(order_by=order_by, replication=True)
 
         limit = self._meta.limit
         if 'HTTP_X_RANGE' in request.META:
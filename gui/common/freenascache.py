@@ -24,11 +24,17 @@
 #
 #####################################################################
 
-import os
+import binascii
+import fcntl
+import grp
 import logging
-import pickle as pickle
+import marshal
+import os
+import pickle
+import pwd
+import sqlite3
+import threading
 
-from bsddb3 import db
 from freenasUI.common.system import (
     get_freenas_var,
     ldap_enabled,
@@ -41,6 +47,8 @@ log = logging.getLogger('common.frenascache')
 
 FREENAS_CACHEDIR = get_freenas_var("FREENAS_CACHEDIR", "/var/tmp/.cache")
 FREENAS_CACHEEXPIRE = int(get_freenas_var("FREENAS_CACHEEXPIRE", 60))
+FREENAS_CACHETIMEOUT = int(get_freenas_var("FREENAS_CACHETIMEOUT", 30))
+FREENAS_CACHEPAGESIZE = int(get_freenas_var("FREENAS_CACHEPAGESIZE", 256))
 
 FREENAS_USERCACHE = os.path.join(FREENAS_CACHEDIR, ".users")
 FREENAS_GROUPCACHE = os.path.join(FREENAS_CACHEDIR, ".groups")
@@ -83,29 +91,91 @@ FLAGS_CACHE_WRITE_GROUP = 0x00000008
 FLAGS_CACHE_READ_QUERY = 0x00000010
 FLAGS_CACHE_WRITE_QUERY = 0x00000020
 
+FREENAS_CACHE_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS cache ("
+    "key TEXT PRIMARY KEY, name TEXT NOT NULL, value BLOB NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS cache_name ON cache (name)",
+    "CREATE TABLE IF NOT EXISTS cache_trigram ("
+    "trigram TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (trigram, key)"
+    ") WITHOUT ROWID",
+]
+
+# Records marshaled as tuples, tagged with their type
+FREENAS_CACHE_STRUCTS = {
+    b'p': pwd.struct_passwd,
+    b'g': grp.struct_group,
+}
+
+
+def cache_key(key):
+    if isinstance(key, bytes):
+        return key.decode('utf8')
+    return str(key)
+
+
+def cache_dumps(value):
+    """
+    Serialize a record, with marshal unless it holds objects only pickle
+    can serialize.
+    """
+    for tag, _type in FREENAS_CACHE_STRUCTS.items():
+        if isinstance(value, _type):
+            return tag + marshal.dumps(tuple(value))
+
+    try:
+        return b'm' + marshal.dumps(value)
+    except ValueError:
+        return b'k' + pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def cache_loads(data):
+    tag, data = data[:1], data[1:]
+    if tag == b'k':
+        return pickle.loads(data)
+
+    value = marshal.loads(data)
+    if tag in FREENAS_CACHE_STRUCTS:
+        value = FREENAS_CACHE_STRUCTS[tag](value)
+    return value
+
+
+def cache_trigrams(name):
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
 
 class FreeNAS_BaseCache(object):
+    """
+    Cache of the records of a directory, keyed by name (or DN).
+
+    Records are stored in a SQLite database, one row per record, with
+    the lowercased key indexed for prefix searches and split in
+    trigrams for substring searches.
+
+    Each generation of the cache is a file of its own, `.cache.sqlite`
+    being a symlink to the current one. A new generation is built aside
+    (begin()) and swapped in at once (commit()), readers keep seeing the
+    previous one until then. As files are never replaced in place, the
+    cache can be read from several processes at the same time.
+    """
+
+    # Index the trigrams of the keys for substring searches
+    trigrams = True
+
     def __init__(self, cachedir=FREENAS_CACHEDIR):
         log.debug("FreeNAS_BaseCache._init__: enter")
 
         self.cachedir = cachedir
-        self.__cachefile = os.path.join(self.cachedir, ".cache.db")
+        self.__cachefile = os.path.join(self.cachedir, ".cache.sqlite")
+        self.__lockfile = os.path.join(self.cachedir, ".cache.lock")
 
         if not self.__dir_exists(self.cachedir):
-            os.makedirs(self.cachedir)
+            os.makedirs(self.cachedir, exist_ok=True)
 
-        flags = db.DB_CREATE | db.DB_THREAD | db.DB_INIT_LOCK | db.DB_INIT_LOG | \
-            db.DB_INIT_MPOOL | db.DB_THREAD | db.DB_INIT_TXN
-
-        self.__dbenv = db.DBEnv()
-        self.__dbenv.open(
-            self.cachedir,
-            flags,
-            0o700
-        )
-
-        self.__cache = db.DB(self.__dbenv)
-        self.__cache.open(self.__cachefile, None, db.DB_HASH, db.DB_CREATE)
+        self.__lock = threading.RLock()
+        self.__generation = None
+        self.__conn = None
+        self.__conn_target = None
+        self.__connection()
 
         log.debug("FreeNAS_BaseCache._init__: cachedir = %s", self.cachedir)
         log.debug(
@@ -125,80 +195,318 @@ class FreeNAS_BaseCache(object):
 
         return path_exists
 
+    def __connect(self, path, create=False):
+        conn = sqlite3.connect(
+            'file:%s?mode=%s' % (path, 'rwc' if create else 'rw'),
+            uri=True,
+            timeout=FREENAS_CACHETIMEOUT,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        if create:
+            for sql in FREENAS_CACHE_SCHEMA:
+                conn.execute(sql)
+        return conn
+
+    def __connection(self):
+        """
+        Connection to the current generation, reopened once another one
+        has been swapped in.
+        """
+        while True:
+            try:
+                target = os.readlink(self.__cachefile)
+
+            except FileNotFoundError:
+                self.__swap(*self.__create())
+                continue
+
+            if self.__conn is not None and target == self.__conn_target:
+                return self.__conn
+
+            try:
+                conn = self.__connect(os.path.join(self.cachedir, target))
+
+            except sqlite3.OperationalError:
+                # Generation removed right after being replaced
+                if os.readlink(self.__cachefile) != target:
+                    continue
+                raise
+
+            if self.__conn is not None:
+                self.__conn.close()
+            self.__conn = conn
+            self.__conn_target = target
+            return conn
+
+    def __create(self):
+        target = ".cache.%s.sqlite" % binascii.hexlify(os.urandom(8)).decode()
+        conn = self.__connect(os.path.join(self.cachedir, target), create=True)
+        # Nobody else reads it until it is swapped in
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute("BEGIN")
+        return target, conn
+
+    def __swap(self, target, conn):
+        conn.execute("COMMIT")
+        conn.close()
+
+        link = "%s.%s" % (self.__cachefile, target)
+        os.symlink(target, link)
+        with open(self.__lockfile, 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                previous = os.readlink(self.__cachefile)
+            except FileNotFoundError:
+                previous = None
+
+            os.rename(link, self.__cachefile)
+
+            # Readers still holding it open keep reading it
+            if previous is not None:
+                try:
+                    os.unlink(os.path.join(self.cachedir, previous))
+                except FileNotFoundError:
+                    pass
+
+    def __write(self, method):
+        """
+        Run `method` with the connection records are written to, in a
+        transaction.
+        """
+        with self.__lock:
+            if self.__generation is not None:
+                return method(self.__generation[1])
+
+            conn = self.__connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = method(conn)
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+
+    def begin(self):
+        """
+        Start building a new generation of the cache, records written
+        from now on go to it instead of the current one.
+        """
+        with self.__lock:
+            if self.__generation is None:
+                self.__generation = self.__create()
+
+    def commit(self):
+        """
+        Swap the generation being built in.
+        """
+        with self.__lock:
+            if self.__generation is not None:
+                generation = self.__generation
+                self.__generation = None
+                self.__swap(*generation)
+
+    def rollback(self):
+        """
+        Throw away the generation being built.
+        """
+        with self.__lock:
+            if self.__generation is None:
+                return
+
+            target, conn = self.__generation
+            self.__generation = None
+            conn.close()
+            os.unlink(os.path.join(self.cachedir, target))
+
     def __len__(self):
-        return len(self.__cache)
+        with self.__lock:
+            return self.__connection().execute(
+                "SELECT COUNT(*) FROM cache"
+            ).fetchone()[0]
 
     def __iter__(self):
-        for key in sorted(self.__cache.keys()):
-            obj = pickle.loads(self.__cache[key])
-            yield obj
+        # Page through the keys so a large cache is neither held in
+        # memory nor locked while it is iterated.
+        key = None
+        while True:
+            with self.__lock:
+                if key is None:
+                    rows = self.__connection().execute(
+                        "SELECT key, value FROM cache ORDER BY key LIMIT ?",
+                        (FREENAS_CACHEPAGESIZE, )
+                    ).fetchall()
+                else:
+                    rows = self.__connection().execute(
+                        "SELECT key, value FROM cache WHERE key > ? "
+                        "ORDER BY key LIMIT ?",
+                        (key, FREENAS_CACHEPAGESIZE)
+                    ).fetchall()
+
+            for key, value in rows:
+                yield cache_loads(value)
+
+            if len(rows) < FREENAS_CACHEPAGESIZE:
+                break
+
+    def __contains__(self, key):
+        return self.has_key(key)
 
     def __getitem__(self, key):
-        return pickle.loads(self.__cache.get(key))
+        with self.__lock:
+            row = self.__connection().execute(
+                "SELECT value FROM cache WHERE key = ?", (cache_key(key), )
+            ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return cache_loads(row[0])
 
     def __setitem__(self, key, value, overwrite=False):
-        if isinstance(key, str):
-            key = key.encode('utf8')
-        haskey = key in self.__cache
-        if (haskey and overwrite) or (not haskey):
-            self.__cache[key] = pickle.dumps(value)
+        key = cache_key(key)
+        name = key.lower()
+        value = cache_dumps(value)
+
+        def setitem(conn):
+            cursor = conn.execute(
+                "INSERT OR %s INTO cache (key, name, value) VALUES (?, ?, ?)" % (
+                    "REPLACE" if overwrite else "IGNORE"
+                ),
+                (key, name, value)
+            )
+            if cursor.rowcount and self.trigrams:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO cache_trigram (trigram, key) "
+                    "VALUES (?, ?)",
+                    [(trigram, key) for trigram in cache_trigrams(name)]
+                )
+
+        self.__write(setitem)
 
     def has_key(self, key):
-        return key in self.__cache
+        with self.__lock:
+            return self.__connection().execute(
+                "SELECT 1 FROM cache WHERE key = ?", (cache_key(key), )
+            ).fetchone() is not None
 
     def keys(self):
-        return list(self.__cache.keys())
+        with self.__lock:
+            return [
+                row[0] for row in self.__connection().execute(
+                    "SELECT key FROM cache ORDER BY key"
+                )
+            ]
 
     def values(self):
-        cache_values = []
-        for key in list(self.__cache.keys()):
-            cache_values.append(pickle.loads(self.__cache[key]))
-        return cache_values
+        return list(self)
 
     def items(self):
-        cache_items = []
-        for key in list(self.__cache.keys()):
-            cache_items.append((key, pickle.loads(self.__cache[key])))
-        return cache_items
+        with self.__lock:
+            return [
+                (key, cache_loads(value))
+                for key, value in self.__connection().execute(
+                    "SELECT key, value FROM cache ORDER BY key"
+                )
+            ]
+
+    def search(self, prefix=None, substring=None, offset=0, limit=None):
+        """
+        Records whose key starts with `prefix` and contains `substring`
+        (case insensitive), ordered by key, `limit` of them from `offset`.
+        """
+        where = []
+        args = []
+        if prefix:
+            prefix = prefix.lower()
+            where.append("name >= ? AND name < ?")
+            args += [prefix, prefix + '\U0010ffff']
+
+        if substring:
+            substring = substring.lower()
+            trigrams = cache_trigrams(substring)
+            if self.trigrams and trigrams:
+                where.append(
+                    "key IN (SELECT key FROM cache_trigram WHERE trigram IN (%s) "
+                    "GROUP BY key HAVING COUNT(*) = ?)" % ', '.join('?' * len(trigrams))
+                )
+                args += list(trigrams) + [len(trigrams)]
+            where.append("instr(name, ?) > 0")
+            args.append(substring)
+
+        sql = "SELECT value FROM cache"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY key LIMIT ? OFFSET ?"
+        args += [-1 if limit is None else limit, offset]
+
+        with self.__lock:
+            rows = self.__connection().execute(sql, args).fetchall()
+        return [cache_loads(row[0]) for row in rows]
+
+    def page(self, offset=0, limit=FREENAS_CACHEPAGESIZE):
+        return self.search(offset=offset, limit=limit)
 
     def empty(self):
-        return (len(self.__cache) == 0)
+        with self.__lock:
+            return self.__connection().execute(
+                "SELECT 1 FROM cache LIMIT 1"
+            ).fetchone() is None
 
     def expire(self):
-        for key in list(self.__cache.keys()):
-            self.__cache.delete(key)
-        self.__cache.close()
-        os.unlink(self.__cachefile)
+        # An empty generation replaces the current one
+        with self.__lock:
+            self.rollback()
+            self.begin()
+            self.commit()
 
     def read(self, key):
         if not key:
             return None
 
-        pobj = pickle.loads(self.__cache[key])
-        return pobj
+        return self[key]
 
     def write(self, key, entry, overwrite=False):
         if not key:
             return False
 
-        haskey = key in self.__cache
-        if (haskey and overwrite) or (not haskey):
-            self.__cache[key] = pickle.dumps(entry)
-
+        self.__setitem__(key, entry, overwrite)
         return True
 
     def delete(self, key):
         if not key:
             return False
 
-        self.__cache.delete(key)
+        key = cache_key(key)
+
+        def delete(conn):
+            conn.execute("DELETE FROM cache WHERE key = ?", (key, ))
+            conn.executemany(
+                "DELETE FROM cache_trigram WHERE trigram = ? AND key = ?",
+                [(trigram, key) for trigram in cache_trigrams(key.lower())]
+            )
+
+        self.__write(delete)
         return True
 
+    def __del__(self):
+        # Generation of a fill which did not complete
+        try:
+            self.rollback()
+        except Exception:
+            pass
+
     def close(self):
-        self.__cache.close()
+        with self.__lock:
+            self.rollback()
+            if self.__conn is not None:
+                self.__conn.close()
+                self.__conn = self.__conn_target = None
 
 
 class FreeNAS_LDAP_UserCache(FreeNAS_BaseCache):
+    trigrams = False
+
     def __init__(self, **kwargs):
         log.debug("FreeNAS_LDAP_UserCache.__init__: enter")
 
@@ -212,6 +520,8 @@ class FreeNAS_LDAP_UserCache(FreeNAS_BaseCache):
 
 
 class FreeNAS_LDAP_GroupCache(FreeNAS_BaseCache):
+    trigrams = False
+
     def __init__(self, **kwargs):
         log.debug("FreeNAS_LDAP_GroupCache.__init__: enter")
 
@@ -251,6 +561,8 @@ class FreeNAS_LDAP_LocalGroupCache(FreeNAS_BaseCache):
 
 
 class FreeNAS_ActiveDirectory_UserCache(FreeNAS_BaseCache):
+    trigrams = False
+
     def __init__(self, **kwargs):
         log.debug("FreeNAS_ActiveDirectory_UserCache.__init__: enter")
 
@@ -264,6 +576,8 @@ class FreeNAS_ActiveDirectory_UserCache(FreeNAS_BaseCache):
 
 
 class FreeNAS_ActiveDirectory_GroupCache(FreeNAS_BaseCache):
+    trigrams = False
+
     def __init__(self, **kwargs):
         log.debug("FreeNAS_ActiveDirectory_GroupCache.__init__: enter")
 
@@ -303,6 +617,8 @@ class FreeNAS_ActiveDirectory_LocalGroupCache(FreeNAS_BaseCache):
 
 
 class FreeNAS_LDAP_QueryCache(FreeNAS_BaseCache):
+    trigrams = False
+
     def __init__(self, **kwargs):
         log.debug("FreeNAS_LDAP_QueryCache.__init__: enter")
 
@@ -316,6 +632,8 @@ class FreeNAS_LDAP_QueryCache(FreeNAS_BaseCache):
 
 
 class FreeNAS_NIS_UserCache(FreeNAS_BaseCache):
+    trigrams = False
+
     def __init__(self, **kwargs):
         log.debug("FreeNAS_NIS_UserCache.__init__: enter")
 
@@ -329,6 +647,8 @@ class FreeNAS_NIS_UserCache(FreeNAS_BaseCache):
 
 
 class FreeNAS_NIS_GroupCache(FreeNAS_BaseCache):
+    trigrams = False
+
     def __init__(self, **kwargs):
         log.debug("FreeNAS_NIS_GroupCache.__init__: enter")
 
@@ -368,6 +688,8 @@ class FreeNAS_NIS_LocalGroupCache(FreeNAS_BaseCache):
 
 
 class FreeNAS_DomainController_UserCache(FreeNAS_BaseCache):
+    trigrams = False
+
     def __init__(self, **kwargs):
         log.debug("FreeNAS_DomainController_UserCache.__init__: enter")
 
@@ -381,6 +703,8 @@ class FreeNAS_DomainController_UserCache(FreeNAS_BaseCache):
 
 
 class FreeNAS_DomainController_GroupCache(FreeNAS_BaseCache):
+    trigrams = False
+
     def __init__(self, **kwargs):
         log.debug("FreeNAS_DomainController_GroupCache.__init__: enter")
 
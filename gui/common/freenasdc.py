@@ -28,7 +28,16 @@ import logging
 import os
 import pwd
 
-from freenasUI.common.freenascache import *
+from freenasUI.common.freenascache import (
+    FreeNAS_UserCache,
+    FreeNAS_GroupCache,
+    FreeNAS_DomainController_UserCache,
+    FreeNAS_DomainController_GroupCache,
+    FLAGS_CACHE_READ_USER,
+    FLAGS_CACHE_READ_GROUP,
+    FLAGS_CACHE_WRITE_USER,
+    FLAGS_CACHE_WRITE_GROUP,
+)
 from freenasUI.common.cmd import cmd_pipe
 
 log = logging.getLogger('common.freenasdc')
@@ -313,6 +322,10 @@ class FreeNAS_DomainController_Users(FreeNAS_DomainController):
                 )
                 dc_users = self.get_users(domain=d)
 
+            if self.flags & FLAGS_CACHE_WRITE_USER:
+                self.__ucache[d].begin()
+                self.__ducache[d].begin()
+
             for u in dc_users:
                 uid = u['uid']
 
@@ -334,6 +347,8 @@ class FreeNAS_DomainController_Users(FreeNAS_DomainController):
                 pw = None
 
             if self.flags & FLAGS_CACHE_WRITE_USER:
+                self.__ucache[d].commit()
+                self.__ducache[d].commit()
                 self.__loaded('u', d, True)
                 self.__loaded('du', d, True)
 
@@ -459,6 +474,10 @@ class FreeNAS_DomainController_Groups(FreeNAS_DomainController):
                 )
                 dc_groups = self.get_groups(domain=d)
 
+            if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                self.__gcache[d].begin()
+                self.__dgcache[d].begin()
+
             for g in dc_groups:
                 sAMAccountName = g['sAMAccountName']
 
@@ -478,6 +497,8 @@ class FreeNAS_DomainController_Groups(FreeNAS_DomainController):
                 gr = None
 
             if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                self.__gcache[d].commit()
+                self.__dgcache[d].commit()
                 self.__loaded('g', d, True)
                 self.__loaded('dg', d, True)
 
@@ -31,11 +31,13 @@ import logging
 import os
 import pwd
 import socket
+import struct
 import tempfile
 import time
 import types
 import ipaddr
 
+from concurrent.futures import ThreadPoolExecutor
 from dns import resolver
 from ldap.controls import SimplePagedResultsControl
 from .log import log_traceback
@@ -50,7 +52,9 @@ from freenasUI.common.ssl import get_certificateauthority_path
 from freenasUI.common.system import (
     get_freenas_var,
     get_freenas_var_by_file,
+    ldap_enabled,
     ldap_objects,
+    activedirectory_enabled,
     activedirectory_objects,
     get_hostname
 )
@@ -98,6 +102,18 @@ FLAGS_LDAP_ENABLED = 0x00200000
 FLAGS_PREFER_IPv6 = 0x00400000
 FLAGS_SASL_GSSAPI = 0x00800000
 
+# Number of domains of a forest searched at once
+FREENAS_AD_DOMAIN_WORKERS = int(get_freenas_var("FREENAS_AD_DOMAIN_WORKERS", 4))
+
+# Attributes the passwd and group entries are built from
+FREENAS_AD_USER_ATTRIBUTES = [
+    'objectSid', 'primaryGroupID', 'displayName',
+    'uidNumber', 'gidNumber', 'unixHomeDirectory', 'loginShell', 'gecos',
+    'msSFU30UidNumber', 'msSFU30GidNumber', 'msSFU30HomeDirectory',
+    'msSFU30LoginShell', 'msSFU30Gecos',
+]
+FREENAS_AD_GROUP_ATTRIBUTES = ['objectSid', 'gidNumber', 'msSFU30GidNumber']
+
 
 class FreeNAS_LDAP_Directory_Exception(Exception):
     pass
@@ -111,6 +127,221 @@ class FreeNAS_LDAP_Exception(FreeNAS_LDAP_Directory_Exception):
     pass
 
 
+def entry_value(entry, attr):
+    """
+    First value of `attr` of a search entry, decoded.
+    """
+    value = entry.get(attr)
+    if not value:
+        return None
+    return value[0].decode('utf8', 'ignore')
+
+
+def entry_int(entry, attr):
+    value = entry_value(entry, attr)
+    if value is None or not value.lstrip('-').isdigit():
+        return None
+    return int(value)
+
+
+def sid_to_rid(sid):
+    """
+    Relative identifier of a binary objectSid, its last sub-authority.
+    """
+    if not sid or len(sid) < 12 or len(sid) != 8 + 4 * sid[1]:
+        return None
+    return struct.unpack('<I', sid[-4:])[0]
+
+
+def sid_with_rid(sid, rid):
+    """
+    Binary SID of the object `rid` of the domain `sid` belongs to.
+    """
+    return sid[:-4] + struct.pack('<I', rid)
+
+
+def sid_to_filter(sid):
+    return '(objectSid=%s)' % ''.join('\\%02x' % b for b in sid)
+
+
+def ldap_to_passwd(entry, name):
+    """
+    passwd entry nss_ldap builds from a posixAccount entry.
+    """
+    uid = entry_int(entry, 'uidNumber')
+    gid = entry_int(entry, 'gidNumber')
+    if uid is None or gid is None:
+        return None
+    return pwd.struct_passwd((
+        name,
+        '*',
+        uid,
+        gid,
+        entry_value(entry, 'gecos') or entry_value(entry, 'cn') or '',
+        entry_value(entry, 'homeDirectory') or '',
+        entry_value(entry, 'loginShell') or '',
+    ))
+
+
+def ldap_to_group(entry, name):
+    """
+    group entry nss_ldap builds from a posixGroup entry.
+    """
+    gid = entry_int(entry, 'gidNumber')
+    if gid is None:
+        return None
+    members = [m.decode('utf8', 'ignore') for m in entry.get('memberUid', [])]
+    return grp.struct_group((name, 'x', gid, members))
+
+
+class FreeNAS_ActiveDirectory_Idmap(object):
+    """
+    Maps the users and groups of the joined domain to the ids winbindd
+    gives them, for the idmap backends where the id is a function of the
+    entry alone (rid and ad), so that enumerating a domain does not take
+    a round trip to winbindd per entry.
+    """
+
+    SCHEMA = {
+        'rfc2307': {
+            'uid': 'uidNumber',
+            'gid': 'gidNumber',
+            'home': 'unixHomeDirectory',
+            'shell': 'loginShell',
+            'gecos': 'gecos',
+        },
+        'sfu': {
+            'uid': 'msSFU30UidNumber',
+            'gid': 'msSFU30GidNumber',
+            'home': 'msSFU30HomeDirectory',
+            'shell': 'msSFU30LoginShell',
+            'gecos': 'msSFU30Gecos',
+        },
+    }
+    SCHEMA['sfu20'] = SCHEMA['sfu']
+
+    def __init__(
+        self, backend, range_low, range_high, schema_mode='rfc2307',
+        nss_info=None, homedir='/home'
+    ):
+        self.backend = backend
+        self.range_low = range_low
+        self.range_high = range_high
+        self.schema = self.SCHEMA.get(schema_mode, self.SCHEMA['rfc2307'])
+        self.nss_info = self.SCHEMA.get(nss_info) if backend == 'ad' else None
+        self.homedir = homedir
+
+    @classmethod
+    def get(cls):
+        """
+        Idmap of the joined domain or None if its ids can only be
+        looked up through winbindd.
+        """
+        from freenasUI.directoryservice.models import DS_TYPE_ACTIVEDIRECTORY
+        from freenasUI.directoryservice.utils import get_idmap
+        from freenasUI.sharing.models import CIFS_Share
+
+        try:
+            if not activedirectory_enabled():
+                return None
+
+            ad = activedirectory_objects()[0]
+            backend = ad.ad_idmap_backend
+            if backend not in ('rid', 'ad'):
+                return None
+
+            idmap = get_idmap(DS_TYPE_ACTIVEDIRECTORY, ad.id, backend)
+            homedir = '/home'
+            for share in CIFS_Share.objects.filter(cifs_home=True):
+                if share.cifs_path:
+                    homedir = share.cifs_path
+                    break
+
+            return cls(
+                backend,
+                getattr(idmap, 'idmap_%s_range_low' % backend),
+                getattr(idmap, 'idmap_%s_range_high' % backend),
+                schema_mode=getattr(idmap, 'idmap_ad_schema_mode', None),
+                nss_info=ad.ad_nss_info,
+                homedir=homedir,
+            )
+
+        except Exception:
+            log.debug("FreeNAS_ActiveDirectory_Idmap.get: failed", exc_info=True)
+            return None
+
+    def __in_range(self, id):
+        if id is None or not (self.range_low <= id <= self.range_high):
+            return None
+        return id
+
+    def __rid_id(self, entry):
+        rid = sid_to_rid((entry.get('objectSid') or [None])[0])
+        return None if rid is None else self.range_low + rid
+
+    def uid(self, entry):
+        if self.backend == 'rid':
+            return self.__in_range(self.__rid_id(entry))
+        return self.__in_range(entry_int(entry, self.schema['uid']))
+
+    def gid(self, entry):
+        if self.backend == 'rid':
+            return self.__in_range(self.__rid_id(entry))
+        return self.__in_range(entry_int(entry, self.schema['gid']))
+
+    def primary_gid(self, entry, lookup=None):
+        """
+        gid of the primaryGroupID of a user, `lookup` resolves the SID
+        of a group to its gid for the backends storing it in the group.
+        """
+        rid = entry_int(entry, 'primaryGroupID')
+        if rid is None:
+            return None
+        if self.backend == 'rid':
+            return self.__in_range(self.range_low + rid)
+
+        sid = (entry.get('objectSid') or [None])[0]
+        if lookup is None or sid_to_rid(sid) is None:
+            return None
+        return lookup(sid_with_rid(sid, rid))
+
+    def passwd(self, entry, name, domain, lookup=None):
+        uid = self.uid(entry)
+        if uid is None:
+            return None
+        gid = self.primary_gid(entry, lookup)
+        if gid is None:
+            return None
+
+        home = shell = gecos = None
+        if self.nss_info:
+            home = entry_value(entry, self.nss_info['home'])
+            shell = entry_value(entry, self.nss_info['shell'])
+            gecos = entry_value(entry, self.nss_info['gecos'])
+
+        # template homedir is %D/%U
+        if not home:
+            home = '%s/%s/%s' % (
+                self.homedir, domain, entry_value(entry, 'sAMAccountName')
+            )
+
+        return pwd.struct_passwd((
+            name,
+            '*',
+            uid,
+            gid,
+            gecos or entry_value(entry, 'displayName') or '',
+            home,
+            shell or '/bin/sh',
+        ))
+
+    def group(self, entry, name):
+        gid = self.gid(entry)
+        if gid is None:
+            return None
+        return grp.struct_group((name, 'x', gid, []))
+
+
 class FreeNAS_LDAP_Directory(object):
     @staticmethod
     def validate_credentials(
@@ -361,18 +592,23 @@ class FreeNAS_LDAP_Directory(object):
             self._isopen = False
             log.debug("FreeNAS_LDAP_Directory.close: connection closed")
 
-    def _search(
+    def _search_iter(
         self, basedn="", scope=ldap.SCOPE_SUBTREE, filter=None,
         attributes=None, attrsonly=0, serverctrls=None, clientctrls=None,
         timeout=-1, sizelimit=0
     ):
-        log.debug("FreeNAS_LDAP_Directory._search: enter")
+        """
+        Generator of the entries of a search, yielded as soon as the
+        page (or message) holding them has been received so that large
+        directories are never held in memory at once.
+        """
+        log.debug("FreeNAS_LDAP_Directory._search_iter: enter")
         log.debug(
-            "FreeNAS_LDAP_Directory._search: basedn = '%s', filter = '%s'",
+            "FreeNAS_LDAP_Directory._search_iter: basedn = '%s', filter = '%s'",
             basedn, filter
         )
         if not self._isopen:
-            return None
+            return
 
         #
         # XXX
@@ -386,8 +622,7 @@ class FreeNAS_LDAP_Directory(object):
         if not filter:
             filter = ''
 
-        result = []
-        results = []
+        count = 0
         paged = SimplePagedResultsControl(
             criticality=False,
             size=self.pagesize,
@@ -400,14 +635,14 @@ class FreeNAS_LDAP_Directory(object):
 
         if self.pagesize > 0:
             log.debug(
-                "FreeNAS_LDAP_Directory._search: pagesize = %d",
+                "FreeNAS_LDAP_Directory._search_iter: pagesize = %d",
                 self.pagesize
             )
 
             page = 0
             while True:
                 log.debug(
-                    "FreeNAS_LDAP_Directory._search: getting page %d",
+                    "FreeNAS_LDAP_Directory._search_iter: getting page %d",
                     page
                 )
                 serverctrls = [paged]
@@ -428,8 +663,6 @@ class FreeNAS_LDAP_Directory(object):
                     id, resp_ctrl_classes=paged_ctrls
                 )
 
-                result.extend(rdata)
-
                 paged.size = 0
                 paged.cookie = cookie = None
                 for sc in serverctrls:
@@ -441,12 +674,16 @@ class FreeNAS_LDAP_Directory(object):
 
                         break
 
+                for entry in rdata:
+                    count += 1
+                    yield entry
+
                 if not cookie:
                     break
 
                 page += 1
         else:
-            log.debug("FreeNAS_LDAP_Directory._search: pagesize = 0")
+            log.debug("FreeNAS_LDAP_Directory._search_iter: pagesize = 0")
 
             id = self._handle.search_ext(
                 basedn,
@@ -469,15 +706,25 @@ class FreeNAS_LDAP_Directory(object):
                     self._logex(e)
                     break
 
-                results.append(data)
+                for entry in data:
+                    count += 1
+                    yield entry
 
-            for i in range(len(results)):
-                for entry in results[i]:
-                    result.append(entry)
+        log.debug("FreeNAS_LDAP_Directory._search_iter: %d results", count)
+        log.debug("FreeNAS_LDAP_Directory._search_iter: leave")
 
-        log.debug("FreeNAS_LDAP_Directory._search: %d results", len(result))
-        log.debug("FreeNAS_LDAP_Directory._search: leave")
-        return result
+    def _search(
+        self, basedn="", scope=ldap.SCOPE_SUBTREE, filter=None,
+        attributes=None, attrsonly=0, serverctrls=None, clientctrls=None,
+        timeout=-1, sizelimit=0
+    ):
+        if not self._isopen:
+            return None
+
+        return list(self._search_iter(
+            basedn, scope, filter, attributes, attrsonly, serverctrls,
+            clientctrls, timeout, sizelimit
+        ))
 
     def search(self):
         log.debug("FreeNAS_LDAP_Directory.search: enter")
@@ -848,12 +1095,13 @@ class FreeNAS_LDAP_Base(FreeNAS_LDAP_Directory):
         log.debug("FreeNAS_LDAP_Base.get_user: leave")
         return ldap_user
 
-    def get_users(self):
-        log.debug("FreeNAS_LDAP_Base.get_users: enter")
+    def iter_users(self):
+        """
+        Generator of the user entries, streamed page by page.
+        """
         isopen = self._isopen
         self.open()
 
-        users = []
         scope = ldap.SCOPE_SUBTREE
         filter = '(&(|(objectclass=person)' \
             '(objectclass=posixaccount)' \
@@ -864,14 +1112,18 @@ class FreeNAS_LDAP_Base(FreeNAS_LDAP_Directory):
         else:
             basedn = "%s" % self.basedn
 
-        results = self._search(basedn, scope, filter, self.attributes)
-        if results:
-            for r in results:
+        try:
+            for r in self._search_iter(basedn, scope, filter, self.attributes):
                 if r[0]:
-                    users.append(r)
+                    yield r
+        finally:
+            if not isopen:
+                self.close()
 
-        if not isopen:
-            self.close()
+    def get_users(self):
+        log.debug("FreeNAS_LDAP_Base.get_users: enter")
+
+        users = list(self.iter_users())
 
         log.debug("FreeNAS_LDAP_Base.get_users: leave")
         return users
@@ -921,12 +1173,13 @@ class FreeNAS_LDAP_Base(FreeNAS_LDAP_Directory):
         log.debug("FreeNAS_LDAP_Base.get_group: leave")
         return ldap_group
 
-    def get_groups(self):
-        log.debug("FreeNAS_LDAP_Base.get_groups: enter")
+    def iter_groups(self):
+        """
+        Generator of the group entries, streamed page by page.
+        """
         isopen = self._isopen
         self.open()
 
-        groups = []
         scope = ldap.SCOPE_SUBTREE
         filter = '(&(|(objectclass=posixgroup)' \
             '(objectclass=group))' \
@@ -937,14 +1190,18 @@ class FreeNAS_LDAP_Base(FreeNAS_LDAP_Directory):
         else:
             basedn = "%s" % self.basedn
 
-        results = self._search(basedn, scope, filter, self.attributes)
-        if results:
-            for r in results:
+        try:
+            for r in self._search_iter(basedn, scope, filter, self.attributes):
                 if r[0]:
-                    groups.append(r)
+                    yield r
+        finally:
+            if not isopen:
+                self.close()
 
-        if not isopen:
-            self.close()
+    def get_groups(self):
+        log.debug("FreeNAS_LDAP_Base.get_groups: enter")
+
+        groups = list(self.iter_groups())
 
         log.debug("FreeNAS_LDAP_Base.get_groups: leave")
         return groups
@@ -1720,6 +1977,30 @@ class FreeNAS_ActiveDirectory_Base(object):
         self.gchandle.open()
         self.gchandle.pagesize = self.pagesize
 
+    def get_domain_handle(self, domain):
+        """
+        Open handle to a domain controller of `domain`, one of
+        get_domains(), for paged searches of its naming context.
+        """
+        if domain['nETBIOSName'] == self.netbiosname:
+            handle = self.dchandle
+
+        else:
+            dcs = self.get_domain_controllers(domain['dnsRoot'], ssl=self.ssl)
+            if not dcs:
+                raise FreeNAS_ActiveDirectory_Exception(
+                    "Unable to find domain controllers for %s" % domain['dnsRoot'])
+            (host, port) = self.get_best_host(dcs)
+
+            handle = FreeNAS_LDAP_Directory(
+                binddn=self.dchandle.binddn, bindpw=self.dchandle.bindpw,
+                host=host, port=port, ssl=self.ssl, certfile=self.certfile,
+                flags=self.dchandle.flags)
+            handle.open()
+            handle.pagesize = self.pagesize
+
+        return handle
+
     def reset_servers(self):
         self.dcname = self.dchost = self.dcport = None
         self.gcname = self.gchost = self.gcport = None
@@ -1848,6 +2129,16 @@ class FreeNAS_ActiveDirectory_Base(object):
             clientctrls, timeout, sizelimit
         )
 
+    def _search_iter(
+        self, handle, basedn="", scope=ldap.SCOPE_SUBTREE,
+        filter=None, attributes=None, attrsonly=0, serverctrls=None,
+        clientctrls=None, timeout=-1, sizelimit=0
+    ):
+        return handle._search_iter(
+            basedn, scope, filter, attributes, attrsonly, serverctrls,
+            clientctrls, timeout, sizelimit
+        )
+
     def _modify(self, handle, dn, modlist):
         return handle._modify(dn, modlist)
 
@@ -2169,29 +2460,37 @@ class FreeNAS_ActiveDirectory_Base(object):
         log.debug("FreeNAS_ActiveDirectory_Base.get_user: leave")
         return ad_user
 
-    def get_users(self):
-        log.debug("FreeNAS_ActiveDirectory_Base.get_users: enter")
-
-        users = []
+    def iter_users(self, handle=None, basedn=None):
+        """
+        Generator of the user entries below `basedn` (defaults to the
+        base DN of the domain), streamed page by page from `handle`.
+        """
         if self.disable_freenas_cache:
-            self.ucount = 0
-            log.debug("FreeNAS_ActiveDirectory_Base.get_users: leave")
-            return users
+            return
+
         scope = ldap.SCOPE_SUBTREE
         filter = '(&(|(objectclass=user)(objectclass=person))' \
             '(sAMAccountName=*))'
-        if self.attributes and 'sAMAccountType' not in self.attributes:
-            self.attributes.append('sAMAccountType')
+        attributes = None
+        if self.attributes:
+            attributes = self.attributes + [
+                attr for attr in ['sAMAccountType'] + FREENAS_AD_USER_ATTRIBUTES
+                if attr not in self.attributes
+            ]
 
-        results = self._search(
-            self.dchandle, self.basedn, scope, filter, self.attributes
-        )
-        if results:
-            for r in results:
-                if r[0] and r[1] and 'sAMAccountType' in r[1]:
-                    type = int(r[1]['sAMAccountType'][0])
-                    if not (type & 0x1):
-                        users.append(r)
+        for r in self._search_iter(
+            handle or self.dchandle, basedn or self.basedn, scope, filter,
+            attributes
+        ):
+            if r[0] and r[1] and 'sAMAccountType' in r[1]:
+                type = int(r[1]['sAMAccountType'][0])
+                if not (type & 0x1):
+                    yield r
+
+    def get_users(self):
+        log.debug("FreeNAS_ActiveDirectory_Base.get_users: enter")
+
+        users = list(self.iter_users())
 
         self.ucount = len(users)
         log.debug("FreeNAS_ActiveDirectory_Base.get_users: leave")
@@ -2247,28 +2546,36 @@ class FreeNAS_ActiveDirectory_Base(object):
         log.debug("FreeNAS_ActiveDirectory_Base.get_group: leave")
         return ad_group
 
-    def get_groups(self):
-        log.debug("FreeNAS_ActiveDirectory_Base.get_groups: enter")
-
-        groups = []
+    def iter_groups(self, handle=None, basedn=None):
+        """
+        Generator of the group entries below `basedn` (defaults to the
+        base DN of the domain), streamed page by page from `handle`.
+        """
         if self.disable_freenas_cache:
-            self.gcount = 0
-            log.debug("FreeNAS_ActiveDirectory_Base.get_groups: leave")
-            return groups
+            return
+
         scope = ldap.SCOPE_SUBTREE
         filter = '(&(objectclass=group)(sAMAccountName=*))'
-        if self.attributes and 'groupType' not in self.attributes:
-            self.attributes.append('groupType')
+        attributes = None
+        if self.attributes:
+            attributes = self.attributes + [
+                attr for attr in ['groupType'] + FREENAS_AD_GROUP_ATTRIBUTES
+                if attr not in self.attributes
+            ]
 
-        results = self._search(
-            self.dchandle, self.basedn, scope, filter, self.attributes
-        )
-        if results:
-            for r in results:
-                if r[0]:
-                    type = int(r[1]['groupType'][0])
-                    if not (type & 0x1):
-                        groups.append(r)
+        for r in self._search_iter(
+            handle or self.dchandle, basedn or self.basedn, scope, filter,
+            attributes
+        ):
+            if r[0]:
+                type = int(r[1]['groupType'][0])
+                if not (type & 0x1):
+                    yield r
+
+    def get_groups(self):
+        log.debug("FreeNAS_ActiveDirectory_Base.get_groups: enter")
+
+        groups = list(self.iter_groups())
 
         self.gcount = len(groups)
         log.debug("FreeNAS_ActiveDirectory_Base.get_groups: leave")
@@ -2528,7 +2835,18 @@ class FreeNAS_LDAP_Users(FreeNAS_LDAP):
             log.debug(
                 "FreeNAS_LDAP_Users.__get_users: LDAP users not in cache"
             )
-            ldap_users = self.get_users()
+            ldap_users = self.iter_users()
+
+        # nss_ldap takes the ids straight from the entries of the
+        # directory it is configured for, no need to ask it for each one.
+        local = ldap_enabled()
+
+        # Entries are streamed into a new generation of the cache rather
+        # than kept in a list
+        if self.flags & FLAGS_CACHE_WRITE_USER:
+            self.__ucache.begin()
+            self.__ducache.begin()
+            self.__users = self.__ucache
 
         # parts = self.host.split('.')
         # host = parts[0].upper()
@@ -2547,18 +2865,27 @@ class FreeNAS_LDAP_Users(FreeNAS_LDAP):
 
             self.__usernames.append(uid)
 
-            try:
-                pw = pwd.getpwnam(uid)
-            except:
-                continue
+            if local:
+                pw = ldap_to_passwd(u, uid)
+                if pw is None:
+                    continue
+
+            else:
+                try:
+                    pw = pwd.getpwnam(uid)
+                except:
+                    continue
 
-            self.__users.append(pw)
             if self.flags & FLAGS_CACHE_WRITE_USER:
                 self.__ucache[uid] = pw
+            else:
+                self.__users.append(pw)
 
             pw = None
 
         if self.flags & FLAGS_CACHE_WRITE_USER:
+            self.__ucache.commit()
+            self.__ducache.commit()
             self.__loaded('u', True)
             self.__loaded('du', True)
 
@@ -2591,6 +2918,7 @@ class FreeNAS_ActiveDirectory_Users(FreeNAS_ActiveDirectory):
                 self.__ucache[n] = FreeNAS_UserCache(dir=n)
                 self.__ducache[n] = FreeNAS_Directory_UserCache(dir=n)
 
+        self.__idmap = FreeNAS_ActiveDirectory_Idmap.get()
         self.__get_users()
 
         log.debug("FreeNAS_ActiveDirectory_Users.__init__: leave")
@@ -2663,57 +2991,98 @@ class FreeNAS_ActiveDirectory_Users(FreeNAS_ActiveDirectory):
                 log.debug("FreeNAS_ActiveDirectory_Users.__get_users: leave")
                 return
 
-        for d in self.__domains:
-            n = d['nETBIOSName']
-            self.__users[n] = []
+        self.attributes = ['sAMAccountName']
 
-            dcs = self.get_domain_controllers(d['dnsRoot'], ssl=self.ssl)
-            if not dcs:
-                raise FreeNAS_ActiveDirectory_Exception(
-                    "Unable to find domain controllers for %s" % d['dnsRoot'])
-            (self.host, self.port) = self.get_best_host(dcs)
+        # Locating the domain controllers is not thread safe, only the
+        # searches run concurrently.
+        handles = {}
+        try:
+            for d in self.__domains:
+                n = d['nETBIOSName']
+                if not (
+                    (self.flags & FLAGS_CACHE_READ_USER) and
+                    self.__loaded('du', n)
+                ):
+                    handles[n] = self.get_domain_handle(d)
+
+            with ThreadPoolExecutor(
+                max_workers=FREENAS_AD_DOMAIN_WORKERS
+            ) as executor:
+                usernames = list(executor.map(
+                    lambda d: self.__get_domain_users(
+                        d, handles.get(d['nETBIOSName'])
+                    ),
+                    self.__domains
+                ))
 
-            self.basedn = d['nCName']
-            self.attributes = ['sAMAccountName']
-            self.pagesize = FREENAS_LDAP_PAGESIZE
+        finally:
+            for handle in handles.values():
+                if handle is not self.dchandle:
+                    handle.close()
 
-            if (
-                (self.flags & FLAGS_CACHE_READ_USER) and
-                self.__loaded('du', n)
-            ):
-                log.debug(
-                    "FreeNAS_ActiveDirectory_Users.__get_users: "
-                    "AD [%s] users in cache",
-                    n
-                )
-                ad_users = self.__ducache[n]
+        for names in usernames:
+            self.__usernames.extend(names)
 
-            else:
-                log.debug(
-                    "FreeNAS_ActiveDirectory_Users.__get_users: "
-                    "AD [%s] users not in cache",
-                    n
-                )
-                ad_users = self.get_users()
+        log.debug("FreeNAS_ActiveDirectory_Users.__get_users: leave")
 
-            for u in ad_users:
-                CN = str(u[0])
+    def __get_domain_users(self, domain, handle):
+        n = domain['nETBIOSName']
+        usernames = []
 
-                if self.flags & FLAGS_CACHE_WRITE_USER:
-                    self.__ducache[n][CN] = u
+        if handle is None:
+            log.debug(
+                "FreeNAS_ActiveDirectory_Users.__get_users: "
+                "AD [%s] users in cache",
+                n
+            )
+            ad_users = self.__ducache[n]
 
-                u = u[1]
-                if self.use_default_domain:
-                    sAMAccountName = u['sAMAccountName'][0].decode('utf8')
-                else:
-                    sAMAccountName = "{}{}{}".format(
-                        n,
-                        FREENAS_AD_SEPARATOR,
-                        u['sAMAccountName'][0].decode('utf8')
-                    )
+        else:
+            log.debug(
+                "FreeNAS_ActiveDirectory_Users.__get_users: "
+                "AD [%s] users not in cache",
+                n
+            )
+            ad_users = self.iter_users(handle, domain['nCName'])
+
+        # idmap is only configured for the domain joined, ids of the
+        # trusted domains are allocated by winbindd.
+        idmap = self.__idmap if n == self.netbiosname else None
+        lookup = self.__gid_lookup(domain, idmap) if idmap else None
 
-                self.__usernames.append(sAMAccountName)
+        # Entries are streamed into a new generation of the cache rather
+        # than kept in a list
+        if self.flags & FLAGS_CACHE_WRITE_USER:
+            self.__ucache[n].begin()
+            self.__ducache[n].begin()
+            self.__users[n] = self.__ucache[n]
+        else:
+            self.__users[n] = []
+
+        for u in ad_users:
+            CN = str(u[0])
+
+            if self.flags & FLAGS_CACHE_WRITE_USER:
+                self.__ducache[n][CN] = u
 
+            u = u[1]
+            if self.use_default_domain:
+                sAMAccountName = u['sAMAccountName'][0].decode('utf8')
+            else:
+                sAMAccountName = "{}{}{}".format(
+                    n,
+                    FREENAS_AD_SEPARATOR,
+                    u['sAMAccountName'][0].decode('utf8')
+                )
+
+            usernames.append(sAMAccountName)
+
+            if idmap:
+                pw = idmap.passwd(u, sAMAccountName, n, lookup)
+                if pw is None:
+                    continue
+
+            else:
                 try:
                     pw = pwd.getpwnam(sAMAccountName)
 
@@ -2721,17 +3090,37 @@ class FreeNAS_ActiveDirectory_Users(FreeNAS_ActiveDirectory):
                     log.debug("Error on getpwnam: %s", e)
                     continue
 
+            if self.flags & FLAGS_CACHE_WRITE_USER:
+                self.__ucache[n][sAMAccountName] = pw
+            else:
                 self.__users[n].append(pw)
-                if self.flags & FLAGS_CACHE_WRITE_USER:
-                    self.__ucache[n][sAMAccountName] = pw
 
-                pw = None
+            pw = None
 
-            if self.flags & FLAGS_CACHE_WRITE_USER:
-                self.__loaded('u', n, True)
-                self.__loaded('du', n, True)
+        if self.flags & FLAGS_CACHE_WRITE_USER:
+            self.__ucache[n].commit()
+            self.__ducache[n].commit()
+            self.__loaded('u', n, True)
+            self.__loaded('du', n, True)
+
+        return usernames
+
+    def __gid_lookup(self, domain, idmap):
+        gids = {}
+
+        def lookup(sid):
+            if sid not in gids:
+                gids[sid] = None
+                for r in self._search_iter(
+                    self.dchandle, domain['nCName'], ldap.SCOPE_SUBTREE,
+                    sid_to_filter(sid)
+                ):
+                    if r[0]:
+                        gids[sid] = idmap.gid(r[1])
+                        break
+            return gids[sid]
 
-        log.debug("FreeNAS_ActiveDirectory_Users.__get_users: leave")
+        return lookup
 
 
 class FreeNAS_Directory_Users(object):
@@ -2826,6 +3215,7 @@ class FreeNAS_LDAP_Groups(FreeNAS_LDAP):
             return
 
         self.attributes = ['cn']
+        self.pagesize = FREENAS_LDAP_PAGESIZE
 
         ldap_groups = None
         if (self.flags & FLAGS_CACHE_READ_GROUP) and self.__loaded('dg'):
@@ -2838,7 +3228,15 @@ class FreeNAS_LDAP_Groups(FreeNAS_LDAP):
             log.debug(
                 "FreeNAS_LDAP_Groups.__get_groups: LDAP groups not in cache"
             )
-            ldap_groups = self.get_groups()
+            ldap_groups = self.iter_groups()
+
+        # See FreeNAS_LDAP_Users
+        local = ldap_enabled()
+
+        if self.flags & FLAGS_CACHE_WRITE_GROUP:
+            self.__gcache.begin()
+            self.__dgcache.begin()
+            self.__groups = self.__gcache
 
         # parts = self.host.split('.')
         # host = parts[0].upper()
@@ -2855,20 +3253,28 @@ class FreeNAS_LDAP_Groups(FreeNAS_LDAP):
 
             self.__groupnames.append(cn)
 
-            try:
-                gr = grp.getgrnam(cn)
+            if local:
+                gr = ldap_to_group(g, cn)
+                if gr is None:
+                    continue
 
-            except:
-                continue
+            else:
+                try:
+                    gr = grp.getgrnam(cn)
 
-            self.__groups.append(gr)
+                except:
+                    continue
 
             if self.flags & FLAGS_CACHE_WRITE_GROUP:
                 self.__gcache[cn] = gr
+            else:
+                self.__groups.append(gr)
 
             gr = None
 
         if self.flags & FLAGS_CACHE_WRITE_GROUP:
+            self.__gcache.commit()
+            self.__dgcache.commit()
             self.__loaded('g', True)
             self.__loaded('dg', True)
 
@@ -2901,6 +3307,7 @@ class FreeNAS_ActiveDirectory_Groups(FreeNAS_ActiveDirectory):
                 self.__gcache[n] = FreeNAS_GroupCache(dir=n)
                 self.__dgcache[n] = FreeNAS_Directory_GroupCache(dir=n)
 
+        self.__idmap = FreeNAS_ActiveDirectory_Idmap.get()
         self.__get_groups()
 
         log.debug("FreeNAS_ActiveDirectory_Groups.__init__: leave")
@@ -2976,56 +3383,91 @@ class FreeNAS_ActiveDirectory_Groups(FreeNAS_ActiveDirectory):
                 )
                 return
 
-        for d in self.__domains:
-            n = d['nETBIOSName']
-            self.__groups[n] = []
+        self.attributes = ['sAMAccountName']
 
-            dcs = self.get_domain_controllers(d['dnsRoot'], ssl=self.ssl)
-            if not dcs:
-                raise FreeNAS_ActiveDirectory_Exception(
-                    "Unable to find domain controllers for %s" % d['dnsRoot'])
-            (self.host, self.port) = self.get_best_host(dcs)
+        # See FreeNAS_ActiveDirectory_Users
+        handles = {}
+        try:
+            for d in self.__domains:
+                n = d['nETBIOSName']
+                if not (
+                    (self.flags & FLAGS_CACHE_READ_GROUP) and
+                    self.__loaded('dg', n)
+                ):
+                    handles[n] = self.get_domain_handle(d)
+
+            with ThreadPoolExecutor(
+                max_workers=FREENAS_AD_DOMAIN_WORKERS
+            ) as executor:
+                groupnames = list(executor.map(
+                    lambda d: self.__get_domain_groups(
+                        d, handles.get(d['nETBIOSName'])
+                    ),
+                    self.__domains
+                ))
 
-            self.basedn = d['nCName']
-            self.attributes = ['sAMAccountName']
-            self.pagesize = FREENAS_LDAP_PAGESIZE
+        finally:
+            for handle in handles.values():
+                if handle is not self.dchandle:
+                    handle.close()
 
-            if (
-                (self.flags & FLAGS_CACHE_READ_GROUP) and
-                self.__loaded('dg', n)
-            ):
-                log.debug(
-                    "FreeNAS_ActiveDirectory_Groups.__get_groups: "
-                    "AD [%s] groups in cache",
-                    n
-                )
-                ad_groups = self.__dgcache[n]
+        for names in groupnames:
+            self.__groupnames.extend(names)
+
+        log.debug("FreeNAS_ActiveDirectory_Groups.__get_groups: leave")
+
+    def __get_domain_groups(self, domain, handle):
+        n = domain['nETBIOSName']
+        groupnames = []
+
+        if handle is None:
+            log.debug(
+                "FreeNAS_ActiveDirectory_Groups.__get_groups: "
+                "AD [%s] groups in cache",
+                n
+            )
+            ad_groups = self.__dgcache[n]
+
+        else:
+            log.debug(
+                "FreeNAS_ActiveDirectory_Groups.__get_groups: "
+                "AD [%s] groups not in cache",
+                n
+            )
+            ad_groups = self.iter_groups(handle, domain['nCName'])
+
+        idmap = self.__idmap if n == self.netbiosname else None
+
+        if self.flags & FLAGS_CACHE_WRITE_GROUP:
+            self.__gcache[n].begin()
+            self.__dgcache[n].begin()
+            self.__groups[n] = self.__gcache[n]
+        else:
+            self.__groups[n] = []
 
+        for g in ad_groups:
+            CN = str(g[0])
+
+            if self.use_default_domain:
+                sAMAccountName = g[1]['sAMAccountName'][0].decode('utf8')
             else:
-                log.debug(
-                    "FreeNAS_ActiveDirectory_Groups.__get_groups: "
-                    "AD [%s] groups not in cache",
-                    n
+                sAMAccountName = "{}{}{}".format(
+                    n,
+                    FREENAS_AD_SEPARATOR,
+                    g[1]['sAMAccountName'][0].decode('utf8')
                 )
-                ad_groups = self.get_groups()
 
-            for g in ad_groups:
-                CN = str(g[0])
+            groupnames.append(sAMAccountName)
 
-                if self.use_default_domain:
-                    sAMAccountName = g[1]['sAMAccountName'][0].decode('utf8')
-                else:
-                    sAMAccountName = "{}{}{}".format(
-                        n,
-                        FREENAS_AD_SEPARATOR,
-                        g[1]['sAMAccountName'][0].decode('utf8')
-                    )
-
-                self.__groupnames.append(sAMAccountName)
+            if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                self.__dgcache[n][CN] = g
 
-                if self.flags & FLAGS_CACHE_WRITE_GROUP:
-                    self.__dgcache[n][CN] = g
+            if idmap:
+                gr = idmap.group(g[1], sAMAccountName)
+                if gr is None:
+                    continue
 
+            else:
                 try:
                     gr = grp.getgrnam(sAMAccountName)
 
@@ -3033,17 +3475,20 @@ class FreeNAS_ActiveDirectory_Groups(FreeNAS_ActiveDirectory):
                     log.debug("Error on getgrnam: %s", e)
                     continue
 
+            if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                self.__gcache[n][sAMAccountName] = gr
+            else:
                 self.__groups[n].append(gr)
-                if self.flags & FLAGS_CACHE_WRITE_GROUP:
-                    self.__gcache[n][sAMAccountName] = gr
 
-                gr = None
+            gr = None
 
-            if self.flags & FLAGS_CACHE_WRITE_GROUP:
-                self.__loaded('g', n, True)
-                self.__loaded('dg', n, True)
+        if self.flags & FLAGS_CACHE_WRITE_GROUP:
+            self.__gcache[n].commit()
+            self.__dgcache[n].commit()
+            self.__loaded('g', n, True)
+            self.__loaded('dg', n, True)
 
-        log.debug("FreeNAS_ActiveDirectory_Groups.__get_groups: leave")
+        return groupnames
 
 
 class FreeNAS_Directory_Groups(object):
@@ -29,7 +29,16 @@ import os
 import pwd
 
 from freenasUI.common.cmd import cmd_pipe
-from freenasUI.common.freenascache import *
+from freenasUI.common.freenascache import (
+    FreeNAS_UserCache,
+    FreeNAS_GroupCache,
+    FreeNAS_Directory_UserCache,
+    FreeNAS_Directory_GroupCache,
+    FLAGS_CACHE_READ_USER,
+    FLAGS_CACHE_READ_GROUP,
+    FLAGS_CACHE_WRITE_USER,
+    FLAGS_CACHE_WRITE_GROUP,
+)
 from freenasUI.common.system import nis_objects
 
 log = logging.getLogger('common.freenasnis')
@@ -337,6 +346,10 @@ class FreeNAS_NIS_Users(FreeNAS_NIS):
                 )
                 nis_users = self.get_users(domain=d)
 
+            if self.flags & FLAGS_CACHE_WRITE_USER:
+                self.__ucache[d].begin()
+                self.__ducache[d].begin()
+
             for u in nis_users:
                 uid = u['uid']
 
@@ -359,6 +372,8 @@ class FreeNAS_NIS_Users(FreeNAS_NIS):
                 pw = None
 
             if self.flags & FLAGS_CACHE_WRITE_USER:
+                self.__ucache[d].commit()
+                self.__ducache[d].commit()
                 self.__loaded('u', d, True)
                 self.__loaded('du', d, True)
 
@@ -479,6 +494,10 @@ class FreeNAS_NIS_Groups(FreeNAS_NIS):
                 )
                 nis_groups = self.get_groups()
 
+            if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                self.__gcache[d].begin()
+                self.__dgcache[d].begin()
+
             for g in nis_groups:
                 group = g['group']
 
@@ -500,6 +519,8 @@ class FreeNAS_NIS_Groups(FreeNAS_NIS):
                 gr = None
 
             if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                self.__gcache[d].commit()
+                self.__dgcache[d].commit()
                 self.__loaded('g', d, True)
                 self.__loaded('dg', d, True)
 
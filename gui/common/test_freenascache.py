@@ -0,0 +1,97 @@
+import grp
+import os
+import pwd
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase
+
+from freenasUI.common.freenascache import (
+    FreeNAS_BaseCache,
+    cache_dumps,
+    cache_loads,
+)
+
+
+def passwd(name, uid):
+    return pwd.struct_passwd((name, '*', uid, uid, '', '/home/%s' % name, '/bin/sh'))
+
+
+class FreeNASBaseCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cachedir)
+        self.cache = FreeNAS_BaseCache(cachedir=self.cachedir)
+        for i, name in enumerate(['alice', 'Albert', 'bob', 'carol', 'malice']):
+            self.cache[name] = passwd(name, 1000 + i)
+
+    def names(self, records):
+        return [r.pw_name for r in records]
+
+    def test_serialization(self):
+        pw = passwd('alice', 1000)
+        self.assertEqual(cache_loads(cache_dumps(pw)), pw)
+        self.assertIsInstance(cache_loads(cache_dumps(pw)), pwd.struct_passwd)
+        gr = grp.struct_group(('staff', 'x', 20, ['alice']))
+        self.assertEqual(cache_loads(cache_dumps(gr)), gr)
+        entry = ('CN=alice,DC=example,DC=com', {'uid': [b'alice']})
+        self.assertEqual(cache_loads(cache_dumps(entry)), entry)
+
+    def test_getitem(self):
+        self.assertEqual(self.cache['bob'].pw_uid, 1002)
+        self.assertIn('bob', self.cache)
+        self.assertNotIn('dave', self.cache)
+        with self.assertRaises(KeyError):
+            self.cache['dave']
+
+    def test_no_overwrite(self):
+        self.cache['bob'] = passwd('bob', 2000)
+        self.assertEqual(self.cache['bob'].pw_uid, 1002)
+        self.cache.write('bob', passwd('bob', 2000), overwrite=True)
+        self.assertEqual(self.cache['bob'].pw_uid, 2000)
+
+    def test_iter(self):
+        self.assertEqual(len(self.cache), 5)
+        self.assertEqual(self.names(self.cache), ['Albert', 'alice', 'bob', 'carol', 'malice'])
+
+    def test_search_prefix(self):
+        self.assertEqual(self.names(self.cache.search(prefix='al')), ['Albert', 'alice'])
+
+    def test_search_substring(self):
+        self.assertEqual(self.names(self.cache.search(substring='lic')), ['alice', 'malice'])
+        self.assertEqual(self.names(self.cache.search(substring='o')), ['bob', 'carol'])
+
+    def test_search_page(self):
+        self.assertEqual(self.names(self.cache.page(offset=1, limit=2)), ['alice', 'bob'])
+
+    def test_delete(self):
+        self.cache.delete('malice')
+        self.assertEqual(self.names(self.cache.search(substring='lic')), ['alice'])
+
+    def test_generation(self):
+        reader = FreeNAS_BaseCache(cachedir=self.cachedir)
+
+        self.cache.begin()
+        self.cache['dave'] = passwd('dave', 1005)
+        # Readers keep the current generation until it is swapped
+        self.assertEqual(len(reader), 5)
+        self.assertNotIn('dave', self.cache)
+
+        self.cache.commit()
+        self.assertEqual(self.names(reader), ['dave'])
+        # Previous generation is gone
+        self.assertEqual(
+            sorted(f for f in os.listdir(self.cachedir) if f.endswith('.sqlite')),
+            sorted(['.cache.sqlite', os.readlink(os.path.join(self.cachedir, '.cache.sqlite'))]),
+        )
+
+    def test_rollback(self):
+        self.cache.begin()
+        self.cache['dave'] = passwd('dave', 1005)
+        self.cache.rollback()
+        self.assertEqual(len(self.cache), 5)
+
+    def test_expire(self):
+        self.cache.expire()
+        self.assertTrue(self.cache.empty())
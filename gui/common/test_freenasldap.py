@@ -0,0 +1,217 @@
+import grp
+import pwd
+import struct
+from unittest import mock
+
+import ldap
+from django.test import SimpleTestCase
+from ldap.controls import SimplePagedResultsControl
+
+from freenasUI.common import freenasldap
+from freenasUI.common.freenasldap import (
+    FreeNAS_ActiveDirectory_Base,
+    FreeNAS_ActiveDirectory_Groups,
+    FreeNAS_ActiveDirectory_Idmap,
+    FreeNAS_ActiveDirectory_Users,
+    FreeNAS_LDAP_Directory,
+    sid_to_rid,
+)
+
+DOMAIN_SID = b'\x01\x05\x00\x00\x00\x00\x00\x05\x15\x00\x00\x00' + struct.pack('<III', 1, 2, 3)
+
+
+def sid(rid):
+    return DOMAIN_SID + struct.pack('<I', rid)
+
+
+def user(name, rid, **attrs):
+    entry = {
+        'sAMAccountName': [name.encode()],
+        'sAMAccountType': [b'805306368'],
+        'objectSid': [sid(rid)],
+        'primaryGroupID': [b'513'],
+    }
+    entry.update({k: [str(v).encode()] for k, v in attrs.items()})
+    return ('CN=%s,CN=Users,DC=example,DC=com' % name, entry)
+
+
+def group(name, rid, **attrs):
+    entry = {
+        'sAMAccountName': [name.encode()],
+        'groupType': [b'-2147483646'],
+        'objectSid': [sid(rid)],
+    }
+    entry.update({k: [str(v).encode()] for k, v in attrs.items()})
+    return ('CN=%s,CN=Users,DC=example,DC=com' % name, entry)
+
+
+class FakeLDAP(object):
+    """
+    In-process stand-in of a python-ldap connection serving paged
+    searches of a fixed set of entries.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.searches = []
+
+    def __match(self, filterstr, entry):
+        if 'objectSid=' in filterstr:
+            value = ''.join('\\%02x' % b for b in entry['objectSid'][0])
+            return value in filterstr
+        if 'objectclass=group' in filterstr:
+            return 'groupType' in entry
+        return 'sAMAccountType' in entry
+
+    def search_ext(self, basedn, scope, filterstr='', attrlist=None, attrsonly=0,
+                   serverctrls=None, clientctrls=None, timeout=-1, sizelimit=0):
+        paged = serverctrls[0]
+        self.searches.append((basedn, filterstr, paged.cookie, paged.size))
+        return len(self.searches)
+
+    def result3(self, msgid, resp_ctrl_classes=None):
+        basedn, filterstr, cookie, size = self.searches[msgid - 1]
+        entries = [
+            e for e in self.entries
+            if e[0].endswith(basedn) and self.__match(filterstr, e[1])
+        ]
+        start = int(cookie or 0)
+        end = start + size
+        control = SimplePagedResultsControl(
+            criticality=False, size=0, cookie=str(end) if end < len(entries) else ''
+        )
+        return (ldap.RES_SEARCH_RESULT, entries[start:end], msgid, [control])
+
+    def unbind(self):
+        pass
+
+
+def directory(entries, pagesize=2):
+    handle = FreeNAS_LDAP_Directory(pagesize=pagesize)
+    handle._handle = FakeLDAP(entries)
+    handle._isopen = True
+    return handle
+
+
+def ad_init(self, **kwargs):
+    self.flags = kwargs.get('flags', 0)
+    self.netbiosname = 'EXAMPLE'
+    self.basedn = 'DC=example,DC=com'
+    self.attributes = None
+    self.use_default_domain = False
+    self.disable_freenas_cache = False
+    self.dchandle = directory([
+        user('alice', 1104),
+        user('bob', 1105),
+        user('carol', 1106, displayName='Carol C'),
+        group('Domain Users', 513),
+        group('staff', 1200),
+    ])
+
+
+DOMAINS = [
+    {'nETBIOSName': 'EXAMPLE', 'dnsRoot': 'example.com', 'nCName': 'DC=example,DC=com'},
+    {'nETBIOSName': 'TRUSTED', 'dnsRoot': 'trusted.com', 'nCName': 'DC=trusted,DC=com'},
+]
+
+
+class FreeNASLDAPDirectoryTest(SimpleTestCase):
+
+    def test_search_iter_pages(self):
+        handle = directory([user('user%d' % i, 1000 + i) for i in range(5)])
+        results = handle._search_iter('DC=example,DC=com', filter='(sAMAccountName=*)')
+
+        self.assertEqual(next(results)[0], 'CN=user0,CN=Users,DC=example,DC=com')
+        # Only the first page has been requested so far
+        self.assertEqual(len(handle._handle.searches), 1)
+        self.assertEqual(len(list(results)), 4)
+        self.assertEqual(len(handle._handle.searches), 3)
+
+    def test_search(self):
+        handle = directory([user('user%d' % i, 1000 + i) for i in range(3)])
+        self.assertEqual(len(handle._search('DC=example,DC=com')), 3)
+
+
+class FreeNASActiveDirectoryIdmapTest(SimpleTestCase):
+
+    def test_sid_to_rid(self):
+        self.assertEqual(sid_to_rid(sid(1104)), 1104)
+        self.assertIsNone(sid_to_rid(b'\x01\x05'))
+
+    def test_rid(self):
+        idmap = FreeNAS_ActiveDirectory_Idmap('rid', 20000, 90000000)
+        pw = idmap.passwd(user('alice', 1104)[1], 'EXAMPLE\\alice', 'EXAMPLE')
+        self.assertEqual(pw, pwd.struct_passwd((
+            'EXAMPLE\\alice', '*', 21104, 20513, '', '/home/EXAMPLE/alice', '/bin/sh',
+        )))
+        self.assertEqual(idmap.group(group('staff', 1200)[1], 'staff').gr_gid, 21200)
+
+    def test_rid_out_of_range(self):
+        idmap = FreeNAS_ActiveDirectory_Idmap('rid', 20000, 21000)
+        self.assertIsNone(idmap.uid(user('alice', 1104)[1]))
+
+    def test_ad(self):
+        idmap = FreeNAS_ActiveDirectory_Idmap(
+            'ad', 10000, 90000000, schema_mode='rfc2307', nss_info='rfc2307',
+        )
+        entry = user('alice', 1104, uidNumber=10001, loginShell='/bin/csh')[1]
+        pw = idmap.passwd(entry, 'alice', 'EXAMPLE', lookup=lambda sid: 10513)
+        self.assertEqual(
+            (pw.pw_uid, pw.pw_gid, pw.pw_shell, pw.pw_dir),
+            (10001, 10513, '/bin/csh', '/home/EXAMPLE/alice'),
+        )
+        self.assertIsNone(idmap.uid(user('bob', 1105)[1]))
+
+
+@mock.patch.object(FreeNAS_ActiveDirectory_Base, '__init__', ad_init)
+@mock.patch.object(FreeNAS_ActiveDirectory_Base, 'get_domains', lambda self, **kwargs: DOMAINS)
+class FreeNASActiveDirectoryUsersTest(SimpleTestCase):
+
+    def setUp(self):
+        self.trusted = directory([
+            ('CN=dave,CN=Users,DC=trusted,DC=com', user('dave', 2000)[1]),
+        ])
+
+        def get_domain_handle(obj, domain):
+            return obj.dchandle if domain['nETBIOSName'] == 'EXAMPLE' else self.trusted
+
+        patches = [
+            mock.patch.object(FreeNAS_ActiveDirectory_Base, 'get_domain_handle', get_domain_handle),
+            mock.patch.object(
+                FreeNAS_ActiveDirectory_Idmap, 'get',
+                classmethod(lambda cls: cls('rid', 20000, 90000000)),
+            ),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_users(self):
+        getpwnam = mock.Mock(return_value=pwd.struct_passwd((
+            'TRUSTED\\dave', '*', 3000, 3000, '', '/home/TRUSTED/dave', '/bin/sh',
+        )))
+        with mock.patch.object(freenasldap.pwd, 'getpwnam', getpwnam):
+            users = FreeNAS_ActiveDirectory_Users()
+
+        self.assertEqual(
+            sorted((pw.pw_name, pw.pw_uid, pw.pw_gid) for pw in users),
+            [
+                ('EXAMPLE\\alice', 21104, 20513),
+                ('EXAMPLE\\bob', 21105, 20513),
+                ('EXAMPLE\\carol', 21106, 20513),
+                ('TRUSTED\\dave', 3000, 3000),
+            ],
+        )
+        # Only the trusted domain, not in the idmap, goes through winbindd
+        getpwnam.assert_called_once_with('TRUSTED\\dave')
+        self.assertEqual(len(users._get_uncached_usernames()), 4)
+
+    def test_groups(self):
+        with mock.patch.object(freenasldap.grp, 'getgrnam', side_effect=KeyError):
+            groups = FreeNAS_ActiveDirectory_Groups()
+
+        self.assertEqual(
+            sorted((gr.gr_name, gr.gr_gid) for gr in groups),
+            [('EXAMPLE\\Domain Users', 20513), ('EXAMPLE\\staff', 21200)],
+        )
+        self.assertIsInstance(next(iter(groups)), grp.struct_group)
@@ -436,11 +436,10 @@ def directoryservice_clearcache(request):
     error = False
     errmsg = ''
 
+    # fill builds new generations of the caches and swaps them in
     os.system(
         "(/usr/local/bin/python "
-        "/usr/local/www/freenasUI/tools/cachetool.py expire >/dev/null 2>&1 &&"
-        " /usr/local/bin/python /usr/local/www/freenasUI/tools/cachetool.py "
-        "fill >/dev/null 2>&1) &")
+        "/usr/local/www/freenasUI/tools/cachetool.py fill >/dev/null 2>&1) &")
 
     return HttpResponse(json.dumps({
         'error': error,
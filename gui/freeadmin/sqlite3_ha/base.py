@@ -1,8 +1,12 @@
 
+import functools
 import logging
 import os
+import queue
+import struct
 import threading
 import time
+import uuid
 from sqlite3 import OperationalError
 
 from django.db.backends.sqlite3 import base as sqlite3base
@@ -28,8 +32,20 @@ NO_SYNC_MAP = {
     'system_failover': {
         'fields': ['master'],
     },
+    'ha_changelog': {},
+    'ha_changelog_meta': {},
 }
 
+"""
+Rows changed are recorded by triggers in ha_changelog, the latest version
+(a global, increasing number) for every row, so the other node can be
+brought up to date sending only the rows changed since its last sync.
+
+Versions only make sense within an epoch, a new one is started every time
+the history may have been lost (e.g. a table rebuilt by a migration).
+"""
+HA_CHANGELOG_MAX = 50000
+
 
 class DBSync(object):
     """
@@ -54,26 +70,38 @@ class Journal(object):
     Interface for accessing the journal for the queries that couldn't run in
     the remote side, either for it being offline or failed to execute.
 
+    The journal is append-only: a header holding the offset of the first
+    entry not yet replayed followed by length-prefixed pickled entries, each
+    a list of (sql, params).  Appending is independent of the journal size
+    and entries appended within the same context are flushed with a single
+    fsync.  A journal without entries is an empty file.
+
     This should be used in a context and provides file locking by itself.
     """
 
     JOURNAL_FILE = '/data/ha-journal'
+    MAGIC = b'HAJ1'
+    HEADER = struct.Struct('>4sQ')
+    ENTRY = struct.Struct('>I')
+    # Drop replayed entries once they take more than this many bytes
+    COMPACT_SIZE = 1024 * 1024
+    # Queries shipped to the remote side per call on replay
+    REPLAY_CHUNK = 500
 
     @classmethod
     def is_empty(cls):
-        if not os.path.exists(cls.JOURNAL_FILE):
-            return True
         try:
-            return os.stat(cls.JOURNAL_FILE).st_size == 0
+            with open(cls.JOURNAL_FILE, 'rb') as f:
+                header = f.read(cls.HEADER.size)
+                size = os.fstat(f.fileno()).st_size
         except OSError:
             return True
-
-    def _get_queries(self):
-        try:
-            with open(self.JOURNAL_FILE, 'rb') as f:
-                self.queries = pickle.loads(f.read())
-        except (pickle.PickleError, EOFError):
-            self.queries = []
+        if not header:
+            return True
+        if len(header) < cls.HEADER.size or not header.startswith(cls.MAGIC):
+            # Legacy journal, a single pickled list
+            return False
+        return cls.HEADER.unpack(header)[1] >= size
 
     def __enter__(self):
         self._lock = LockFile(self.JOURNAL_FILE)
@@ -83,55 +111,463 @@ class Journal(object):
             except LockTimeout:
                 self._lock.break_lock()
 
-        if not os.path.exists(self.JOURNAL_FILE):
-            open(self.JOURNAL_FILE, 'a').close()
-
-        self._get_queries()
+        self._file = self._open_file()
+        self._pending = []
+        self._queries = None
+        self._loaded = None
+        try:
+            self._open()
+        except Exception:
+            self._file.close()
+            self._lock.release()
+            raise
         return self
 
     def __exit__(self, typ, value, traceback):
+        try:
+            if self._queries is not None and self._queries != self._loaded:
+                # Legacy interface, whole journal was (possibly) modified
+                self._rewrite([self._queries] if self._queries else [])
+            self.flush()
+        finally:
+            self._file.close()
+            self._lock.release()
+        if typ is not None:
+            raise
 
-        with open(self.JOURNAL_FILE, 'wb+') as f:
-            if self.queries:
-                f.write(pickle.dumps(self.queries))
+    def _open_file(self):
+        # Not opened in append mode, the header is updated in place
+        return os.fdopen(os.open(self.JOURNAL_FILE, os.O_RDWR | os.O_CREAT, 0o600), 'r+b')
 
-        self._lock.release()
-        if typ is not None:
+    def _open(self):
+        self._file.seek(0)
+        header = self._file.read(self.HEADER.size)
+        if header.startswith(self.MAGIC) and len(header) == self.HEADER.size:
+            self._start = self.HEADER.unpack(header)[1]
+            return
+        if header:
+            # Convert a legacy journal in place
+            self._file.seek(0)
+            try:
+                queries = pickle.loads(self._file.read())
+            except (pickle.PickleError, EOFError):
+                log.error('Discarding corrupted HA journal', exc_info=True)
+                queries = []
+            self._rewrite([queries] if queries else [])
+        else:
+            # Header is written along with the first entry
+            self._start = self.HEADER.size
+
+    def _write_header(self, start):
+        self._start = start
+        os.pwrite(self._file.fileno(), self.HEADER.pack(self.MAGIC, start), 0)
+
+    def _rewrite(self, entries):
+        """
+        Replace the journal contents by `entries`.
+        """
+        self._file.truncate(0)
+        self._start = self.HEADER.size
+        for entry in entries:
+            self._pending.append(entry)
+        self.flush()
+
+    def _entries(self):
+        """
+        Iterate over (entry, offset of the next entry) not yet replayed.
+        """
+        offset = self._start
+        self._file.seek(offset)
+        while True:
+            size = self._file.read(self.ENTRY.size)
+            if len(size) < self.ENTRY.size:
+                break
+            data = self._file.read(self.ENTRY.unpack(size)[0])
+            try:
+                entry = pickle.loads(data)
+            except (pickle.PickleError, EOFError):
+                # Partially written entry, e.g. power loss before fsync
+                log.error('Truncated HA journal entry at offset %d', offset)
+                break
+            offset += self.ENTRY.size + len(data)
+            yield entry, offset
+
+    @property
+    def queries(self):
+        """
+        All queries not replayed yet, as a list.
+
+        Kept for compatibility, assigning or modifying it rewrites the
+        whole journal.  Use `append` and `replay` instead.
+        """
+        if self._queries is None:
+            self.flush()
+            self._loaded = [q for entry, offset in self._entries() for q in entry]
+            self._queries = list(self._loaded)
+        return self._queries
+
+    @queries.setter
+    def queries(self, value):
+        self.queries
+        self._queries = value
+
+    def empty(self):
+        if self._pending:
+            return False
+        return self._start >= os.fstat(self._file.fileno()).st_size
+
+    def append(self, queries):
+        if self._queries is not None:
+            self._queries.extend(queries)
+        else:
+            self._pending.append(list(queries))
+
+    def flush(self):
+        if not self._pending:
+            return
+        data = bytearray()
+        for entry in self._pending:
+            entry = pickle.dumps(entry)
+            data += self.ENTRY.pack(len(entry)) + entry
+        self._pending = []
+        if self._file.seek(0, os.SEEK_END) == 0:
+            data[:0] = self.HEADER.pack(self.MAGIC, self._start)
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def replay(self, send, chunk=None):
+        """
+        Ship journaled queries in order calling `send(queries)` with about
+        `chunk` queries at a time (entries are not split), marking them as
+        replayed as it goes so a failure does not send them again.
+        """
+        chunk = chunk or self.REPLAY_CHUNK
+        self.flush()
+        queries = []
+        try:
+            for entry, offset in self._entries():
+                queries.extend(entry)
+                if len(queries) >= chunk:
+                    send(queries)
+                    queries = []
+                    self._write_header(offset)
+            if queries:
+                send(queries)
+        except Exception:
+            self.compact()
             raise
+        self.clear()
 
+    def clear(self):
+        self._pending = []
+        self._queries = self._loaded = None
+        self._file.truncate(0)
+        self._start = self.HEADER.size
+        os.fsync(self._file.fileno())
 
-class RunSQLRemote(threading.Thread):
+    def compact(self):
+        """
+        Drop replayed entries from the journal file.
+        """
+        self.flush()
+        if self._start - self.HEADER.size < self.COMPACT_SIZE:
+            return
+        self._file.seek(self._start)
+        tmp = self.JOURNAL_FILE + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.HEADER.size))
+            while True:
+                data = self._file.read(1024 * 1024)
+                if not data:
+                    break
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.JOURNAL_FILE)
+        self._file.close()
+        self._file = self._open_file()
+        self._start = self.HEADER.size
+
+
+class FailoverStatus(object):
     """
-    This is a thread responsible for running the queries on the remote side.
+    Cache of the failover status of this node.
 
-    The query will be appended to the Journal in case the Journal is not empty
-    or if it fails (e.g. remote side offline)
+    Getting it is extremely time-consuming, so a MASTER status is kept for
+    TTL seconds, which bounds how long a node may go on replicating its
+    writes after it stopped being the MASTER.
     """
 
+    TTL = 30
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._status = None
+        self._expire = 0
+
+    def _refresh(self):
+        try:
+            from freenasUI.middleware.notifier import notifier
+            if hasattr(notifier, 'failover_status'):
+                self._status = notifier().failover_status()
+            else:
+                self._status = None
+        except Exception:
+            self._status = None
+        self._expire = time.monotonic() + self.TTL
+
+    def is_master(self):
+        """
+        Whether this node is the MASTER.
+
+        Only a MASTER status is served from cache, anything else is checked
+        again so writes made right after this node took over are not left
+        out of replication.
+        """
+        with self._lock:
+            if self._status != 'MASTER' or time.monotonic() >= self._expire:
+                self._refresh()
+            return self._status == 'MASTER'
+
+
+failover_status = FailoverStatus()
+
+
+class ReplicationWorker(threading.Thread):
+    """
+    This is the thread responsible for running the queries on the remote side.
+
+    Queries are run in the order they were queued.  Everything queued while
+    a batch is being sent goes in the next batch, as a single remote call.
+
+    The queries will be appended to the Journal in case the Journal is not
+    empty or if it fails (e.g. remote side offline), the Journal being
+    replayed first once the remote side is back.
+    """
+
+    # Seconds between attempts to replay the journal
+    REPLAY_INTERVAL = 30
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
     def __init__(self, *args, **kwargs):
-        self._sql = kwargs.pop('sql')
-        self._params = kwargs.pop('params')
-        super(RunSQLRemote, self).__init__(*args, **kwargs)
+        super(ReplicationWorker, self).__init__(*args, **kwargs)
+        self.daemon = True
+        self._queue = queue.Queue()
+        self._client = None
+        self._replay_after = 0
+
+    @classmethod
+    def get(cls):
+        with cls._instance_lock:
+            if cls._instance is None or not cls._instance.is_alive():
+                cls._instance = cls()
+                cls._instance.start()
+            return cls._instance
+
+    def put(self, queries):
+        """
+        Queue `queries` to be run on the remote side.
+
+        Returns an event set once they were run or journaled.
+        """
+        done = threading.Event()
+        self._queue.put((queries, done))
+        return done
+
+    def _get_client(self):
+        from freenasUI.middleware.client import Client
+        if self._client is None:
+            self._client = Client()
+        return self._client
+
+    def _close_client(self):
+        if self._client is not None:
+            try:
+                self._client.close()
+            except Exception:
+                pass
+            self._client = None
 
     def run(self):
-        from freenasUI.middleware.client import client, ClientException
+        while True:
+            # Retry the journal every now and then while there is one
+            try:
+                batch = [self._queue.get(
+                    timeout=None if Journal.is_empty() else self.REPLAY_INTERVAL
+                )]
+            except queue.Empty:
+                self._send([])
+                continue
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._send([q for queries, done in batch for q in queries])
+            finally:
+                for queries, done in batch:
+                    done.set()
+
+    def _call(self, queries):
+        self._get_client().call('failover.call_remote', 'datastore.sql_batch', [queries])
+
+    def _send(self, queries):
+        from freenasUI.middleware.client import ClientException
         try:
-            with Journal() as f:
-                if f.queries:
-                    f.queries.append((self._sql, self._params))
-                else:
-                    with client as c:
-                        c.call('failover.call_remote', 'datastore.sql', [self._sql, self._params])
+            with Journal() as j:
+                try:
+                    if not j.empty():
+                        # Do not wait on an offline remote side for every write
+                        if time.monotonic() < self._replay_after:
+                            j.append(queries)
+                            return False
+                        j.replay(self._call)
+                    if queries:
+                        self._call(queries)
+                except Exception:
+                    if queries:
+                        j.append(queries)
+                    self._replay_after = time.monotonic() + self.REPLAY_INTERVAL
+                    raise
         except ClientException:
-            with Journal() as f:
-                f.queries.append((self._sql, self._params))
             return False
         except Exception as err:
-            log.error('Failed to run SQL remotely %s: %s', self._sql, err, exc_info=True)
+            log.error('Failed to run %d SQL queries remotely: %s', len(queries), err, exc_info=True)
+            # Connection may be broken, start a new one next time
+            self._close_client()
             return False
         return True
 
 
+def replicate(queries):
+    """
+    Run `queries` on the remote side, waiting for it only within DBSync.
+    """
+    done = ReplicationWorker.get().put(queries)
+    if execute_sync:
+        done.wait()
+
+
+def convert_query(query):
+    return sqlite3base.FORMAT_QMARK_REGEX.sub('?', query).replace(
+        '%%', '%'
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def replicated_statements(query, convert):
+    """
+    Process the query, modify it if necessary based on NO_SYNC_MAP rules.
+
+    Returns the statements to be run on the remote side along with the
+    indexes of the params they do not use anymore.  Parsing is expensive
+    and the same queries are run over and over, so it is cached by query.
+    """
+    rv = []
+    parse = sqlparse.parse(query)
+    for p in parse:
+
+        # Only care for DELETE, INSERT and UPDATE queries
+        if p.tokens[0].normalized not in ('DELETE', 'INSERT', 'UPDATE'):
+            continue
+
+        # Remember correspondent params to delete
+        delete_idx = []
+        if p.tokens[0].normalized == 'INSERT':
+
+            into = p.token_next_by(m=(sqlparse.tokens.Keyword, 'INTO'))
+            if not into:
+                continue
+
+            next_ = p.token_next(into[0])
+
+            if next_[1].value in NO_SYNC_MAP:
+                continue
+
+        elif p.tokens[0].normalized == 'DELETE':
+
+            from_ = p.token_next_by(m=(sqlparse.tokens.Keyword, 'FROM'))
+            if not from_:
+                continue
+
+            next_ = p.token_next(from_[0])
+
+            if next_[1].value in NO_SYNC_MAP:
+                continue
+
+        elif p.tokens[0].normalized == 'UPDATE':
+
+            name = p.token_next(0)[1].value
+            no_sync = NO_SYNC_MAP.get(name)
+            # Skip if table is in set to not to sync and has no attrs
+            if no_sync is None and name in NO_SYNC_MAP:
+                continue
+
+            set_ = p.token_next_by(m=(sqlparse.tokens.Keyword, 'SET'))
+            if not set_:
+                continue
+
+            next_ = p.token_next(set_[0])
+            if not next_:
+                continue
+
+            if no_sync is None:
+                lookup = []
+            else:
+
+                if 'fields' not in no_sync:
+                    continue
+
+                if issubclass(
+                    next_[1].__class__, sqlparse.sql.IdentifierList
+                ):
+                    lookup = list(next_[1].get_sublists())
+                elif issubclass(next_[1].__class__, sqlparse.sql.Comparison):
+                    lookup = [next_[1]]
+
+                # Get all placeholders from the query (%s or ?)
+                placeholders = [a for a in p.flatten() if a.value in ('%s', '?')]
+
+            for l in lookup:
+
+                if l.value not in no_sync['fields']:
+                    continue
+
+                # Remove placeholder from the params
+                try:
+                    idx = placeholders.index(l.tokens[-1])
+                    delete_idx.append(idx)
+                except ValueError:
+                    pass
+
+                # If it is a list we must also remove the comma around it
+                t_index = l.parent.token_index(l)
+                prev_ = l.parent.token_prev(t_index)
+                next_ = l.parent.token_next(t_index)
+                if next_ and issubclass(
+                    next_[1].__class__, sqlparse.sql.Token
+                ) and next_[1].value == ',':
+                    del l.parent.tokens[next_[0]]
+                elif prev_ and issubclass(
+                    prev_[1].__class__, sqlparse.sql.Token
+                ) and prev_[1].value == ',':
+                    del l.parent.tokens[prev_[0]]
+                del l.parent.tokens[l.parent.token_index(l)]
+
+            delete_idx.sort(reverse=True)
+
+        if convert:
+            sql = convert_query(str(p))
+        else:
+            sql = str(p)
+        rv.append((sql, tuple(delete_idx)))
+    return tuple(rv)
+
+
 class DatabaseFeatures(sqlite3base.DatabaseFeatures):
     pass
 
@@ -142,8 +578,257 @@ class DatabaseOperations(sqlite3base.DatabaseOperations):
 
 class DatabaseWrapper(sqlite3base.DatabaseWrapper):
 
+    def __init__(self, *args, **kwargs):
+        super(DatabaseWrapper, self).__init__(*args, **kwargs)
+        # Queries of the ongoing transaction, replicated as a single batch
+        # once it is committed.
+        self.ha_pending = []
+        self.ha_savepoints = {}
+
     def create_cursor(self):
-        return self.connection.cursor(factory=HASQLiteCursorWrapper)
+        cursor = self.connection.cursor(factory=HASQLiteCursorWrapper)
+        cursor.ha_wrapper = self
+        return cursor
+
+    def ha_replicate(self, queries):
+        if self.in_atomic_block:
+            self.ha_pending.extend(queries)
+        else:
+            replicate(queries)
+
+    def _commit(self):
+        rv = super(DatabaseWrapper, self)._commit()
+        queries, self.ha_pending = self.ha_pending, []
+        self.ha_savepoints = {}
+        if queries:
+            replicate(queries)
+        return rv
+
+    def _rollback(self):
+        self.ha_pending = []
+        self.ha_savepoints = {}
+        return super(DatabaseWrapper, self)._rollback()
+
+    def _savepoint(self, sid):
+        self.ha_savepoints[sid] = len(self.ha_pending)
+        return super(DatabaseWrapper, self)._savepoint(sid)
+
+    def _savepoint_rollback(self, sid):
+        del self.ha_pending[self.ha_savepoints.pop(sid, len(self.ha_pending)):]
+        return super(DatabaseWrapper, self)._savepoint_rollback(sid)
+
+    def _savepoint_commit(self, sid):
+        self.ha_savepoints.pop(sid, None)
+        return super(DatabaseWrapper, self)._savepoint_commit(sid)
+
+    def _ha_meta(self, cur, key, value=None):
+        if value is None:
+            cur.executelocal('SELECT value FROM ha_changelog_meta WHERE key = %s', [key])
+            row = cur.fetchone()
+            return row[0] if row else None
+        cur.executelocal('INSERT OR REPLACE INTO ha_changelog_meta (key, value) VALUES (%s, %s)', [key, value])
+
+    def _ha_tables(self, cur):
+        """
+        Returns tables to sync with the rows identified by an integer id,
+        which can be tracked, and the ones that need to be copied whole.
+        """
+        cur.executelocal("select name from sqlite_master where type = 'table'")
+        tracked = {}
+        untracked = {}
+        for table, in cur.fetchall():
+            if table in NO_SYNC_MAP and not NO_SYNC_MAP[table]:
+                continue
+            cur.executelocal("PRAGMA table_info('%s');" % table)
+            fields = cur.fetchall()
+            fieldnames = [i[1] for i in fields]
+            if any(i[1] == 'id' and i[5] and i[2].lower() == 'integer' for i in fields):
+                tracked[table] = fieldnames
+            else:
+                untracked[table] = fieldnames
+        return tracked, untracked
+
+    def ha_track(self):
+        """
+        Make sure changes to all synced tables are being recorded.
+        """
+        cur = self.cursor()
+        cur.executelocal(
+            'CREATE TABLE IF NOT EXISTS ha_changelog ('
+            'version integer NOT NULL PRIMARY KEY AUTOINCREMENT, '
+            'tbl varchar(120) NOT NULL, row_id integer NOT NULL, '
+            'UNIQUE (tbl, row_id))'
+        )
+        cur.executelocal(
+            'CREATE TABLE IF NOT EXISTS ha_changelog_meta ('
+            'key varchar(120) NOT NULL PRIMARY KEY, value text)'
+        )
+        cur.executelocal("select name from sqlite_master where type = 'trigger'")
+        triggers = set(row[0] for row in cur.fetchall())
+
+        lost = self._ha_meta(cur, 'epoch') is None
+        tracked = self._ha_tables(cur)[0]
+        for table in tracked:
+            rows = {'insert': ['NEW'], 'update': ['OLD', 'NEW'], 'delete': ['OLD']}
+            for op, refs in rows.items():
+                name = 'ha_changelog_%s_%s' % (table, op)
+                if name in triggers:
+                    continue
+                # Table created or rebuilt (migration) without us knowing
+                lost = True
+                cur.executelocal(
+                    'CREATE TRIGGER IF NOT EXISTS "%s" AFTER %s ON "%s" BEGIN %s END' % (
+                        name, op.upper(), table, ' '.join([
+                            "INSERT OR REPLACE INTO ha_changelog (tbl, row_id) VALUES ('%s', %s.id);" % (
+                                table, ref,
+                            ) for ref in refs
+                        ]),
+                    )
+                )
+        if lost:
+            self.ha_reset()
+            return
+
+        # Keep the newest half once the changelog is too large, nodes synced
+        # before that will need the whole database.
+        cur.executelocal('SELECT COUNT(*) FROM ha_changelog')
+        if cur.fetchone()[0] > HA_CHANGELOG_MAX:
+            cur.executelocal(
+                'SELECT version FROM ha_changelog ORDER BY version DESC LIMIT 1 OFFSET %d' % (
+                    HA_CHANGELOG_MAX // 2
+                )
+            )
+            pruned = cur.fetchone()[0]
+            cur.executelocal('DELETE FROM ha_changelog WHERE version <= %s', [pruned])
+            self._ha_meta(cur, 'pruned', str(pruned))
+
+    def ha_reset(self):
+        """
+        Start a new epoch, history of changes is lost.
+        """
+        cur = self.cursor()
+        cur.executelocal('DELETE FROM ha_changelog')
+        self._ha_meta(cur, 'epoch', uuid.uuid4().hex)
+        self._ha_meta(cur, 'pruned', '0')
+
+    def ha_version(self):
+        """
+        Returns the current epoch and version.
+        """
+        cur = self.cursor()
+        cur.executelocal('SELECT MAX(version) FROM ha_changelog')
+        version = cur.fetchone()[0] or 0
+        return self._ha_meta(cur, 'epoch'), version
+
+    def ha_synced(self, epoch=None, version=None):
+        """
+        Get or set the epoch and version of the other node this node was
+        last synced with.
+        """
+        cur = self.cursor()
+        if epoch is not None:
+            self._ha_meta(cur, 'synced_epoch', epoch)
+            self._ha_meta(cur, 'synced_version', str(version))
+        return {
+            'epoch': self._ha_meta(cur, 'synced_epoch'),
+            'version': int(self._ha_meta(cur, 'synced_version') or 0),
+        }
+
+    def ha_can_sync(self, epoch, version):
+        """
+        Whether all changes since `version` of `epoch` are known.
+        """
+        if epoch is None:
+            return False
+        cur = self.cursor()
+        if epoch != self._ha_meta(cur, 'epoch'):
+            return False
+        return version >= int(self._ha_meta(cur, 'pruned') or 0)
+
+    def _ha_rows(self, cur, table, fieldnames, where=None, params=None):
+        cur.executelocal('SELECT %s FROM "%s"%s' % (
+            ', '.join(['quote(`%s`)' % f for f in fieldnames]),
+            table,
+            (' WHERE %s' % where) if where else '',
+        ), params)
+        return cur.fetchall()
+
+    def _ha_statements(self, table, fieldnames, row):
+        columns = ', '.join(['`%s`' % f for f in fieldnames])
+        values = ', '.join(row)
+        no_sync = NO_SYNC_MAP.get(table)
+        if not no_sync:
+            return ['INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (table, columns, values)]
+        # Do not touch the fields of this node
+        values_map = dict(zip(fieldnames, row))
+        return [
+            'INSERT OR IGNORE INTO %s (%s) VALUES (%s)' % (table, columns, values),
+            'UPDATE %s SET %s WHERE id = %s' % (table, ', '.join([
+                '`%s` = %s' % (f, values_map[f]) for f in fieldnames if f not in no_sync['fields']
+            ]), values_map['id']),
+        ]
+
+    def ha_changes(self, since, until, chunk=500):
+        """
+        Iterate over lists of about `chunk` SQL statements bringing a node
+        synced up to version `since` up to version `until`.
+
+        Tables not tracked by id are copied whole.
+        """
+        cur = self.cursor()
+        tracked, untracked = self._ha_tables(cur)
+
+        cur.executelocal(
+            'SELECT tbl, row_id FROM ha_changelog WHERE version > %s AND version <= %s ORDER BY version',
+            [since, until],
+        )
+        changes = cur.fetchall()
+
+        script = []
+        for i in range(0, len(changes), chunk):
+            batch = changes[i:i + chunk]
+            ids = {}
+            for table, row_id in batch:
+                ids.setdefault(table, []).append(row_id)
+            rows = {}
+            for table, table_ids in ids.items():
+                if table not in tracked:
+                    continue
+                fieldnames = tracked[table]
+                idx = fieldnames.index('id')
+                for row in self._ha_rows(
+                    cur, table, fieldnames,
+                    'id IN (%s)' % ', '.join(['%s'] * len(table_ids)), table_ids,
+                ):
+                    rows[(table, int(row[idx]))] = row
+
+            for table, row_id in batch:
+                if table not in tracked:
+                    continue
+                row = rows.get((table, row_id))
+                if row is None:
+                    script.append('DELETE FROM %s WHERE id = %d' % (table, row_id))
+                else:
+                    script.extend(self._ha_statements(table, tracked[table], row))
+
+            if len(script) >= chunk:
+                yield [(sql, None) for sql in script]
+                script = []
+
+        for table, fieldnames in untracked.items():
+            where = None
+            if table == 'sqlite_sequence':
+                # Keep sequences of the tables not synced
+                where = 'name NOT IN (%s)' % ', '.join(["'%s'" % t for t in NO_SYNC_MAP])
+            script.append('DELETE FROM %s%s' % (table, (' WHERE %s' % where) if where else ''))
+            for row in self._ha_rows(cur, table, fieldnames, where):
+                script.extend(self._ha_statements(table, fieldnames, row))
+                if len(script) >= chunk:
+                    yield [(sql, None) for sql in script]
+                    script = []
+
+        if script:
+            yield [(sql, None) for sql in script]
 
     def dump(self):
         """
@@ -239,7 +924,14 @@ class DatabaseWrapper(sqlite3base.DatabaseWrapper):
         ))
 
         with Journal() as j:
-            j.queries = []
+            j.clear()
+
+        # Whatever was recorded here is meaningless now
+        cur.executelocal(
+            "select name from sqlite_master where type = 'table' and name = 'ha_changelog'"
+        )
+        if cur.fetchone():
+            self.ha_reset()
 
         return True
 
@@ -248,132 +940,32 @@ class HASQLiteCursorWrapper(Database.Cursor):
 
     def execute_passive(self, query, params=None):
         """
-        Process the query, modify it if necessary based on NO_SYNC_MAP rules
-        and execute it on the remote side.
+        Queue the query to be run on the remote side.
         """
-        global execute_sync
 
         # Skip SELECT queries
         if query.lower().startswith('select'):
             return
 
-        try:
-            # FIXME: This is extremely time-consuming (failover.status)
-            from freenasUI.middleware.notifier import notifier
-            if not (
-                hasattr(notifier, 'failover_status') and
-                notifier().failover_status() == 'MASTER'
-            ):
-                return
-        except:
+        if not failover_status.is_master():
             return
 
-        parse = sqlparse.parse(query)
-        for p in parse:
-
-            # Only care for DELETE, INSERT and UPDATE queries
-            if p.tokens[0].normalized not in ('DELETE', 'INSERT', 'UPDATE'):
-                continue
-
+        queries = []
+        for sql, delete_idx in replicated_statements(query, params is not None):
             cparams = list(params)
-            if p.tokens[0].normalized == 'INSERT':
-
-                into = p.token_next_by(m=(sqlparse.tokens.Keyword, 'INTO'))
-                if not into:
-                    continue
-
-                next_ = p.token_next(into[0])
-
-                if next_[1].value in NO_SYNC_MAP:
-                    continue
-
-            elif p.tokens[0].normalized == 'DELETE':
-
-                from_ = p.token_next_by(m=(sqlparse.tokens.Keyword, 'FROM'))
-                if not from_:
-                    continue
-
-                next_ = p.token_next(from_[0])
-
-                if next_[1].value in NO_SYNC_MAP:
-                    continue
-
-            elif p.tokens[0].normalized == 'UPDATE':
-
-                name = p.token_next(0)[1].value
-                no_sync = NO_SYNC_MAP.get(name)
-                # Skip if table is in set to not to sync and has no attrs
-                if no_sync is None and name in NO_SYNC_MAP:
-                    continue
-
-                set_ = p.token_next_by(m=(sqlparse.tokens.Keyword, 'SET'))
-                if not set_:
-                    continue
-
-                next_ = p.token_next(set_[0])
-                if not next_:
-                    continue
-
-                if no_sync is None:
-                    lookup = []
-                else:
-
-                    if 'fields' not in no_sync:
-                        continue
-
-                    if issubclass(
-                        next_[1].__class__, sqlparse.sql.IdentifierList
-                    ):
-                        lookup = list(next_[1].get_sublists())
-                    elif issubclass(next_[1].__class__, sqlparse.sql.Comparison):
-                        lookup = [next_[1]]
-
-                    # Get all placeholders from the query (%s or ?)
-                    placeholders = [a for a in p.flatten() if a.value in ('%s', '?')]
-
-                # Remember correspondent cparams to delete
-                delete_idx = []
-
-                for l in lookup:
-
-                    if l.value not in no_sync['fields']:
-                        continue
-
-                    # Remove placeholder from the params
-                    try:
-                        idx = placeholders.index(l.tokens[-1])
-                        if cparams:
-                            delete_idx.append(idx)
-                    except ValueError:
-                        pass
-
-                    # If it is a list we must also remove the comma around it
-                    t_index = l.parent.token_index(l)
-                    prev_ = l.parent.token_prev(t_index)
-                    next_ = l.parent.token_next(t_index)
-                    if next_ and issubclass(
-                        next_[1].__class__, sqlparse.sql.Token
-                    ) and next_[1].value == ',':
-                        del l.parent.tokens[next_[0]]
-                    elif prev_ and issubclass(
-                        prev_[1].__class__, sqlparse.sql.Token
-                    ) and prev_[1].value == ',':
-                        del l.parent.tokens[prev_[0]]
-                    del l.parent.tokens[l.parent.token_index(l)]
-
-                delete_idx.sort(reverse=True)
+            if cparams:
                 for i in delete_idx:
                     del cparams[i]
+            queries.append((sql, cparams))
 
-            if params is not None:
-                sql = self.convert_query(str(p))
-            else:
-                sql = str(p)
-            # Actually try to run the query on the remote side within a thread
-            rsr = RunSQLRemote(sql=sql, params=cparams)
-            rsr.start()
-            if execute_sync:
-                rsr.join()
+        if not queries:
+            return
+
+        wrapper = getattr(self, 'ha_wrapper', None)
+        if wrapper is not None:
+            wrapper.ha_replicate(queries)
+        else:
+            replicate(queries)
 
     def locked_retry(self, method, *args, **kwargs):
         """
@@ -438,6 +1030,4 @@ class HASQLiteCursorWrapper(Database.Cursor):
         return self.locked_retry(Database.Cursor.executemany, query, param_list)
 
     def convert_query(self, query):
-        return sqlite3base.FORMAT_QMARK_REGEX.sub('?', query).replace(
-            '%%', '%'
-        )
+        return convert_query(query)
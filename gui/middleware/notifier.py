@@ -608,6 +608,7 @@ class notifier(metaclass=HookMetaclass):
             except Exception as ee:
                 log.warn(str(ee))
                 failed += 1
+        zfs.pool_state_invalidate()
         return failed
 
     def geli_testkey(self, volume, passphrase=None):
@@ -902,24 +903,6 @@ class notifier(metaclass=HookMetaclass):
                 retval[line] = line
         return retval
 
-    def repl_remote_snapshots(self, repl):
-        """
-        Get a list of snapshots in the remote side
-        """
-        if repl.repl_remote.ssh_remote_dedicateduser_enabled:
-            user = repl.repl_remote.ssh_remote_dedicateduser
-        else:
-            user = 'root'
-        proc = self._pipeopen('/usr/local/bin/ssh -i /data/ssh/replication -o ConnectTimeout=3 -o BatchMode=yes -o StrictHostKeyChecking=yes -p %s "%s"@"%s" "zfs list -Ht snapshot -o name"' % (
-            repl.repl_remote.ssh_remote_port,
-            user,
-            repl.repl_remote.ssh_remote_hostname,
-        ))
-        data = proc.communicate()[0]
-        if proc.returncode != 0:
-            return []
-        return data.strip('\n').split('\n')
-
     def destroy_zfs_dataset(self, path, recursive=False):
         retval = None
         if retval is None:
@@ -939,6 +922,7 @@ class notifier(metaclass=HookMetaclass):
                 from freenasUI.storage.models import Task, Replication
                 Task.objects.filter(task_filesystem=path).delete()
                 Replication.objects.filter(repl_filesystem=path).delete()
+                self.zfs_snapshot_index_reload(path.split('@')[0], recursive or '@' not in path)
         if not retval:
             try:
                 self.__rmdir_mountpoint(path)
@@ -956,6 +940,8 @@ class notifier(metaclass=HookMetaclass):
             str(name),
         ))
         retval = zfsproc.communicate()[1]
+        if zfsproc.returncode == 0:
+            self.zfs_snapshot_index_reload(name, True)
         return retval
 
     def __destroy_zfs_volume(self, volume):
@@ -2806,6 +2792,7 @@ class notifier(metaclass=HookMetaclass):
             # These should probably be options that are configurable from the GUI
             self._system("zfs set aclmode=passthrough '%s'" % name)
             self._system("zfs set aclinherit=passthrough '%s'" % name)
+            zfs.pool_state_invalidate()
             return True
         else:
             log.error("Importing %s [%s] failed with: %s", name, id, stderr)
@@ -2889,6 +2876,7 @@ class notifier(metaclass=HookMetaclass):
 
         self._encvolume_detach(volume)
         self.__rmdir_mountpoint(vol_mountpath)
+        zfs.pool_state_invalidate()
 
     def volume_import(self, volume_name, volume_id, key=None, passphrase=None, enc_disks=None):
         from freenasUI.storage.models import Disk, EncryptedDisk, Scrub, Volume
@@ -3030,84 +3018,69 @@ class notifier(metaclass=HookMetaclass):
             raise MiddlewareError('Unable to scrub %s: %s' % (name, stderr))
         return True
 
-    def zfs_snapshot_list(self, path=None, replications=None, sort=None, system=False):
-        from freenasUI.storage.models import Volume
-        fsinfo = dict()
+    def zfs_snapshot_index_reload(self, dataset, recursive=False):
+        """
+        Let the middleware snapshot index know snapshots of `dataset`
+        have been taken or destroyed.
+        """
+        try:
+            with client as c:
+                c.call('zfs.snapshot.reload', dataset, recursive)
+        except ClientException:
+            log.warn('Failed to reload snapshot index for %s', dataset, exc_info=True)
 
-        if sort is None:
-            sort = ''
-        else:
-            sort = '-s %s' % sort
+    def zfs_snapshot_query(self, filters=None, options=None, replication=False, system=False):
+        """
+        Query snapshots from the middleware snapshot index.
 
+        If `replication` is set snapshots already sent to the remote side
+        of a replication task are flagged.
+
+        Returns a list of zfs.Snapshot
+        """
+        filters = list(filters or [])
         if system is False:
-            systemdataset, basename = self.system_dataset_settings()
+            filters.append(('system', '=', False))
 
-        if replications is None:
-            replications = {}
+        with client as c:
+            snapshots = c.call('zfs.snapshot.query', filters, options or {})
+            if (options or {}).get('count'):
+                return snapshots
+            if replication:
+                replicated = set(c.call('replication.snapshots_replicated', [i['name'] for i in snapshots]))
+            else:
+                replicated = set()
 
-        zfsproc = self._pipeopen("/sbin/zfs list -t volume -o name %s -H" % sort)
-        zvols = set([y for y in zfsproc.communicate()[0].split('\n') if y != ''])
-        volnames = set([o.vol_name for o in Volume.objects.all()])
+        return [
+            zfs.Snapshot(
+                name=snap['snapshot_name'],
+                filesystem=snap['dataset'],
+                used=snap['used'],
+                refer=snap['referenced'],
+                mostrecent=snap['mostrecent'],
+                parent_type='volume' if snap['type'] == 'VOLUME' else 'filesystem',
+                replication='OK' if snap['name'] in replicated else None,
+                vmsynced=snap['vmsynced'],
+            )
+            for snap in snapshots
+        ]
 
-        fieldsflag = '-o name,used,available,referenced,mountpoint,freenas:vmsynced'
+    def zfs_snapshot_list(self, path=None, replication=False, sort=None, system=False):
+        fsinfo = OrderedDict()
+
+        filters = []
         if path:
-            zfsproc = self._pipeopen("/sbin/zfs list -p -r -t snapshot %s -H -S creation '%s'" % (fieldsflag, path))
-        else:
-            zfsproc = self._pipeopen("/sbin/zfs list -p -t snapshot -H -S creation %s" % (fieldsflag))
-        lines = zfsproc.communicate()[0].split('\n')
-        for line in lines:
-            if line != '':
-                _list = line.split('\t')
-                snapname = _list[0]
-                used = int(_list[1])
-                refer = int(_list[3])
-                vmsynced = _list[5]
-                fs, name = snapname.split('@')
+            if '@' in path:
+                filters.append(('name', '=', path))
+            else:
+                filters.append(('dataset', '=', path))
 
-                if system is False and basename:
-                    if fs == basename or fs.startswith(basename + '/'):
-                        continue
+        options = {}
+        if sort:
+            options['order_by'] = [sort]
 
-                # Do not list snapshots from the root pool
-                if fs.split('/')[0] not in volnames:
-                    continue
-                try:
-                    snaplist = fsinfo[fs]
-                    mostrecent = False
-                except:
-                    snaplist = []
-                    mostrecent = True
-                replication = None
-                for repl in replications:
-                    if not (
-                        fs == repl.repl_filesystem or (
-                            repl.repl_userepl and fs.startswith(repl.repl_filesystem + '/')
-                        )
-                    ):
-                        continue
-                    snaps = replications[repl]
-                    # Make sure remote snapshot is checked correctly
-                    # when destination is root dataset
-                    if '/' not in repl.repl_zfs:
-                        replace = '{}/{}'.format(repl.repl_zfs, repl.repl_filesystem.rsplit('/')[-1])
-                    else:
-                        replace = repl.repl_zfs
-                    remotename = '%s@%s' % (fs.replace(repl.repl_filesystem, replace), name)
-                    if remotename in snaps:
-                        replication = 'OK'
-                        # TODO: Multiple replication tasks
-
-                snaplist.insert(0, zfs.Snapshot(
-                    name=name,
-                    filesystem=fs,
-                    used=used,
-                    refer=refer,
-                    mostrecent=mostrecent,
-                    parent_type='filesystem' if fs not in zvols else 'volume',
-                    replication=replication,
-                    vmsynced=(vmsynced == 'Y')
-                ))
-                fsinfo[fs] = snaplist
+        for snap in self.zfs_snapshot_query(filters, options, replication=replication, system=system):
+            fsinfo.setdefault(snap.filesystem, []).append(snap)
         return fsinfo
 
     def zfs_mksnap(self, dataset, name, recursive=False, vmsnaps_count=0):
@@ -3122,6 +3095,7 @@ class notifier(metaclass=HookMetaclass):
         if p1.wait() != 0:
             err = p1.communicate()[1]
             raise MiddlewareError("Snapshot could not be taken: %s" % err)
+        self.zfs_snapshot_index_reload(dataset, recursive)
         return True
 
     def zfs_clonesnap(self, snapshot, dataset):
@@ -3135,6 +3109,9 @@ class notifier(metaclass=HookMetaclass):
             snapshot,
         ))
         retval = zfsproc.communicate()[1]
+        if force:
+            # Rollback destroys every snapshot more recent than `snapshot`
+            self.zfs_snapshot_index_reload(snapshot.split('@')[0])
         return retval
 
     def config_restore(self):
@@ -3642,11 +3619,12 @@ class notifier(metaclass=HookMetaclass):
             search = doc.xpath("//class[name = 'DISK']/geom/provider/config[normalize-space(ident) = normalize-space('%s')]/../../name" % value)
             if len(search) > 0:
                 return search[0].text
+            disks = self.__get_disks()
             with client as c:
-                for devname in self.__get_disks():
-                    serial = c.call('disk.serial_from_device', devname)
-                    if serial == value:
-                        return devname
+                records = c.call('smart.probe', disks)
+            for devname in disks:
+                if records.get(devname) and records[devname]['serial'] == value:
+                    return devname
             return None
 
         elif tp == 'serial_lunid':
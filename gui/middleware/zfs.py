@@ -28,10 +28,13 @@ import libzfs
 import logging
 import re
 import subprocess
+import time
 
 from collections import defaultdict, OrderedDict
 from django.utils.translation import ugettext_lazy as _
 
+from freenasUI.middleware.client import client
+
 log = logging.getLogger('middleware.zfs')
 
 ZPOOL_NAME_RE = r'[a-z][a-z0-9_\-\.]*'
@@ -997,6 +1000,39 @@ def list_datasets(path="", recursive=False, hierarchical=False,
     )
 
 
+# Seconds the pool state is shared by Volume objects
+POOL_STATE_TTL = 2
+_pool_state = {
+    'state': None,
+    'expire': 0,
+}
+
+
+def pool_state():
+    """
+    State of all pools and GELI providers (see pool.state in middlewared),
+    shared for a couple of seconds so listing all volumes costs a single
+    call.
+    """
+    if _pool_state['state'] is None or time.monotonic() > _pool_state['expire']:
+        with client as c:
+            _pool_state['state'] = c.call('pool.state')
+        _pool_state['expire'] = time.monotonic() + POOL_STATE_TTL
+    return _pool_state['state']
+
+
+def pool_state_invalidate():
+    """
+    Pools or GELI providers changed, do not wait for the events.
+    """
+    _pool_state['state'] = None
+    try:
+        with client as c:
+            c.call('pool.state_invalidate')
+    except Exception as e:
+        log.debug('Failed to invalidate pool state: %s', e)
+
+
 def zpool_list(name=None):
     zfsproc = subprocess.Popen([
         'zpool',
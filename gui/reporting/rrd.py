@@ -27,18 +27,70 @@ import glob
 import logging
 import os
 import re
-import tempfile
 import subprocess
+import threading
+import time
+
+from collections import OrderedDict
 
 from freenasUI.common.pipesubr import pipeopen
 from freenasUI.middleware.client import client
-from middlewared.utils import cache_with_autorefresh, filter_list
+from middlewared.utils import cache_with_autorefresh, filter_list, FilterIndex
 
 
 log = logging.getLogger('reporting.rrd')
 
 name2plugin = dict()
 
+# Graphs are rendered at most once per window, collectd writes every 10 seconds
+GRAPH_WINDOW = 10
+GRAPH_CACHE_SIZE = 64
+
+
+class GraphCache(object):
+    """
+    Rendered graphs shared by every viewer within the same time window.
+
+    A graph requested while another thread is rendering it waits for that
+    render instead of spawning rrdtool again.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.graphs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, render):
+        with self.lock:
+            entry = self.graphs.get(key)
+            if entry is None:
+                entry = self.graphs[key] = {'event': threading.Event(), 'data': None}
+                owner = True
+                while len(self.graphs) > self.size:
+                    self.graphs.popitem(last=False)
+            else:
+                self.graphs.move_to_end(key)
+                owner = False
+
+        if owner:
+            try:
+                entry['data'] = render()
+            finally:
+                if entry['data'] is None:
+                    # Do not cache failures
+                    with self.lock:
+                        if self.graphs.get(key) is entry:
+                            self.graphs.pop(key)
+                entry['event'].set()
+        else:
+            entry['event'].wait()
+            if entry['data'] is None:
+                return render()
+        return entry['data']
+
+
+graph_cache = GraphCache(GRAPH_CACHE_SIZE)
+
 
 class RRDMeta(type):
 
@@ -123,11 +175,18 @@ class RRDBase(object, metaclass=RRDMeta):
 
     def generate(self):
         """
-        Call rrdgraph to generate the graph on a temp file
+        Call rrdgraph to generate the graph, cached for GRAPH_WINDOW seconds
 
         Returns:
-            str - path to the image
+            bytes - the image
         """
+        key = (
+            self.plugin, self.identifier, self.unit, self.step, self._base_path,
+            int(time.time() // GRAPH_WINDOW),
+        )
+        return graph_cache.get(key, self.render)
+
+    def render(self):
 
         starttime = '1%s' % (self.unit[0], )
         if self.step == 0:
@@ -135,11 +194,10 @@ class RRDBase(object, metaclass=RRDMeta):
         else:
             endtime = 'now-%d%s' % (self.step, self.unit[0], )
 
-        fh, path = tempfile.mkstemp()
         args = [
             "/usr/local/bin/rrdtool",
             "graph",
-            path,
+            '-',
             '--imgformat', self.imgformat,
             '--vertical-label', str(self.get_vertical_label()),
             '--title', str(self.get_title()),
@@ -157,10 +215,11 @@ class RRDBase(object, metaclass=RRDMeta):
             stdin=subprocess.PIPE,
             stderr=subprocess.PIPE,
         )
-        err = proc.communicate()[1]
+        data, err = proc.communicate()
         if proc.returncode != 0:
             log.error("Failed to generate graph: %s", err)
-        return fh, path
+            return None
+        return data
 
 
 class CPUPlugin(RRDBase):
@@ -777,7 +836,8 @@ class CTLPlugin(RRDBase):
 @cache_with_autorefresh(0, 5)
 def get_disks():
     with client as c:
-        return c.call('disk.query')
+        # Looked up by name for every disk graph
+        return FilterIndex(c.call('disk.query'))
 
 
 class DiskBase():
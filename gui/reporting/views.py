@@ -24,7 +24,6 @@
 #
 #####################################################################
 import logging
-import os
 
 from django.http import HttpResponse
 from django.shortcuts import render
@@ -106,15 +105,7 @@ def generate(request):
             step=step,
             identifier=identifier
         )
-        fd, path = plugin.generate()
-        with open(path, 'rb') as f:
-            data = f.read()
-
-        try:
-            os.unlink(path)
-            os.close(fd)
-        except OSError as e:
-            log.warn("Failed to remove reporting temp file: %s", e)
+        data = plugin.generate() or b''
 
         response = HttpResponse(data)
         response['Content-type'] = 'image/png'
@@ -2273,6 +2273,16 @@ class ReplicationForm(ModelForm):
         initial='standard',
         choices=choices.REPL_CIPHER,
     )
+    repl_remote_parallel = forms.IntegerField(
+        label=_("Parallel streams"),
+        initial=2,
+        min_value=1,
+        required=False,
+        help_text=_(
+            "Maximum number of datasets being sent to the remote host at "
+            "the same time."
+        ),
+    )
     repl_remote_hostkey = forms.CharField(
         label=_("Remote hostkey"),
         widget=forms.Textarea(),
@@ -2343,6 +2353,8 @@ class ReplicationForm(ModelForm):
                 repl.repl_remote.ssh_remote_dedicateduser)
             self.fields['repl_remote_cipher'].initial = (
                 repl.repl_remote.ssh_cipher)
+            self.fields['repl_remote_parallel'].initial = (
+                repl.repl_remote.ssh_remote_parallel)
             self.fields['repl_remote_hostkey'].initial = (
                 repl.repl_remote.ssh_remote_hostkey)
             self.fields['repl_remote_hostkey'].required = False
@@ -2366,6 +2378,12 @@ class ReplicationForm(ModelForm):
             return 22
         return port
 
+    def clean_repl_remote_parallel(self):
+        parallel = self.cleaned_data.get('repl_remote_parallel')
+        if not parallel:
+            return 2
+        return parallel
+
     def clean_repl_remote_dedicateduser(self):
         en = self.cleaned_data.get("repl_remote_dedicateduser_enabled")
         user = self.cleaned_data.get("repl_remote_dedicateduser")
@@ -2424,6 +2442,7 @@ class ReplicationForm(ModelForm):
         r.ssh_remote_dedicateduser = self.cleaned_data.get(
             "repl_remote_dedicateduser")
         r.ssh_cipher = self.cleaned_data.get("repl_remote_cipher")
+        r.ssh_remote_parallel = self.cleaned_data.get("repl_remote_parallel")
 
         if mode == 'SEMIAUTOMATIC':
             try:
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0005_resilver'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replremote',
+            name='ssh_remote_parallel',
+            field=models.IntegerField(default=2, help_text='Maximum number of datasets being sent to the remote host at the same time.', verbose_name='Parallel streams'),
+        ),
+    ]
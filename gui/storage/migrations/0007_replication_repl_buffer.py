@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0006_replremote_ssh_remote_parallel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replication',
+            name='repl_buffer',
+            field=models.IntegerField(default=64, help_text='Amount of the stream buffered while the remote system is slower than the local one.', verbose_name='Buffer (MiB)'),
+        ),
+    ]
@@ -30,7 +30,6 @@ import logging
 import os
 import re
 import uuid
-import subprocess
 
 from django.db import models
 from django.db.models import Q
@@ -38,6 +37,8 @@ from django.utils.translation import ugettext as __, ugettext_lazy as _
 
 from freenasUI import choices
 from freenasUI.middleware import zfs
+from freenasUI.middleware.zfs import pool_state, pool_state_invalidate
+from freenasUI.middleware.client import client
 from freenasUI.middleware.notifier import notifier
 from freenasUI.freeadmin.models import Model, UserField
 
@@ -71,27 +72,21 @@ class Volume(Model):
     def is_upgraded(self):
         if not self.is_decrypted():
             return True
-        try:
-            version = notifier().zpool_version(str(self.vol_name))
-        except ValueError:
-            return True
-        if version == '-':
-            proc = subprocess.Popen([
-                "zpool",
-                "get",
-                "-H", "-o", "property,value",
-                "all",
-                str(self.vol_name),
-            ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8')
-            data = proc.communicate()[0].strip('\n')
-            for line in data.split('\n'):
-                if not line.startswith('feature') or '\t' not in line:
-                    continue
-                prop, value = line.split('\t', 1)
-                if value not in ('active', 'enabled'):
-                    return False
+        state = self._pool
+        if state is None:
             return True
-        return False
+        return state['upgraded']
+
+    @property
+    def _pool(self):
+        """
+        State of the pool, None if not imported.
+        """
+        try:
+            return pool_state()['pools'].get(self.vol_name)
+        except Exception as e:
+            log.debug('Failed to get pool state: %s', e)
+            return None
 
     @property
     def vol_path(self):
@@ -144,7 +139,8 @@ class Volume(Model):
         try:
             # Make sure do not compute it twice
             if not hasattr(self, '_status'):
-                status = notifier().get_volume_status(self.vol_name)
+                state = self._pool
+                status = state['status'] if state else 'UNKNOWN'
                 if status == 'UNKNOWN' and self.vol_encrypt > 0:
                     return _("LOCKED")
                 else:
@@ -166,22 +162,24 @@ class Volume(Model):
         return "%s/%s.key" % (GELI_KEYPATH, self.vol_encryptkey, )
 
     def is_decrypted(self):
-        __is_decrypted = getattr(self, '__is_decrypted', None)
-        if __is_decrypted is not None:
-            return __is_decrypted
-
-        self.__is_decrypted = True
-        # If the status is not UNKNOWN means the pool is already imported
-        status = notifier().get_volume_status(self.vol_name)
-        if status != 'UNKNOWN':
-            return self.__is_decrypted
+        if getattr(self, '_is_decrypted', None) is not None:
+            return self._is_decrypted
+
+        self._is_decrypted = True
+        # If the pool is there it is already imported
+        if self._pool is not None:
+            return self._is_decrypted
         if self.vol_encrypt > 0:
-            _notifier = notifier()
+            try:
+                geli = set(pool_state()['geli'])
+            except Exception as e:
+                log.debug('Failed to get pool state: %s', e)
+                geli = set()
             for ed in self.encrypteddisk_set.all():
-                if not _notifier.geli_is_decrypted(ed.encrypted_provider):
-                    self.__is_decrypted = False
+                if ed.encrypted_provider not in geli:
+                    self._is_decrypted = False
                     break
-        return self.__is_decrypted
+        return self._is_decrypted
 
     def has_attachments(self):
         """
@@ -387,6 +385,7 @@ class Volume(Model):
         # The framework would cascade delete all database items
         # referencing this volume.
         super(Volume, self).delete()
+        pool_state_invalidate()
 
         # If there's a system dataset on this pool, stop using it.
         if systemdataset:
@@ -422,20 +421,18 @@ class Volume(Model):
         if not self.vol_encryptkey and self.vol_encrypt > 0:
             self.vol_encryptkey = str(uuid.uuid4())
         super(Volume, self).save(*args, **kwargs)
+        pool_state_invalidate()
 
     def __str__(self):
         return self.vol_name
 
     def _get__zplist(self):
-        if not hasattr(self, '__zplist'):
-            try:
-                self.__zplist = zfs.zpool_list().get(self.vol_name)
-            except SystemError:
-                self.__zplist = None
-        return self.__zplist
+        if not hasattr(self, '_zplist_cache'):
+            self._zplist_cache = self._pool
+        return self._zplist_cache
 
     def _set__zplist(self, value):
-        self.__zplist = value
+        self._zplist_cache = value
 
     def _get_avail(self):
         try:
@@ -798,6 +795,14 @@ class ReplRemote(Model):
         choices=choices.REPL_CIPHER,
         default='standard',
     )
+    ssh_remote_parallel = models.IntegerField(
+        default=2,
+        verbose_name=_("Parallel streams"),
+        help_text=_(
+            "Maximum number of datasets being sent to the remote host at "
+            "the same time."
+        ),
+    )
 
     class Meta:
         verbose_name = _("Remote Replication Host")
@@ -858,6 +863,13 @@ class Replication(Model):
             "Limit the replication speed. Unit in "
             "kilobytes/seconds. 0 = unlimited."),
     )
+    repl_buffer = models.IntegerField(
+        default=64,
+        verbose_name=_("Buffer (MiB)"),
+        help_text=_(
+            "Amount of the stream buffered while the remote system is "
+            "slower than the local one."),
+    )
     repl_begin = models.TimeField(
         default=time(hour=0),
         verbose_name=_("Begin"),
@@ -907,12 +919,24 @@ class Replication(Model):
                 pid = int(f.read())
             title = notifier().get_proc_title(pid)
             if title:
+                resume = (self.repl_lastresult or {}).get('resume')
                 reg = re.search(r'sending (\S+) \((\d+)%', title)
-                if reg:
+                if reg and resume:
+                    return _(
+                        'Resuming %(snapshot)s (%(percent)s%%, %(bytes)s '
+                        'bytes received before interruption)'
+                    ) % {
+                        'snapshot': reg.groups()[0],
+                        'percent': reg.groups()[1],
+                        'bytes': resume['bytes'],
+                    }
+                elif reg:
                     return _('Sending %(snapshot)s (%(percent)s%%)') % {
                         'snapshot': reg.groups()[0],
                         'percent': reg.groups()[1],
                     }
+                elif resume:
+                    return _('Resuming')
                 else:
                     return _('Sending')
         if self.repl_lastresult:
@@ -1024,6 +1048,11 @@ class Task(Model):
             notifier().restart("cron")
         except:
             pass
+        try:
+            with client as c:
+                c.call('autosnap.reload')
+        except Exception:
+            log.warn('Failed to reload periodic snapshot tasks', exc_info=True)
 
     def delete(self, *args, **kwargs):
         super(Task, self).delete(*args, **kwargs)
@@ -1031,6 +1060,11 @@ class Task(Model):
             notifier().restart("cron")
         except:
             pass
+        try:
+            with client as c:
+                c.call('autosnap.reload')
+        except Exception:
+            log.warn('Failed to reload periodic snapshot tasks', exc_info=True)
 
     class Meta:
         verbose_name = _("Periodic Snapshot Task")
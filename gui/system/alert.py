@@ -4,10 +4,14 @@ import hashlib
 import imp
 import logging
 import os
+import re
 import socket
 import subprocess
+import threading
 import time
+from concurrent.futures import Future
 
+from django.db import connection
 from django.utils.translation import ugettext_lazy as _
 
 from freenasUI.common.locks import lock
@@ -45,16 +49,125 @@ class BaseAlertMetaclass(type):
         return klass
 
 
+class AlertProbes(object):
+    """
+    System state shared by alert modules within a single run.
+
+    Every probe is computed once per run no matter how many modules, running
+    concurrently, ask for it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = {}
+
+    def _get(self, key, method, *args):
+        with self._lock:
+            future = self._cache.get(key)
+            owner = future is None
+            if owner:
+                future = self._cache[key] = Future()
+        if owner:
+            try:
+                future.set_result(method(*args))
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    def _run(self, *args):
+        proc = subprocess.Popen(
+            args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8',
+        )
+        output = proc.communicate()[0]
+        return proc.returncode, output
+
+    def is_freenas(self):
+        return self._get('is_freenas', lambda: notifier().is_freenas())
+
+    def failover_status(self):
+        """
+        Failover status or None if not available.
+        """
+        def probe():
+            if not hasattr(notifier, 'failover_status'):
+                return None
+            return notifier().failover_status()
+        return self._get('failover_status', probe)
+
+    def zpool_list(self):
+        """
+        Returns a dict of imported pools with their capacity and health.
+        """
+        def probe():
+            returncode, output = self._run('/sbin/zpool', 'list', '-H', '-o', 'name,cap,health')
+            pools = {}
+            for line in output.splitlines():
+                name, cap, health = line.split('\t')
+                try:
+                    cap = int(cap.replace('%', ''))
+                except ValueError:
+                    cap = None
+                pools[name] = {'cap': cap, 'health': health}
+            return pools
+        return self._get('zpool_list', probe)
+
+    def _zpool_status_all(self):
+        # Only pools with problems are listed
+        returncode, output = self._run('/sbin/zpool', 'status', '-x')
+        sections = re.split(r'^\s*pool: (\S+)\s*$', output, flags=re.M)
+        pools = {}
+        for name, zpool_result in zip(sections[1::2], sections[2::2]):
+            state = 'UNKNOWN'
+            status = ''
+            reg1 = re.search(r'^\s*state: (\w+)', zpool_result, re.M)
+            if reg1:
+                state = reg1.group(1)
+            reg1 = re.search(r'^\s*status: (.+)\n\s*action+:', zpool_result, re.S | re.M)
+            if reg1:
+                status = re.sub(r'\s+', ' ', reg1.group(1))
+            pools[name] = (state, status)
+        return pools
+
+    def zpool_status(self, pool):
+        """
+        Same as notifier.zpool_status, for all pools at once.
+        """
+        pools = self._get('zpool_status', self._zpool_status_all)
+        if pool in pools:
+            return pools[pool]
+        if pool in self.zpool_list():
+            return 'HEALTHY', ''
+        return 'UNKNOWN', ''
+
+    def multipath_all(self):
+        return self._get('multipath_all', lambda: notifier().multipath_all())
+
+    def service_status(self, name):
+        """
+        Returns returncode and output of `service <name> status`.
+        """
+        return self._get(('service_status', name), self._run, '/usr/sbin/service', name, 'status')
+
+    def vm_guest(self):
+        return self._get('vm_guest', lambda: self._run('/sbin/sysctl', '-n', 'kern.vm_guest')[1].strip())
+
+
 class BaseAlert(object, metaclass=BaseAlertMetaclass):
 
     alert = None
     interval = 0
     fire_once = False
     name = None
+    # Seconds to wait for the module before using its last result
+    timeout = 60
 
     def __init__(self, alert):
         self.alert = alert
 
+    @property
+    def probes(self):
+        return self.alert.probes
+
     def run(self):
         """
         Returns a list of Alert objects
@@ -147,6 +260,8 @@ class AlertPlugins(metaclass=HookMetaclass):
         )
         self.modspath = os.path.join(self.basepath, 'alertmods/')
         self.mods = []
+        self.probes = AlertProbes()
+        self.__running = {}
 
     def rescan(self):
         self.mods = []
@@ -169,6 +284,48 @@ class AlertPlugins(metaclass=HookMetaclass):
         instance = klass(self)
         self.mods.append(instance)
 
+    def __run_module(self, instance, result):
+        try:
+            result['rv'] = instance.run()
+        except Exception as e:
+            log.debug("Alert module '%s' failed: %s", instance, e, exc_info=True)
+            log.error("Alert module '%s' failed: %s", instance, e)
+            result['error'] = e
+        finally:
+            connection.close()
+
+    def run_modules(self, instances):
+        """
+        Run the modules concurrently, waiting at most their timeout.
+
+        Returns a dict of module name and result of the modules done, modules
+        still running from a previous run are not started again.
+        """
+        started = time.monotonic()
+        running = []
+        for instance in instances:
+            thread = self.__running.get(instance.name)
+            if thread is not None and thread.is_alive():
+                continue
+            result = {}
+            thread = threading.Thread(
+                target=self.__run_module,
+                args=(instance, result),
+                name='alert-%s' % instance.name,
+                daemon=True,
+            )
+            self.__running[instance.name] = thread
+            thread.start()
+            running.append((instance, thread, result))
+
+        results = {}
+        for instance, thread, result in running:
+            thread.join(max(started + instance.timeout - time.monotonic(), 0))
+            if thread.is_alive():
+                continue
+            results[instance.name] = result
+        return results
+
     def email(self, alerts):
         node = alert_node()
         dismisseds = [a.message_id for a in mAlert.objects.filter(node=node)]
@@ -285,44 +442,54 @@ class AlertPlugins(metaclass=HookMetaclass):
         node = alert_node()
         dismisseds = [a.message_id for a in mAlert.objects.filter(node=node)]
         ids = []
+        due = []
         for instance in self.mods:
-            try:
-                if instance.name in results:
-                    if instance.fire_once:
-                        continue
-                    if results.get(instance.name).get(
-                        'lastrun'
-                    ) > time.time() - (instance.interval * 60):
-                        if results.get(instance.name).get('alerts'):
-                            for alert in results.get(instance.name).get('alerts'):
-                                ids.append(alert.getId())
-                                rvs.append(alert)
-                        continue
-                rv = instance.run()
-                if rv:
-                    alerts = [_f for _f in rv if _f]
-                    for alert in alerts:
+            if instance.name in results:
+                if instance.fire_once:
+                    continue
+                if results.get(instance.name).get(
+                    'lastrun'
+                ) > time.time() - (instance.interval * 60):
+                    if results.get(instance.name).get('alerts'):
+                        for alert in results.get(instance.name).get('alerts'):
+                            ids.append(alert.getId())
+                            rvs.append(alert)
+                    continue
+            due.append(instance)
+
+        self.probes = AlertProbes()
+        done = self.run_modules(due)
+        for instance in due:
+            if instance.name not in done:
+                log.warn("Alert module '%s' timed out, using its last result", instance)
+                if results.get(instance.name, {}).get('alerts'):
+                    for alert in results.get(instance.name).get('alerts'):
                         ids.append(alert.getId())
-                        if instance.name in results:
-                            found = False
-                            for i in (results[instance.name]['alerts'] or []):
-                                if alert == i:
-                                    found = i
-                                    break
-                            if found is not False:
-                                alert.setTimestamp(found.getTimestamp())
-
-                        if alert.getId() in dismisseds:
-                            alert.setDismiss(True)
-                    rvs.extend(alerts)
-                results[instance.name] = {
-                    'lastrun': int(time.time()),
-                    'alerts': rv,
-                }
-
-            except Exception as e:
-                log.debug("Alert module '%s' failed: %s", instance, e, exc_info=True)
-                log.error("Alert module '%s' failed: %s", instance, e)
+                        rvs.append(alert)
+                continue
+            if 'error' in done[instance.name]:
+                continue
+            rv = done[instance.name]['rv']
+            if rv:
+                alerts = [_f for _f in rv if _f]
+                for alert in alerts:
+                    ids.append(alert.getId())
+                    if instance.name in results:
+                        found = False
+                        for i in (results[instance.name]['alerts'] or []):
+                            if alert == i:
+                                found = i
+                                break
+                        if found is not False:
+                            alert.setTimestamp(found.getTimestamp())
+
+                    if alert.getId() in dismisseds:
+                        alert.setDismiss(True)
+                rvs.extend(alerts)
+            results[instance.name] = {
+                'lastrun': int(time.time()),
+                'alerts': rv,
+            }
 
         qs = mAlert.objects.exclude(message_id__in=ids, node=node)
         if qs.exists():
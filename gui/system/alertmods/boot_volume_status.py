@@ -1,6 +1,5 @@
 from django.utils.translation import ugettext as _
 from freenasUI.system.alert import alertPlugins, Alert, BaseAlert
-from freenasUI.middleware.notifier import notifier
 
 
 class BootVolumeStatusAlert(BaseAlert):
@@ -19,7 +18,7 @@ class BootVolumeStatusAlert(BaseAlert):
 
     def run(self):
         alerts = []
-        state, status = notifier().zpool_status('freenas-boot')
+        state, status = self.probes.zpool_status('freenas-boot')
         if state == 'HEALTHY':
             pass
         else:
@@ -1,6 +1,5 @@
 from django.utils.translation import ugettext as _
 
-from freenasUI.middleware.notifier import notifier
 from freenasUI.system.alert import alertPlugins, Alert, BaseAlert
 
 
@@ -8,7 +7,7 @@ class MultipathAlert(BaseAlert):
 
     def run(self):
         not_optimal = []
-        for mp in notifier().multipath_all():
+        for mp in self.probes.multipath_all():
             if mp.status != 'OPTIMAL':
                 not_optimal.append(mp.name)
 
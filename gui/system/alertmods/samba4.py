@@ -10,10 +10,7 @@ class Samba4Alert(BaseAlert):
     def run(self):
         if not Volume.objects.all().exists():
             return None
-        if (
-            hasattr(notifier, 'failover_status') and
-            notifier().failover_status() == 'BACKUP'
-        ):
+        if self.probes.failover_status() == 'BACKUP':
             return None
         systemdataset, basename = notifier().system_dataset_settings()
         if not systemdataset.sys_pool:
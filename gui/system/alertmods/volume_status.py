@@ -19,8 +19,8 @@ class VolumeStatusAlert(BaseAlert):
         }, hardware=True)
 
     def volumes_status_enabled(self):
-        if not notifier().is_freenas():
-            status = notifier().failover_status()
+        if not self.probes.is_freenas():
+            status = self.probes.failover_status()
             return status in ('MASTER', 'SINGLE')
         return True
 
@@ -31,9 +31,9 @@ class VolumeStatusAlert(BaseAlert):
         for vol in Volume.objects.all():
             if not vol.is_decrypted():
                 continue
-            state, status = notifier().zpool_status(vol.vol_name)
+            state, status = self.probes.zpool_status(vol.vol_name)
             if state != 'HEALTHY':
-                if not notifier().is_freenas():
+                if not self.probes.is_freenas():
                     try:
                         notifier().zpool_enclosure_sync(vol.vol_name)
                     except:
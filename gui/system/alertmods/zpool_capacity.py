@@ -1,5 +1,4 @@
 import logging
-import subprocess
 
 from django.utils.translation import ugettext as _
 
@@ -19,20 +18,12 @@ class ZpoolCapAlert(BaseAlert):
             vol.vol_name
             for vol in Volume.objects.all()
         ] + ['freenas-boot']
+        imported = self.probes.zpool_list()
         for pool in pools:
-            proc = subprocess.Popen([
-                "/sbin/zpool",
-                "list",
-                "-H",
-                "-o", "cap",
-                pool.encode('utf8'),
-            ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8')
-            data = proc.communicate()[0]
-            if proc.returncode != 0:
+            if pool not in imported:
                 continue
-            try:
-                cap = int(data.strip('\n').replace('%', ''))
-            except ValueError:
+            cap = imported[pool]['cap']
+            if cap is None:
                 continue
 
             msg = _(
@@ -25,6 +25,7 @@
 #
 
 import os
+import re
 import sys
 
 sys.path.extend([
@@ -84,7 +85,30 @@ def _cachelen(cache):
     return cachelen
 
 
+def __cache_remove_bsddb(cachedir):
+    """Remove the files the old bsddb3 cache left behind: the .cache.db
+       databases and the __db.* and log.* files of their environments."""
+    if not os.path.exists(cachedir):
+        return
+
+    for root, dirs, files in os.walk(cachedir):
+        if '.cache.db' not in files and \
+                not any(f.startswith('__db.') for f in files):
+            continue
+
+        for f in files:
+            if f == '.cache.db' or f.startswith('__db.') or \
+                    re.match(r'^log\.\d{10}$', f):
+                try:
+                    os.unlink(os.path.join(root, f))
+                except OSError:
+                    pass
+
+
 def cache_fill(**kwargs):
+    if 'cachedir' in kwargs and kwargs['cachedir']:
+        __cache_remove_bsddb(kwargs['cachedir'])
+
     uargs = {'flags': FLAGS_DBINIT | FLAGS_CACHE_WRITE_USER}
     gargs = {'flags': FLAGS_DBINIT | FLAGS_CACHE_WRITE_GROUP}
 
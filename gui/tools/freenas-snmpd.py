@@ -5,7 +5,6 @@ import sys
 import errno
 import signal
 import time
-import subprocess
 import daemon
 import threading
 import fcntl
@@ -13,6 +12,8 @@ import socket
 import asyncore
 import json
 import libzfs
+import sysctl
+from collections import deque
 from setproctitle import setproctitle
 from syslog import (
     syslog,
@@ -24,17 +25,23 @@ PIDFILE = '/var/run/freenas-snmpd.pid'
 SOCKFILE = '/var/run/freenas-snmpd.sock'
 QUIT_FLAG = threading.Event()  # Termination Event
 
+# Seconds to keep sampling after the last request
+IDLE_TIMEOUT = 300
+# ZIL windows served, in seconds
+ZIL_INTERVALS = (1, 5, 10)
+
 # Global Dicts
-# The following contain zilstat results from the last
-# zilstat command (1, 5 and 10 second intervals)
+# The following contain zil statistics for the last
+# 1, 5 and 10 seconds
 zilstat_one = {}
 zilstat_five = {}
 zilstat_ten = {}
 # This is for zpool iostat (total and 1 sec results)
 zpoolio_all = {}
 zpoolio_one = {}
-# This is for properly teminating all subprocess when freenas-snmpd is killed
-proc_pid_list = []
+# Last time a client asked for data and event to resume sampling
+last_request = 0
+requested = threading.Event()
 
 # global data lock
 lock = threading.Lock()
@@ -61,16 +68,9 @@ def unprettyprint(ster):
 # Our custom terminate signal handler
 # is called when the daemon recieves signal.SIGTERM
 def cust_terminate(signal_number, stack_frame):
-    global proc_pid_list
     QUIT_FLAG.set()
+    requested.set()
     time.sleep(0.01)
-    # Try to terminate all subprocesses on exit
-    for pd in proc_pid_list:
-        try:
-            os.killpg(pd, signal.SIGTERM)
-        except:
-            # Maybe this process has already ended?
-            pass
     exception = SystemExit(
         "\nfreenas-snmpd Terminating on SIGTERM\n")
     raise exception
@@ -142,6 +142,9 @@ class SockHandler(asyncore.dispatcher_with_send):
         global zilstat_five
         global zilstat_ten
         global zpoolio_all
+        global last_request
+        last_request = time.monotonic()
+        requested.set()
         with lock:
             tmp_data = {
                 "zil_data": {
@@ -202,126 +205,160 @@ class Loop_Sockserver(threading.Thread):
         self.join()
 
 
-# Method to parse `zilstat interval 1`
-def zfs_zilstat_ops(interval):
-    global proc_pid_list
-    zilstatproc = subprocess.Popen(
-        ['/usr/local/bin/zilstat', str(interval), '1'],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        preexec_fn=os.setsid,
-        encoding='utf8',
-    )
-    ppid = zilstatproc.pid
-    with lock:
-        proc_pid_list.append(ppid)
-    output = zilstatproc.communicate()[0].strip('\n')
-    output = output.split('\n')[1].split()
-    attrs = {
-        'NBytes': output[0],
-        'NBytespersec': output[1],
-        'NMaxRate': output[2],
-        'BBytes': output[3],
-        'BBytespersec': output[4],
-        'BMaxRate': output[5],
-        'ops': output[6],
-        'lteq4kb': output[7],
-        '4to32kb': output[8],
-        'gteq4kb': output[9],
+def zil_counters():
+    """
+    Read the ZIL kstats, keyed by name without the kstat.zfs.misc.zil prefix.
+    """
+    return {
+        i.name.rsplit('.', 1)[-1]: i.value
+        for i in sysctl.filter('kstat.zfs.misc.zil')
     }
-    with lock:
-        try:
-            proc_pid_list.remove(ppid)
-        except ValueError:
-            # Its not in the list?
-            pass
-    return attrs
 
 
-class zilOneWorker(threading.Thread):
-    def __init__(self):
-        super(zilOneWorker, self).__init__()
-        self.daemon = True
+def zil_window(samples, interval):
+    """
+    Compute zilstat-like values over the last `interval` seconds out of
+    the 1 second `samples` ring buffer, (time, zil counters) oldest first.
+
+    Nbytes is the data written to the ZIL and Bbytes the size of the
+    blocks it was written in, MaxRate being the highest 1 second rate.
+    """
+    if len(samples) < 2:
+        return {}
+    window = list(samples)[-(interval + 1):]
+
+    def nbytes(counters):
+        return sum(counters.get(k, 0) for k in (
+            'zil_itx_indirect_bytes',
+            'zil_itx_copied_bytes',
+            'zil_itx_needcopy_bytes',
+        ))
+
+    def bbytes(counters):
+        return sum(counters.get(k, 0) for k in (
+            'zil_itx_metaslab_normal_bytes',
+            'zil_itx_metaslab_slog_bytes',
+        ))
+
+    def ops(counters):
+        return sum(counters.get(k, 0) for k in (
+            'zil_itx_metaslab_normal_count',
+            'zil_itx_metaslab_slog_count',
+        ))
+
+    nmax = bmax = 0
+    for (t0, c0), (t1, c1) in zip(window, window[1:]):
+        elapsed = (t1 - t0) or 1
+        nmax = max(nmax, int((nbytes(c1) - nbytes(c0)) / elapsed))
+        bmax = max(bmax, int((bbytes(c1) - bbytes(c0)) / elapsed))
+
+    (first_time, first), (last_time, last) = window[0], window[-1]
+    elapsed = (last_time - first_time) or 1
+    return {
+        'NBytes': nbytes(last) - nbytes(first),
+        'NBytespersec': int((nbytes(last) - nbytes(first)) / elapsed),
+        'NMaxRate': nmax,
+        'BBytes': bbytes(last) - bbytes(first),
+        'BBytespersec': int((bbytes(last) - bbytes(first)) / elapsed),
+        'BMaxRate': bmax,
+        'ops': ops(last) - ops(first),
+        # Buffer size bins are not available from the counters
+        'lteq4kb': 0,
+        '4to32kb': 0,
+        'gteq4kb': 0,
+    }
 
-    def run(self):
-        global zilstat_one
-        while not QUIT_FLAG.wait(0.01):
-            temp = zfs_zilstat_ops(1)
-            with lock:
-                zilstat_one = temp
 
+class statsWorker(threading.Thread):
+    """
+    Samples ZIL counters and pools I/O every second while there are
+    clients asking for them, ZIL windows computed from a single ring
+    buffer of samples.
+    """
 
-class zilFiveWorker(threading.Thread):
     def __init__(self):
-        super(zilFiveWorker, self).__init__()
+        super(statsWorker, self).__init__()
         self.daemon = True
+        self.zfs = libzfs.ZFS()
+        self.zil_samples = deque(maxlen=max(ZIL_INTERVALS) + 1)
+        self.previous_values = {}
 
     def run(self):
+        global zilstat_one
         global zilstat_five
-        while not QUIT_FLAG.wait(0.01):
-            temp = zfs_zilstat_ops(5)
-            with lock:
-                zilstat_five = temp
-
-
-class zilTenWorker(threading.Thread):
-    def __init__(self):
-        super(zilTenWorker, self).__init__()
-        self.daemon = True
-
-    def run(self):
         global zilstat_ten
-        while not QUIT_FLAG.wait(0.01):
-            temp = zfs_zilstat_ops(10)
+        global zpoolio_one
+        global zpoolio_all
+        while not QUIT_FLAG.is_set():
+            if time.monotonic() - last_request > IDLE_TIMEOUT:
+                # Nobody is asking, stop sampling until someone does.
+                # Do not serve values from before the pause, start over.
+                with lock:
+                    zilstat_one = {}
+                    zilstat_five = {}
+                    zilstat_ten = {}
+                    zpoolio_one = {}
+                    zpoolio_all = {}
+                self.zil_samples.clear()
+                self.previous_values = {}
+                # A request sets the event after updating last_request,
+                # clearing it only once woken up cannot miss one.
+                requested.wait()
+                requested.clear()
+                continue
+
+            try:
+                self.zil_samples.append((time.monotonic(), zil_counters()))
+            except Exception as e:
+                syslog(LOG_ALERT, 'Failed to read ZIL statistics: %s' % e)
+            zil = {i: zil_window(self.zil_samples, i) for i in ZIL_INTERVALS}
             with lock:
-                zilstat_ten = temp
+                zilstat_one = zil[1]
+                zilstat_five = zil[5]
+                zilstat_ten = zil[10]
 
+            self.zpoolio()
+            QUIT_FLAG.wait(1.0)
 
-class zpoolioWorker(threading.Thread):
-    def __init__(self):
-        super(zpoolioWorker, self).__init__()
-        self.daemon = True
-
-    def run(self):
+    def zpoolio(self):
         global zpoolio_one
         global zpoolio_all
-        zfs = libzfs.ZFS()
-        previous_values = {}
-        while not QUIT_FLAG.wait(1.0):
-            rv = {}
-            for pool in zfs.pools:
-                next_val = {
-                    'pool': pool.name,
-                    'alloc': unprettyprint(pool.properties['allocated'].value),
-                    'free': unprettyprint(pool.properties['free'].value),
-                    'opread': pool.root_vdev.stats.ops[libzfs.ZIOType.READ],
-                    'opwrite': pool.root_vdev.stats.ops[libzfs.ZIOType.WRITE],
-                    'bwread': pool.root_vdev.stats.bytes[libzfs.ZIOType.READ],
-                    'bwrite': pool.root_vdev.stats.bytes[libzfs.ZIOType.WRITE],
+        previous_values = self.previous_values
+        rv = {}
+        for pool in self.zfs.pools:
+            next_val = {
+                'pool': pool.name,
+                'alloc': unprettyprint(pool.properties['allocated'].value),
+                'free': unprettyprint(pool.properties['free'].value),
+                'opread': pool.root_vdev.stats.ops[libzfs.ZIOType.READ],
+                'opwrite': pool.root_vdev.stats.ops[libzfs.ZIOType.WRITE],
+                'bwread': pool.root_vdev.stats.bytes[libzfs.ZIOType.READ],
+                'bwrite': pool.root_vdev.stats.bytes[libzfs.ZIOType.WRITE],
+            }
+            try:
+                update_dict = {
+                    'opread': next_val['opread'] - previous_values[pool.name]['opread'],
+                    'opwrite': next_val['opwrite'] - previous_values[pool.name]['opwrite'],
+                    'bwread': next_val['bwread'] - previous_values[pool.name]['bwread'],
+                    'bwrite': next_val['bwrite'] - previous_values[pool.name]['bwrite'],
                 }
-                try:
-                    update_dict = {
-                        'opread': next_val['opread'] - previous_values[pool.name]['opread'],
-                        'opwrite': next_val['opwrite'] - previous_values[pool.name]['opwrite'],
-                        'bwread': next_val['bwread'] - previous_values[pool.name]['bwread'],
-                        'bwrite': next_val['bwrite'] - previous_values[pool.name]['bwrite'],
-                    }
-                except KeyError:
-                    # This means that the 'previous_values' dict does not contain this
-                    # pool (maybe it was just added or maybe we just started this worker)
-                    # and thus there is nothing to report at this point for this pool
-                    pass
-                else:
-                    # If the Key Error exception was not raised then do the following
-                    rv[pool.name] = next_val.copy()
-                    rv[pool.name].update(update_dict)
-                finally:
-                    # In either case we want the next previous_value's pool.name key to contain
-                    # the current next_val
-                    previous_values[pool.name] = next_val.copy()
-            with lock:
-                zpoolio_one = rv.copy()
-                zpoolio_all = previous_values.copy()
+            except KeyError:
+                # This means that the 'previous_values' dict does not contain this
+                # pool (maybe it was just added or maybe we just started this worker)
+                # and thus there is nothing to report at this point for this pool
+                pass
+            else:
+                # If the Key Error exception was not raised then do the following
+                rv[pool.name] = next_val.copy()
+                rv[pool.name].update(update_dict)
+            finally:
+                # In either case we want the next previous_value's pool.name key to contain
+                # the current next_val
+                previous_values[pool.name] = next_val.copy()
+        with lock:
+            zpoolio_one = rv.copy()
+            zpoolio_all = previous_values.copy()
+
 
 if __name__ == '__main__':
 
@@ -342,14 +379,8 @@ if __name__ == '__main__':
         setproctitle('freenas-snmpd')
         loop_thread = Loop_Sockserver()
         loop_thread.start()
-        z1 = zilOneWorker()
-        z5 = zilFiveWorker()
-        z10 = zilTenWorker()
-        zio = zpoolioWorker()
-        z1.start()
-        z5.start()
-        z10.start()
-        zio.start()
+        stats = statsWorker()
+        stats.start()
         # stupid while true to keep main loop active
         # fix this if possible
         while True:
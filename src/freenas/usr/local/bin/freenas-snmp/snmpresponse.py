@@ -25,36 +25,99 @@
 # Initial code taken from: https://github.com/jm66/solaris-extra-snmp
 
 
-def decompose_oid(oid):
-    return [int(o) for o in oid.split('.')[1:]]
+import bisect
+import sys
+import time
 
 
-def oid_compare(a, b):
-    ad = decompose_oid(a)
-    bd = decompose_oid(b)
-    return cmp(ad, bd)
+def decompose_oid(oid):
+    return [int(o) for o in oid.split('.')[1:]]
 
 
-def printValue(value, oid):
+def printValue(value, oid, out=sys.stdout):
     # If it's a function, call it.
-    if type(value).__name__ == 'function':
+    if callable(value):
         value = value(oid)
     # Otherwise assume it's a two-tuple of type and value.
-    print(value[0])
-    print(value[1])
+    typ, value = value
+    if typ in ('gauge', 'counter', 'counter64', 'integer'):
+        value = int(value)
+    out.write('%s\n%s\n' % (typ, value))
 
 
-def respond_to(operation, req_oid, result):
-    result = sorted(result, key=lambda row: decompose_oid(row[0]))
+class OIDTable(object):
+    """
+    OIDs and their values sorted so GET and GETNEXT are a bisect away.
+    """
+
+    def __init__(self, result):
+        rows = sorted(result, key=lambda row: decompose_oid(row[0]))
+        self.keys = [decompose_oid(oid) for oid, value in rows]
+        self.rows = rows
+
+    def get(self, oid):
+        key = decompose_oid(oid)
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.rows[i]
 
+    def getnext(self, oid):
+        i = bisect.bisect_right(self.keys, decompose_oid(oid))
+        if i < len(self.rows):
+            return self.rows[i]
+
+
+def respond_to(operation, req_oid, result):
+    table = OIDTable(result)
     if operation == '-g':
-        for oid, value in result:
-            if oid == req_oid:
-                print(oid)
-                printValue(value, oid)
+        row = table.get(req_oid)
     elif operation == '-n':
-        for oid, value in result:
-            if oid_compare(oid, req_oid) == 1:
-                print(oid)
-                printValue(value, oid)
-                break
+        row = table.getnext(req_oid)
+    else:
+        row = None
+    if row:
+        print(row[0])
+        printValue(row[1], row[0])
+
+
+def pass_persist(build, interval, stdin=sys.stdin, stdout=sys.stdout):
+    """
+    Answer snmpd pass_persist requests until stdin is closed.
+
+    `build` returns the list of (oid, value) to serve, it is called again
+    once the table is older than `interval` seconds.
+    """
+    table = None
+    built = 0
+    while True:
+        line = stdin.readline()
+        if not line:
+            break
+        command = line.strip().lower()
+        if command == 'ping':
+            stdout.write('PONG\n')
+        elif command in ('get', 'getnext'):
+            oid = stdin.readline().strip()
+            if table is None or time.monotonic() - built >= interval:
+                try:
+                    table = OIDTable(build())
+                    built = time.monotonic()
+                except Exception as e:
+                    # Keep serving the last table
+                    sys.stderr.write('Failed to refresh OID table: %s\n' % e)
+            row = None
+            if table is not None:
+                try:
+                    row = table.get(oid) if command == 'get' else table.getnext(oid)
+                except ValueError:
+                    pass
+            if row:
+                stdout.write('%s\n' % row[0])
+                printValue(row[1], row[0], out=stdout)
+            else:
+                stdout.write('NONE\n')
+        elif command == 'set':
+            stdin.readline()
+            stdin.readline()
+            stdout.write('not-writable\n')
+        stdout.flush()
@@ -1,16 +1,33 @@
-from collections import OrderedDict
+from collections import deque, OrderedDict
 from datetime import datetime
+from middlewared.client import ejson
 from middlewared.utils import Popen
 
 import asyncio
 import copy
 import enum
 import json
+import logging
 import os
+import sqlite3
 import subprocess
 import sys
+import threading
+import time
 import traceback
 
+logger = logging.getLogger('middlewared.job')
+
+# Finished jobs are kept across restarts in this database
+JOBS_HISTORY_PATH = '/var/db/middlewared/jobs.db'
+# Number of finished jobs kept in the history
+JOBS_HISTORY_MAX = 10000
+# Number of finished jobs of each method kept in the history, so frequent
+# jobs do not push the others out.
+JOBS_HISTORY_METHOD_MAX = 100
+# Progress of a job is sent at most once every this many seconds
+PROGRESS_INTERVAL = 1
+
 
 class State(enum.Enum):
     WAITING = 1
@@ -31,6 +48,10 @@ class JobSharedLock(object):
         self.queue = queue
         self.name = name
         self.jobs = []
+        # Jobs waiting for the lock, in order
+        self.waiting = deque()
+        # Whether a job holding or about to hold the lock has been scheduled
+        self.scheduled = False
         self.semaphore = asyncio.Semaphore()
 
     def add_job(self, job):
@@ -53,11 +74,17 @@ class JobSharedLock(object):
 
 
 class JobsQueue(object):
+    """
+    Jobs without a lock are ready to run right away. Jobs with a lock wait
+    in the queue of the lock and only the first one is made ready once the
+    lock is free, so picking the next job never scans the waiting ones.
+    """
 
     def __init__(self, middleware):
         self.middleware = middleware
-        self.deque = JobsDeque()
-        self.queue = []
+        self.history = JobsHistory()
+        self.deque = JobsDeque(start=self.history.last_id())
+        self.ready = deque()
 
         # Event responsible for the job queue schedule loop.
         # This event is set and a new job is potentially ready to run
@@ -71,12 +98,19 @@ class JobsQueue(object):
 
     def add(self, job):
         self.deque.add(job)
-        self.queue.append(job)
 
         self.middleware.send_event('core.get_jobs', 'ADDED', id=job.id, fields=job.__encode__())
 
+        lock = self.get_lock(job)
+        if lock is None:
+            self.ready.append(job)
+        else:
+            lock.waiting.append(job)
+            self.schedule(lock)
+
         # A job has been added to the queue, let the queue scheduler run
-        self.queue_event.set()
+        if self.ready:
+            self.queue_event.set()
 
     def get_lock(self, job):
         """
@@ -93,6 +127,17 @@ class JobsQueue(object):
         lock.add_job(job)
         return lock
 
+    def schedule(self, lock):
+        """
+        Make the first job waiting for `lock` ready to run unless a job
+        holding the lock is scheduled already.
+        """
+        if lock.scheduled or not lock.waiting:
+            return
+        lock.scheduled = True
+        self.ready.append(lock.waiting.popleft())
+        self.queue_event.set()
+
     def release_lock(self, job):
         lock = job.get_lock()
         if not lock:
@@ -100,13 +145,24 @@ class JobsQueue(object):
         # Remove job from lock list and release it so another job can use it
         lock.remove_job(job)
         lock.release()
+        lock.scheduled = False
 
         if len(lock.get_jobs()) == 0:
             self.job_locks.pop(lock.name)
 
         # Once a lock is released there could be another job in the queue
         # waiting for the same lock
-        self.queue_event.set()
+        self.schedule(lock)
+
+    async def finished(self, job):
+        """
+        Job is done running, store it in the history.
+        """
+        self.release_lock(job)
+        try:
+            await self.middleware.threaded(self.history.add, job.__encode__())
+        except Exception:
+            logger.warn('Failed to store job %d in the history', job.id, exc_info=True)
 
     async def __next__(self):
         """
@@ -116,25 +172,16 @@ class JobsQueue(object):
         while True:
             # Awaits a new event to look for a job
             await self.queue_event.wait()
-            found = None
-            for job in self.queue:
-                lock = self.get_lock(job)
-                # Get job in the queue if it has no lock or its not locked
-                if lock is None or not lock.locked():
-                    found = job
-                    if lock:
-                        await job.set_lock(lock)
-                    break
-            if found:
-                # Unlocked job found to run
-                self.queue.remove(found)
-                # If there are no more jobs in the queue, clear the event
-                if len(self.queue) == 0:
-                    self.queue_event.clear()
-                return found
-            else:
-                # No jobs available to run, clear the event
+            if not self.ready:
+                self.queue_event.clear()
+                continue
+            job = self.ready.popleft()
+            if not self.ready:
                 self.queue_event.clear()
+            name = job.get_lock_name()
+            if name is not None:
+                await job.set_lock(self.job_locks[name])
+            return job
 
     async def run(self):
         while True:
@@ -148,9 +195,9 @@ class JobsDeque(object):
     with a `id` assigner.
     """
 
-    def __init__(self, maxlen=1000):
-        self.maxlen = 1000
-        self.count = 0
+    def __init__(self, maxlen=1000, start=0):
+        self.maxlen = maxlen
+        self.count = start
         self.__dict = OrderedDict()
 
     def add(self, job):
@@ -164,6 +211,141 @@ class JobsDeque(object):
         return self.__dict
 
 
+class JobsHistory(object):
+    """
+    Finished jobs stored in a sqlite database, indexed by method, state
+    and time.
+    """
+
+    COLUMNS = ('id', 'method', 'state', 'time_started', 'time_finished')
+    OPERATORS = {
+        '=': '=',
+        '!=': '!=',
+        '>': '>',
+        '>=': '>=',
+        '<': '<',
+        '<=': '<=',
+        'in': 'IN',
+        'nin': 'NOT IN',
+    }
+
+    def __init__(self, path=JOBS_HISTORY_PATH, maxlen=JOBS_HISTORY_MAX, method_maxlen=JOBS_HISTORY_METHOD_MAX):
+        self.path = path
+        self.maxlen = maxlen
+        self.method_maxlen = method_maxlen
+        self.lock = threading.Lock()
+        self.added = 0
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY,
+                    method TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    time_started REAL,
+                    time_finished REAL,
+                    data TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_method_id ON jobs (method, id);
+                CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, time_finished);
+                CREATE INDEX IF NOT EXISTS jobs_time_finished ON jobs (time_finished);
+            """)
+        except Exception:
+            logger.warn('Failed to open jobs history %s', path, exc_info=True)
+            self.conn = None
+
+    @staticmethod
+    def _value(value):
+        if isinstance(value, datetime):
+            return value.timestamp()
+        return value
+
+    def last_id(self):
+        if self.conn is None:
+            return 0
+        with self.lock:
+            return self.conn.execute('SELECT MAX(id) FROM jobs').fetchone()[0] or 0
+
+    def add(self, job):
+        """
+        Store the encoded `job`.
+        """
+        if self.conn is None:
+            return
+        try:
+            data = ejson.dumps(job)
+        except Exception:
+            # Result may not be serializable
+            data = ejson.dumps(dict(job, result=None))
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)',
+                    (
+                        job['id'], job['method'], job['state'], self._value(job['time_started']),
+                        self._value(job['time_finished']), data,
+                    ),
+                )
+                self.conn.execute(
+                    'DELETE FROM jobs WHERE method = ? AND id <= '
+                    '(SELECT id FROM jobs WHERE method = ? ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                    (job['method'], job['method'], self.method_maxlen),
+                )
+                self.added += 1
+                if self.added % 100 == 0:
+                    self.conn.execute(
+                        'DELETE FROM jobs WHERE id <= (SELECT MAX(id) FROM jobs) - ?', (self.maxlen,),
+                    )
+
+    def query(self, filters=None, order_by=None, limit=None):
+        """
+        Returns the jobs matching `filters` on indexed columns, ordered by id.
+
+        Other filters are left for the caller to apply on the result. If
+        every filter and `order_by` key is on an indexed column, jobs are
+        sorted by `order_by` (then id) and at most `limit` of them returned.
+        """
+        if self.conn is None:
+            return []
+        where = []
+        params = []
+        exact = True
+        for f in filters or []:
+            if len(f) != 3 or f[0] not in self.COLUMNS or f[1] not in self.OPERATORS:
+                exact = False
+                continue
+            name, op, value = f
+            if op in ('in', 'nin'):
+                value = list(value)
+                where.append(f'{name} {self.OPERATORS[op]} ({", ".join("?" * len(value))})')
+                params.extend(self._value(i) for i in value)
+            else:
+                where.append(f'{name} {self.OPERATORS[op]} ?')
+                params.append(self._value(value))
+        sql = 'SELECT data FROM jobs'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        order = []
+        for name in order_by or []:
+            reverse = name.startswith('-')
+            name = name[1:] if reverse else name
+            if name not in self.COLUMNS:
+                exact = False
+                break
+            order.append(f'{name} DESC' if reverse else name)
+        if exact:
+            sql += ' ORDER BY ' + ', '.join(order + ['id'])
+            if limit:
+                sql += ' LIMIT ?'
+                params.append(limit)
+        else:
+            sql += ' ORDER BY id'
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [ejson.loads(i[0]) for i in rows]
+
+
 class Job(object):
     """
     Represents a long running call, methods marked with @job decorator
@@ -190,6 +372,8 @@ class Job(object):
         }
         self.time_started = datetime.now()
         self.time_finished = None
+        self.__progress_sent = 0
+        self.__progress_handle = None
 
         # If Job is marked as pipe we open a pipe()
         # so the job can read/write and the other end can read/write it
@@ -240,7 +424,30 @@ class Job(object):
             self.progress['description'] = description
         if extra:
             self.progress['extra'] = extra
-        self.middleware.send_event('core.get_jobs', 'CHANGED', id=self.id, fields=self.__encode__())
+        # May be called from a thread
+        self.middleware.loop.call_soon_threadsafe(self.__progress_changed)
+
+    def __progress_changed(self):
+        """
+        Progress changes are coalesced and sent at most once every
+        PROGRESS_INTERVAL seconds.
+        """
+        if self.__progress_handle is not None or self.state in (State.SUCCESS, State.FAILED):
+            return
+        delay = self.__progress_sent + PROGRESS_INTERVAL - time.monotonic()
+        if delay > 0:
+            self.__progress_handle = self.middleware.loop.call_later(delay, self.__send_progress)
+        else:
+            self.__send_progress()
+
+    def __send_progress(self):
+        self.__progress_handle = None
+        self.__progress_sent = time.monotonic()
+        self.middleware.send_event('core.get_jobs', 'CHANGED', id=self.id, fields={
+            'id': self.id,
+            'state': self.state.name,
+            'progress': self.progress,
+        })
 
     async def wait(self):
         await self._finished.wait()
@@ -305,7 +512,10 @@ class Job(object):
             self.set_exception(sys.exc_info())
             raise
         finally:
-            queue.release_lock(self)
+            if self.__progress_handle is not None:
+                self.__progress_handle.cancel()
+                self.__progress_handle = None
+            await queue.finished(self)
             self._finished.set()
             self.middleware.send_event('core.get_jobs', 'CHANGED', id=self.id, fields=self.__encode__())
 
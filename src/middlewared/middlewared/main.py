@@ -6,7 +6,7 @@ from .schema import Error as SchemaError
 from .service import CallError, CallException
 from aiohttp import web
 from aiohttp_wsgi import WSGIHandler
-from collections import defaultdict
+from collections import defaultdict, deque, Counter
 from daemon import DaemonContext
 from daemon.pidfile import TimeoutPIDLockFile
 
@@ -15,15 +15,18 @@ import asyncio
 import binascii
 import concurrent.futures
 import errno
+import functools
 import imp
 import inspect
 import linecache
 import os
 import queue
+import re
 import select
 import setproctitle
 import signal
 import sys
+import tempfile
 import threading
 import time
 import traceback
@@ -32,6 +35,31 @@ import urllib.parse
 import uuid
 from . import logger
 
+# Messages queued for a client not reading fast enough, older events are
+# dropped past that
+SEND_QUEUE_MAX = 1000
+# Bytes buffered in the transport of a client above which messages are
+# queued instead of written
+SEND_HIGH_WATER = 1024 * 1024
+# Seconds between checks of a congested client transport
+SEND_POLL_INTERVAL = 0.05
+
+
+def event_message(name, event_type, **kwargs):
+    event = {
+        'msg': event_type.lower(),
+        'collection': name,
+    }
+    if 'id' in kwargs:
+        event['id'] = kwargs['id']
+    if event_type in ('ADDED', 'CHANGED'):
+        if 'fields' in kwargs:
+            event['fields'] = kwargs['fields']
+    if event_type == 'CHANGED':
+        if 'cleared' in kwargs:
+            event['cleared'] = kwargs['cleared']
+    return event
+
 
 class Application(object):
 
@@ -53,13 +81,93 @@ class Application(object):
         """
         self.__callbacks = defaultdict(list)
         self.__subscribed = {}
+        self.__subscribed_names = Counter()
+
+        # Messages waiting for the client to catch up. Entries are
+        # [key, encoded, event], `key` being set for CHANGED events which
+        # are coalesced by collection and id.
+        self.__queue = deque()
+        self.__coalesce = {}
+        self.__dropped = 0
+        self.__writer = None
 
     def register_callback(self, name, method):
         assert name in ('on_message', 'on_close')
         self.__callbacks[name].append(method)
 
     def _send(self, data):
-        self.response.send_json(data, dumps=json.dumps)
+        self._send_encoded(json.dumps(data))
+
+    def __congested(self):
+        transport = self.request.transport
+        return transport is not None and transport.get_write_buffer_size() > SEND_HIGH_WATER
+
+    def _send_encoded(self, data, event=None):
+        """
+        Send an already encoded message, queueing it if the client is not
+        keeping up. `event` is the message itself if it can be coalesced
+        or dropped.
+        """
+        if not self.__queue and not self.__congested():
+            self.response.send_str(data)
+            return
+
+        key = None
+        if event is not None and event['msg'] == 'changed' and 'id' in event:
+            key = (event['collection'], str(event['id']))
+            entry = self.__coalesce.get(key)
+            if entry is not None:
+                # Fold into the pending event, fields not in the new one
+                # are kept from the previous.
+                merged = dict(entry[2])
+                merged['fields'] = dict(entry[2].get('fields') or {}, **(event.get('fields') or {}))
+                if 'cleared' in event:
+                    merged['cleared'] = event['cleared']
+                entry[1] = None
+                entry[2] = merged
+                return
+        elif event is not None and event['msg'] in ('added', 'removed') and 'id' in event:
+            # Changes queued after this one must not be folded into changes
+            # queued before it.
+            self.__coalesce.pop((event['collection'], str(event['id'])), None)
+
+        entry = [key, data, event]
+        self.__queue.append(entry)
+        if key is not None:
+            self.__coalesce[key] = entry
+
+        if len(self.__queue) > SEND_QUEUE_MAX:
+            for i, old in enumerate(self.__queue):
+                if old[2] is not None:
+                    del self.__queue[i]
+                    if old[0] is not None:
+                        self.__coalesce.pop(old[0], None)
+                    if self.__dropped == 0:
+                        self.logger.warn('Client %s is not keeping up, dropping events', self.sessionid)
+                    self.__dropped += 1
+                    break
+
+        if self.__writer is None:
+            self.__writer = asyncio.ensure_future(self.__write_queue())
+
+    async def __write_queue(self):
+        try:
+            while self.__queue:
+                if self.__congested():
+                    await asyncio.sleep(SEND_POLL_INTERVAL)
+                    continue
+                key, data, event = self.__queue.popleft()
+                if key is not None:
+                    self.__coalesce.pop(key, None)
+                self.response.send_str(data if data is not None else json.dumps(event))
+            if self.__dropped:
+                self.logger.warn('Client %s caught up, %d events dropped', self.sessionid, self.__dropped)
+                self.__dropped = 0
+        except Exception:
+            self.__queue.clear()
+            self.__coalesce.clear()
+        finally:
+            self.__writer = None
 
     def _tb_error(self, exc_info):
         klass, exc, trace = exc_info
@@ -170,35 +278,20 @@ class Application(object):
 
     def subscribe(self, ident, name):
         self.__subscribed[ident] = name
+        self.__subscribed_names[name] += 1
+        if self.__subscribed_names[name] == 1:
+            self.middleware.subscribe_wsclient(name, self)
         self._send({
             'msg': 'ready',
             'subs': [ident],
         })
 
     def unsubscribe(self, ident):
-        self.__subscribed.pop(ident)
-
-    def send_event(self, name, event_type, **kwargs):
-        found = False
-        for i in self.__subscribed.values():
-            if i == name or i == '*':
-                found = True
-                break
-        if not found:
-            return
-        event = {
-            'msg': event_type.lower(),
-            'collection': name,
-        }
-        if 'id' in kwargs:
-            event['id'] = kwargs['id']
-        if event_type in ('ADDED', 'CHANGED'):
-            if 'fields' in kwargs:
-                event['fields'] = kwargs['fields']
-        if event_type == 'CHANGED':
-            if 'cleared' in kwargs:
-                event['cleared'] = kwargs['cleared']
-        self._send(event)
+        name = self.__subscribed.pop(ident)
+        self.__subscribed_names[name] -= 1
+        if self.__subscribed_names[name] == 0:
+            self.__subscribed_names.pop(name)
+            self.middleware.unsubscribe_wsclient(name, self)
 
     def on_open(self):
         self.middleware.register_wsclient(self)
@@ -211,6 +304,15 @@ class Application(object):
             except:
                 self.logger.error('Failed to run on_close callback.', exc_info=True)
 
+        for name in list(self.__subscribed_names):
+            self.middleware.unsubscribe_wsclient(name, self)
+        self.__subscribed_names.clear()
+        self.__subscribed.clear()
+        if self.__writer is not None:
+            self.__writer.cancel()
+        self.__queue.clear()
+        self.__coalesce.clear()
+
         self.middleware.unregister_wsclient(self)
 
     async def on_message(self, message):
@@ -263,10 +365,102 @@ class Application(object):
             self.unsubscribe(message['id'])
 
 
+# Size of reads and writes of file transfers
+FILE_CHUNK_SIZE = 1024 * 1024
+# Uploaded files received before the job exists are kept in memory up to
+# this size and spooled to disk above it
+UPLOAD_SPOOL_THRESHOLD = 16 * 1024 * 1024
+# Where job outputs and uploads are spooled to
+SPOOL_DIR = '/var/tmp'
+# Seconds a job output is kept after it was last downloaded
+DOWNLOAD_SPOOL_TTL = 3600
+RE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class JobOutputSpool(object):
+    """
+    Output of a job pipe spooled to an unlinked file as it is produced,
+    so it can be downloaded while the job is running, more than once and
+    by ranges.
+    """
+
+    def __init__(self, middleware, read_fd):
+        self.middleware = middleware
+        self.fd, path = tempfile.mkstemp(dir=SPOOL_DIR)
+        os.unlink(path)
+        self.size = 0
+        self.complete = False
+        self.accessed = time.monotonic()
+        self.cond = asyncio.Condition()
+        asyncio.ensure_future(self.__fill(read_fd))
+
+    def __copy(self, read_fd):
+        data = os.read(read_fd, FILE_CHUNK_SIZE)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+        return len(data)
+
+    async def __fill(self, read_fd):
+        try:
+            while True:
+                size = await self.middleware.threaded(self.__copy, read_fd)
+                if size == 0:
+                    break
+                async with self.cond:
+                    self.size += size
+                    self.cond.notify_all()
+        finally:
+            os.close(read_fd)
+            async with self.cond:
+                self.complete = True
+                self.cond.notify_all()
+
+    async def read(self, start, end=None):
+        """
+        Yields the output from `start` up to `end` (exclusive), waiting for
+        the job to produce it.
+        """
+        offset = start
+        while end is None or offset < end:
+            self.accessed = time.monotonic()
+            async with self.cond:
+                await self.cond.wait_for(lambda: self.size > offset or self.complete)
+            if offset >= self.size:
+                break
+            length = min(self.size if end is None else min(end, self.size), offset + FILE_CHUNK_SIZE) - offset
+            data = await self.middleware.threaded(os.pread, self.fd, length, offset)
+            if not data:
+                break
+            offset += len(data)
+            yield data
+
+    def close(self):
+        os.close(self.fd)
+
+
 class FileApplication(object):
 
     def __init__(self, middleware):
         self.middleware = middleware
+        self.spools = {}
+
+    def __get_spool(self, job):
+        spool = self.spools.get(job.id)
+        if spool is None:
+            spool = self.spools[job.id] = JobOutputSpool(self.middleware, job.read_fd)
+            # Pipe is owned by the spool now
+            job.read_fd = None
+            asyncio.get_event_loop().call_later(DOWNLOAD_SPOOL_TTL, self.__expire_spool, job.id)
+        return spool
+
+    def __expire_spool(self, job_id):
+        spool = self.spools[job_id]
+        idle = time.monotonic() - spool.accessed
+        if not spool.complete or idle < DOWNLOAD_SPOOL_TTL:
+            asyncio.get_event_loop().call_later(max(DOWNLOAD_SPOOL_TTL - idle, 60), self.__expire_spool, job_id)
+            return
+        self.spools.pop(job_id).close()
 
     async def download(self, request):
         path = request.path.split('/')
@@ -278,7 +472,7 @@ class FileApplication(object):
         job_id = int(path[-1])
         jobs = self.middleware.jobs.all()
         job = jobs.get(job_id)
-        if not job:
+        if not job or (job.read_fd is None and job_id not in self.spools):
             resp = web.Response()
             resp.set_status(404)
             return resp
@@ -303,30 +497,83 @@ class FileApplication(object):
             resp.set_status(401)
             return resp
 
-        resp = web.StreamResponse(status=200, reason='OK', headers={
+        spool = self.__get_spool(job)
+
+        headers = {
             'Content-Type': 'application/octet-stream',
             'Content-Disposition': f'attachment; filename="{filename}"',
-            'Transfer-Encoding': 'chunked',
-        })
+        }
+        status = 200
+        start = 0
+        end = None
+        if spool.complete:
+            # Length is only known once the job is done writing, until then
+            # the whole output is streamed regardless of any range requested.
+            headers['Accept-Ranges'] = 'bytes'
+            end = spool.size
+            reg = RE_RANGE.match(request.headers.get('Range', ''))
+            if reg and (reg.group(1) or reg.group(2)):
+                if not reg.group(1):
+                    start = max(spool.size - int(reg.group(2)), 0)
+                else:
+                    start = int(reg.group(1))
+                    if reg.group(2):
+                        end = min(int(reg.group(2)) + 1, spool.size)
+                if start >= end:
+                    resp = web.Response(headers={'Content-Range': f'bytes */{spool.size}'})
+                    resp.set_status(416)
+                    return resp
+                status = 206
+                headers['Content-Range'] = f'bytes {start}-{end - 1}/{spool.size}'
+            headers['Content-Length'] = str(end - start)
+        else:
+            headers['Transfer-Encoding'] = 'chunked'
+
+        resp = web.StreamResponse(status=status, reason='Partial Content' if status == 206 else 'OK', headers=headers)
         await resp.prepare(request)
 
-        f = None
-        try:
-            def read_write():
-                f = os.fdopen(job.read_fd, 'rb')
-                while True:
-                    read = f.read(1024)
-                    if read == b'':
-                        break
-                    resp.write(read)
-                    #await web.drain()
-            await self.middleware.threaded(read_write)
+        async for data in spool.read(start, end):
+            resp.write(data)
             await resp.drain()
+        return resp
+
+    async def __write_fd(self, chunks, fd):
+        """
+        Write `chunks` to the job pipe `fd`, which is closed afterwards.
+
+        Writes block once the pipe is full, so chunks are only read as fast
+        as the job consumes them.
+        """
+        def write(data):
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+
+        try:
+            async for data in chunks:
+                await self.middleware.threaded(write, data)
+        except BrokenPipeError:
+            # Job is not reading anymore, it will report its own error
+            pass
+        finally:
+            os.close(fd)
+
+    async def __part_chunks(self, part):
+        while True:
+            data = await part.read_chunk(FILE_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
 
+    async def __spool_chunks(self, spool):
+        try:
+            while True:
+                data = await self.middleware.threaded(spool.read, FILE_CHUNK_SIZE)
+                if not data:
+                    break
+                yield data
         finally:
-            if f:
-                f.close()
-        return resp
+            spool.close()
 
     async def upload(self, request):
 
@@ -355,42 +602,60 @@ class FileApplication(object):
             resp.set_status(401)
             return resp
 
-        form = {}
-        reader = await request.multipart()
-        while True:
-            part = await reader.next()
-            if part is None:
-                break
-            form[part.name] = await part.read()  # FIXME: handle big files
-
-        if 'data' not in form or 'file' not in form:
-            resp = web.Response(status=405, reason='Expected data not on payload')
-            resp.set_status(405)
-            return resp
-
+        # The file is streamed straight into the job pipe if the job data
+        # comes first in the payload, otherwise it has to be spooled until
+        # the job is created.
+        job = None
+        spool = None
+        written = False
         try:
-            data = json.loads(form['data'])
-            job = await self.middleware.call(data['method'], *(data.get('params') or []))
+            reader = await request.multipart()
+            while True:
+                part = await reader.next()
+                if part is None:
+                    break
+                if part.name == 'data' and job is None:
+                    try:
+                        data = json.loads(await part.read())
+                        job = await self.middleware.call(data['method'], *(data.get('params') or []))
+                    except Exception:
+                        if spool is not None:
+                            spool.close()
+                        resp = web.Response()
+                        resp.set_status(405)
+                        return resp
+                elif part.name == 'file' and not written and spool is None:
+                    if job is not None:
+                        # Job pipe is closed by __write_fd from now on
+                        written = True
+                        await self.__write_fd(self.__part_chunks(part), job.write_fd)
+                    else:
+                        spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_THRESHOLD, dir=SPOOL_DIR)
+                        async for data in self.__part_chunks(part):
+                            await self.middleware.threaded(spool.write, data)
+                        spool.seek(0)
+                else:
+                    await part.release()
+
+            if job is None or (not written and spool is None):
+                if spool is not None:
+                    spool.close()
+                if job is not None:
+                    os.close(job.write_fd)
+                resp = web.Response(status=405, reason='Expected data not on payload')
+                resp.set_status(405)
+                return resp
         except Exception:
-            resp = web.Response()
-            resp.set_status(405)
-            return resp
+            if spool is not None:
+                spool.close()
+            if job is not None and not written:
+                # Job would wait on its input forever
+                os.close(job.write_fd)
+            raise
 
-        f = None
-        try:
-            def read_write():
-                f = os.fdopen(job.write_fd, 'wb')
-                i = 0
-                while True:
-                    read = form['file'][i* 1024:(i + 1) * 1024]
-                    if read == b'':
-                        break
-                    f.write(read)
-                    i += 1
-            await self.middleware.threaded(read_write)
-        finally:
-            if f:
-                f.close()
+        if spool is not None:
+            # Do not hold the request until the job consumed the file
+            asyncio.ensure_future(self.__write_fd(self.__spool_chunks(spool), job.write_fd))
 
         resp = web.Response(
             status=200,
@@ -588,6 +853,8 @@ class Middleware(object):
         self.__schemas = {}
         self.__services = {}
         self.__wsclients = {}
+        # Event name to websocket clients subscribed to it
+        self.__wsclient_subs = defaultdict(set)
         self.__event_subs = defaultdict(list)
         self.__hooks = defaultdict(list)
         self.__server_threads = []
@@ -672,6 +939,17 @@ class Middleware(object):
     def unregister_wsclient(self, client):
         self.__wsclients.pop(client.sessionid)
 
+    def subscribe_wsclient(self, name, client):
+        self.__wsclient_subs[name].add(client)
+
+    def unsubscribe_wsclient(self, name, client):
+        clients = self.__wsclient_subs.get(name)
+        if clients is None:
+            return
+        clients.discard(client)
+        if not clients:
+            self.__wsclient_subs.pop(name)
+
     def register_hook(self, name, method, sync=True):
         """
         Register a hook under `name`.
@@ -810,11 +1088,25 @@ class Middleware(object):
 
     def send_event(self, name, event_type, **kwargs):
         assert event_type in ('ADDED', 'CHANGED', 'REMOVED')
-        for sessionid, wsclient in self.__wsclients.items():
+        if self.__loop is not None and threading.get_ident() != self.__thread_id:
+            # Clients and their queues are only touched from the event loop
+            self.__loop.call_soon_threadsafe(functools.partial(self.send_event, name, event_type, **kwargs))
+            return
+
+        wsclients = self.__wsclient_subs.get(name, set()) | self.__wsclient_subs.get('*', set())
+        if wsclients:
+            # Encoded once for every client
+            event = event_message(name, event_type, **kwargs)
             try:
-                wsclient.send_event(name, event_type, **kwargs)
-            except:
-                self.logger.warn('Failed to send event {} to {}'.format(name, sessionid), exc_info=True)
+                data = json.dumps(event)
+            except Exception:
+                self.logger.warn('Failed to encode event {}'.format(name), exc_info=True)
+                wsclients = set()
+            for wsclient in wsclients:
+                try:
+                    wsclient._send_encoded(data, event)
+                except:
+                    self.logger.warn('Failed to send event {} to {}'.format(name, wsclient.sessionid), exc_info=True)
 
         # Send event also for internally subscribed plugins
         for handler in self.__event_subs.get(name, []):
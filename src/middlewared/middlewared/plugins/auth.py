@@ -1,4 +1,8 @@
+import asyncio
 import crypt
+import hashlib
+import hmac
+import os
 import subprocess
 import time
 import uuid
@@ -7,6 +11,11 @@ from middlewared.schema import Dict, Int, Str, accepts
 from middlewared.service import Service, no_auth_required, pass_app, private
 from middlewared.utils import Popen
 
+# Seconds a verified username and password are trusted without crypt()
+CREDENTIALS_TTL = 60
+# Seconds between sweeps of expired tokens and credentials
+SWEEP_INTERVAL = 60
+
 
 class AuthTokens(object):
 
@@ -57,16 +66,67 @@ class AuthTokens(object):
 
     def pop_token(self, token_id):
         # Remove a token from both indexes
-        token = self.__tokens.pop(token_id)
+        token = self.__tokens.pop(token_id, None)
+        if token is None:
+            return
         for sessionid in token['sessions']:
             self.__sessionid_map.pop(sessionid, None)
 
+    def validate(self, token):
+        # Check token TTL, updating last time or removing it if expired
+        if int(time.time()) - token['ttl'] < token['last']:
+            token['last'] = int(time.time())
+            return True
+        self.pop_token(token['id'])
+        return False
+
+    def sweep(self):
+        # Remove expired tokens
+        now = int(time.time())
+        for token in list(self.__tokens.values()):
+            if now - token['ttl'] >= token['last']:
+                self.pop_token(token['id'])
+
+
+class CredentialsCache(object):
+    """
+    Verified username and password pairs.
+
+    Credentials are kept as a keyed hash with a per process random key and
+    are only valid along with the password hash they were verified against,
+    so changing the password invalidates them.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.__key = os.urandom(32)
+        self.__entries = {}
+
+    def __digest(self, username, password):
+        return hmac.new(self.__key, f'{username}\0{password}'.encode('utf8'), hashlib.sha256).digest()
+
+    def check(self, username, password, unixhash):
+        entry = self.__entries.get(self.__digest(username, password))
+        if entry is None:
+            return False
+        return entry[1] > time.monotonic() and hmac.compare_digest(entry[0], unixhash)
+
+    def add(self, username, password, unixhash):
+        self.__entries[self.__digest(username, password)] = (unixhash, time.monotonic() + self.ttl)
+
+    def sweep(self):
+        now = time.monotonic()
+        for digest, entry in list(self.__entries.items()):
+            if entry[1] <= now:
+                self.__entries.pop(digest, None)
+
 
 class AuthService(Service):
 
     def __init__(self, *args, **kwargs):
         super(AuthService, self).__init__(*args, **kwargs)
         self.authtokens = AuthTokens()
+        self.credentials = CredentialsCache(CREDENTIALS_TTL)
 
     @accepts(Str('username'), Str('password'))
     async def check_user(self, username, password):
@@ -79,9 +139,15 @@ class AuthService(Service):
             user = await self.middleware.call('datastore.query', 'account.bsdusers', [('bsdusr_username', '=', username)], {'get': True})
         except IndexError:
             return False
-        if user['bsdusr_unixhash'] in ('x', '*'):
+        unixhash = user['bsdusr_unixhash']
+        if unixhash in ('x', '*'):
             return False
-        return crypt.crypt(password, user['bsdusr_unixhash']) == user['bsdusr_unixhash']
+        if self.credentials.check(username, password, unixhash):
+            return True
+        valid = await self.middleware.threaded(crypt.crypt, password, unixhash) == unixhash
+        if valid:
+            self.credentials.add(username, password, unixhash)
+        return valid
 
     @accepts(Int('ttl', required=False), Dict('attrs', additional_attrs=True))
     def generate_token(self, ttl=None, attrs=None):
@@ -94,6 +160,23 @@ class AuthService(Service):
     def get_token(self, token_id):
         return self.authtokens.get_token(token_id)
 
+    @private
+    async def check_token(self, token_id):
+        """
+        Verify `token_id` is a valid token, refreshing its TTL.
+        """
+        token = self.authtokens.get_token(token_id)
+        if token is None:
+            return False
+        return self.authtokens.validate(token)
+
+    @private
+    async def sweeper(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            self.authtokens.sweep()
+            self.credentials.sweep()
+
     @no_auth_required
     @accepts(Str('username'), Str('password'))
     @pass_app
@@ -119,12 +202,8 @@ class AuthService(Service):
             removing authentication
             """
             token = self.authtokens.get_token_by_sessionid(app.sessionid)
-            if token is None:
-                return
-            if int(time.time()) - token['ttl'] < token['last']:
-                token['last'] = int(time.time())
-            else:
-                self.authtokens.pop_token(token['id'])
+            if token is None or not self.authtokens.validate(token):
+                # Expired, possibly removed by the sweeper already
                 app.authenticated = False
 
         def remove_session(app):
@@ -143,15 +222,13 @@ class AuthService(Service):
           - add the session id to token
           - register connection callbacks to update/remove token
         """
-        if int(time.time()) - token['ttl'] < token['last']:
-            token['last'] = int(time.time())
+        if self.authtokens.validate(token):
             self.authtokens.add_session(app.sessionid, token)
             app.register_callback('on_message', update_token)
             app.register_callback('on_close', remove_session)
             app.authenticated = True
             return True
         else:
-            self.authtokens.pop_token(token['id'])
             return False
 
 
@@ -180,3 +257,4 @@ async def check_permission(app):
 
 def setup(middleware):
     middleware.register_hook('core.on_connect', check_permission, sync=True)
+    asyncio.ensure_future(middleware.call('auth.sweeper'))
@@ -0,0 +1,279 @@
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from middlewared.schema import accepts
+from middlewared.service import Service, private
+from middlewared.utils import run
+
+import asyncio
+import heapq
+import libzfs
+import re
+
+RE_AUTOSNAP = re.compile(
+    r'^auto-(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})\.(?P<hour>\d{2})(?P<minute>\d{2})'
+    r'-(?P<retcount>\d+)(?P<retunit>[hdwmy])$'
+)
+
+
+def is_time_between(time_to_test, begin_time, end_time):
+    if begin_time <= end_time:
+        # e.g. from 9:00 to 18:00.  This also covers e.g. 18:00 to 18:00
+        # which means the event happens on exactly 18:00.
+        return begin_time <= time_to_test <= end_time
+    else:
+        # e.g. from 18:00 to 9:00
+        return time_to_test >= begin_time or time_to_test <= end_time
+
+
+def is_matching_time(task, snaptime):
+    if not is_time_between(snaptime.time(), task['task_begin'], task['task_end']):
+        return False
+
+    if task['task_repeat_unit'] == 'daily':
+        return True
+
+    if task['task_repeat_unit'] == 'weekly':
+        return str(snaptime.isoweekday()) in task['task_byweekday'].split(',')
+
+    return False
+
+
+def next_run(task, last, now):
+    """
+    First minute, not before `now`, a snapshot for `task` is due given
+    the `last` automatic snapshot taken for it.
+    """
+    t = now.replace(second=0, microsecond=0)
+    if last is not None:
+        t = max(t, last + timedelta(minutes=task['task_interval']))
+
+    # Every iteration either matches or jumps to the beginning of the time
+    # window or to the next day, so a week worth of days is enough.
+    for i in range(16):
+        if is_matching_time(task, t):
+            return t
+        if is_time_between(t.time(), task['task_begin'], task['task_end']):
+            # In the time window but not in a selected weekday
+            t = datetime.combine(t.date() + timedelta(days=1), time())
+        else:
+            begin = datetime.combine(t.date(), task['task_begin'])
+            if begin <= t:
+                begin += timedelta(days=1)
+            t = begin
+    return None
+
+
+def task_key(task):
+    """
+    Snapshots are named 'foo@auto-%Y%m%d.%H%M-{expire time}' so tasks sharing
+    filesystem, retention and recursion take the very same snapshot.
+    """
+    return (
+        task['task_filesystem'],
+        f'{task["task_ret_count"]}{task["task_ret_unit"][0]}',
+        task['task_recursive'],
+    )
+
+
+def snapshot_expiration(created, retention):
+    count, unit = int(retention[:-1]), retention[-1]
+    if unit == 'h':
+        return created + timedelta(hours=count)
+    elif unit == 'd':
+        return created + timedelta(days=count)
+    elif unit == 'w':
+        return created + timedelta(days=7 * count)
+    elif unit == 'm':
+        return created + timedelta(days=int(30.436875 * count))
+    elif unit == 'y':
+        return created + timedelta(days=int(365.2425 * count))
+
+
+class AutosnapService(Service):
+    """
+    Periodic snapshot tasks scheduler.
+
+    Tasks, the last automatic snapshot of each task and a min-heap of
+    snapshots pending expiration are kept in memory so the scheduler only
+    wakes up when a snapshot is due or expires.
+    """
+
+    class Config:
+        private = True
+
+    def __init__(self, *args, **kwargs):
+        super(AutosnapService, self).__init__(*args, **kwargs)
+        self.__tasks = []
+        self.__last = {}
+        self.__expirations = []
+        self.__wakeup = asyncio.Event()
+
+    @accepts()
+    async def reload(self):
+        """
+        Reload periodic snapshot tasks and rebuild the scheduler state
+        from the snapshot index.
+        """
+        tasks = await self.middleware.call('datastore.query', 'storage.task', [('task_enabled', '=', True)])
+        recursive = tuple(f'{t["task_filesystem"]}{sep}' for t in tasks if t['task_recursive'] for sep in '@/')
+        nonrecursive = tuple(f'{t["task_filesystem"]}@' for t in tasks if not t['task_recursive'])
+        keys = set(task_key(t) for t in tasks)
+
+        last = {}
+        expirations = []
+        for name in await self.middleware.call('zfs.snapshot.names', list(set(t['task_filesystem'] for t in tasks))):
+            fs, snapname = name.split('@', 1)
+            reg = RE_AUTOSNAP.match(snapname)
+            if not reg:
+                continue
+            info = reg.groupdict()
+            created = datetime(*[int(info[i]) for i in ('year', 'month', 'day', 'hour', 'minute')])
+            retention = f'{info["retcount"]}{info["retunit"]}'
+
+            # Only expire snapshots if there is a snapshot task enabled that created it
+            if name.startswith(nonrecursive) or name.startswith(recursive):
+                expirations.append((snapshot_expiration(created, retention), name))
+
+            for key in ((fs, retention, True), (fs, retention, False)):
+                if key in keys and (key not in last or last[key] < created):
+                    last[key] = created
+        heapq.heapify(expirations)
+
+        self.__tasks = tasks
+        self.__last = last
+        self.__expirations = expirations
+        self.__wakeup.set()
+
+    def __next_due(self, now):
+        due = [self.__expirations[0][0]] if self.__expirations else []
+        for task in self.__tasks:
+            t = next_run(task, self.__last.get(task_key(task)), now)
+            if t is not None:
+                due.append(t)
+        return min(due) if due else None
+
+    @private
+    async def run(self):
+        await self.reload()
+        while True:
+            self.__wakeup.clear()
+            now = datetime.now()
+            due = self.__next_due(now)
+            timeout = None if due is None else max((due - now).total_seconds(), 0)
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), timeout)
+                continue
+            except asyncio.TimeoutError:
+                pass
+
+            now = datetime.now()
+            try:
+                await self.__take_snapshots(now)
+            except Exception:
+                self.logger.error('Failed to take periodic snapshots', exc_info=True)
+            try:
+                await self.__expire_snapshots(now)
+            except Exception:
+                self.logger.error('Failed to destroy expired snapshots', exc_info=True)
+
+    async def __take_snapshots(self, now):
+        snaptime = now.replace(second=0, microsecond=0)
+        due = set()
+        for task in self.__tasks:
+            t = next_run(task, self.__last.get(task_key(task)), now)
+            if t is not None and t <= now:
+                due.add(task_key(task))
+        if not due:
+            return
+
+        # A snapshot on a dataset covered by a recursive task with the same
+        # retention would collide with the recursive snapshot name, the
+        # recursive task takes it already.
+        for key in list(due):
+            fs, retention, recursive = key
+            if recursive:
+                continue
+            for r_fs, r_retention, r_recursive in due:
+                if r_recursive and r_retention == retention and (fs + '/').startswith(r_fs + '/'):
+                    due.remove(key)
+                    # Taken by the recursive task, it is not due anymore
+                    self.__last[key] = snaptime
+                    break
+
+        pools = await self.middleware.threaded(lambda: set(p.name for p in libzfs.ZFS().pools))
+        taken = False
+        for key in sorted(due):
+            fs, retention, recursive = key
+            # Do not keep retrying it every minute
+            self.__last[key] = snaptime
+            if fs.split('/')[0] not in pools:
+                self.logger.warn(f'Volume {fs.split("/")[0]} not imported, skipping snapshot of {fs}')
+                continue
+
+            snapname = f'{fs}@auto-{snaptime.strftime("%Y%m%d.%H%M")}-{retention}'
+            vmware = await self.middleware.call('vmware.snapshot_begin', fs, recursive, snapname)
+            try:
+                await self.middleware.threaded(self.__snapshot, fs, snapname, recursive, vmware['vmsynced'])
+            except libzfs.ZFSException as e:
+                self.logger.error(f'Failed to create snapshot {snapname!r}: {e}')
+                await self.middleware.call('mail.send', {
+                    'subject': f'Snapshot failed! ({snapname})',
+                    'text': f'\nHello,\n    Snapshot {snapname} failed with the following error: {e}',
+                    'channel': 'autosnap',
+                })
+            else:
+                taken = True
+                heapq.heappush(self.__expirations, (snapshot_expiration(snaptime, retention), snapname))
+                await self.middleware.call('zfs.snapshot.reload', fs, recursive)
+            finally:
+                if vmware['items']:
+                    await self.middleware.call('vmware.snapshot_end', vmware)
+
+        if taken and await self.middleware.call('datastore.query', 'storage.replication', [], {'count': True}):
+            await self.middleware.call('replication.schedule')
+
+    def __snapshot(self, fs, snapname, recursive, vmsynced):
+        fsopts = {}
+        if vmsynced:
+            fsopts['freenas:vmsynced'] = 'Y'
+        libzfs.ZFS().get_dataset(fs).snapshot(snapname, fsopts=fsopts, recursive=recursive)
+
+    async def __expire_snapshots(self, now):
+        expired = []
+        while self.__expirations and self.__expirations[0][0] <= now:
+            expired.append(heapq.heappop(self.__expirations)[1])
+        if not expired:
+            return
+
+        if await self.middleware.call('core.get_jobs', [
+            ('method', '=', 'replication.run'), ('state', '=', 'RUNNING'),
+        ]):
+            self.logger.debug('Replication running, postponing destroy of expired snapshots')
+            retry = now + timedelta(minutes=1)
+            for name in expired:
+                heapq.heappush(self.__expirations, (retry, name))
+            return
+
+        # Destroy of expired snapshots is recursive, so only request it on
+        # the toplevel dataset.
+        expired = set(expired)
+        batches = defaultdict(list)
+        for name in sorted(expired, key=lambda x: x.split('@')):
+            fs, snapname = name.split('@', 1)
+            parts = fs.split('/')
+            if any(f'{"/".join(parts[:i])}@{snapname}' in expired for i in range(1, len(parts))):
+                continue
+            batches[fs].append(snapname)
+
+        for fs, snapnames in batches.items():
+            # Snapshots of the same dataset are destroyed in a single run,
+            # snapshots with clones will have destruction deferred.
+            cp = await run('/sbin/zfs', 'destroy', '-r', '-d', f'{fs}@{",".join(snapnames)}', check=False)
+            if cp.returncode != 0:
+                self.logger.error(f'Failed to destroy snapshots of {fs} {snapnames!r}: {cp.stderr.decode()}')
+            await self.middleware.call('zfs.snapshot.reload', fs, True)
+
+
+def setup(middleware):
+    asyncio.ensure_future(middleware.call('autosnap.run'))
@@ -2,14 +2,152 @@ from middlewared.schema import accepts, Bool, Dict, Int, Patch, Ref, Str
 from middlewared.service import CRUDService, Service, item_method, filterable, job, private
 from middlewared.utils import Popen
 
+from collections import deque
+
 import asyncio
 import boto3
+import concurrent.futures
 import os
 import subprocess
 import re
 import tempfile
+import threading
+import time
 
+# Smallest part size allowed by S3 multipart uploads
 CHUNK_SIZE = 5 * 1024 * 1024
+# Parts transferred concurrently
+TRANSFER_WORKERS = 4
+# Bytes of parts held in memory at once
+TRANSFER_MEMORY = 64 * 1024 * 1024
+# Attempts for each part
+TRANSFER_RETRIES = 3
+
+
+class S3Transfer(object):
+    """
+    Multipart transfer of a stream to or from an S3 object, with parts
+    transferred concurrently by `workers` threads.
+
+    Reading (or writing) the stream is done by the calling thread and no
+    more parts than fit in `memory` are in flight at once.
+    """
+
+    def __init__(self, client, bucket, key, part_size=None, workers=None, memory=None, progress=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size or CHUNK_SIZE, CHUNK_SIZE)
+        self.workers = max(min(workers or TRANSFER_WORKERS, (memory or TRANSFER_MEMORY) // self.part_size), 1)
+        self.progress = progress
+        self.transferred = 0
+        self.total = None
+        self.lock = threading.Lock()
+
+    def __retry(self, method, *args, **kwargs):
+        for i in range(TRANSFER_RETRIES):
+            try:
+                return method(*args, **kwargs)
+            except Exception:
+                if i == TRANSFER_RETRIES - 1:
+                    raise
+                time.sleep(2 ** i)
+
+    def __done(self, size):
+        with self.lock:
+            self.transferred += size
+            if self.progress:
+                self.progress(self.transferred, self.total)
+
+    def __upload_part(self, upload_id, number, data):
+        resp = self.__retry(
+            self.client.upload_part,
+            Bucket=self.bucket,
+            Key=self.key,
+            PartNumber=number,
+            UploadId=upload_id,
+            ContentLength=len(data),
+            Body=data,
+        )
+        self.__done(len(data))
+        return {'ETag': resp['ETag'], 'PartNumber': number}
+
+    def __download_part(self, start, end):
+        def get():
+            return self.client.get_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Range=f'bytes={start}-{end - 1}',
+            )['Body'].read()
+        data = self.__retry(get)
+        if len(data) != end - start:
+            raise ValueError(f'Short read of {self.key} at {start}: {len(data)} of {end - start} bytes')
+        self.__done(len(data))
+        return data
+
+    def upload(self, f):
+        """
+        Upload the contents of file object `f` until end of file.
+        """
+        mp = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+        parts = []
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+                pending = set()
+                number = 1
+                eof = False
+                while not eof:
+                    while len(pending) >= self.workers:
+                        done, pending = concurrent.futures.wait(
+                            pending, return_when=concurrent.futures.FIRST_COMPLETED,
+                        )
+                        parts.extend(i.result() for i in done)
+
+                    data = bytearray()
+                    while len(data) < self.part_size:
+                        read = f.read(self.part_size - len(data))
+                        if not read:
+                            eof = True
+                            break
+                        data += read
+                    # An empty object still takes a single empty part
+                    if data or number == 1:
+                        pending.add(executor.submit(self.__upload_part, mp['UploadId'], number, bytes(data)))
+                        number += 1
+                parts.extend(i.result() for i in concurrent.futures.as_completed(pending))
+
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=mp['UploadId'],
+                MultipartUpload={
+                    'Parts': sorted(parts, key=lambda i: i['PartNumber']),
+                },
+            )
+        except Exception:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=mp['UploadId'])
+            raise
+
+    def download(self, f):
+        """
+        Download the object to file object `f`, by ranges written in order.
+        """
+        self.total = self.client.head_object(Bucket=self.bucket, Key=self.key)['ContentLength']
+        ranges = deque(
+            (start, min(start + self.part_size, self.total))
+            for start in range(0, self.total, self.part_size)
+        )
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            try:
+                while ranges or pending:
+                    while ranges and len(pending) < self.workers:
+                        pending.append(executor.submit(self.__download_part, *ranges.popleft()))
+                    f.write(pending.popleft().result())
+            except Exception:
+                for i in pending:
+                    i.cancel()
+                raise
 
 
 class BackupCredentialService(CRUDService):
@@ -178,20 +316,22 @@ class BackupS3Service(Service):
         namespace = 'backup.s3'
 
     @private
-    async def get_client(self, id):
-        credential = await self.middleware.call('datastore.query', 'system.cloudcredentials', [('id', '=', id)], {'get': True})
+    def get_client(self, id):
+        credential = self.middleware.call_sync('datastore.query', 'system.cloudcredentials', [('id', '=', id)], {'get': True})
 
         client = boto3.client(
             's3',
             aws_access_key_id=credential['attributes'].get('access_key'),
             aws_secret_access_key=credential['attributes'].get('secret_key'),
+            # S3 compatible services other than AWS
+            endpoint_url=credential['attributes'].get('endpoint') or None,
         )
         return client
 
     @accepts(Int('id'))
-    async def get_buckets(self, id):
+    def get_buckets(self, id):
         """Returns buckets from a given S3 credential."""
-        client = await self.get_client(id)
+        client = self.get_client(id)
         buckets = []
         for bucket in client.list_buckets()['Buckets']:
             buckets.append({
@@ -202,11 +342,11 @@ class BackupS3Service(Service):
         return buckets
 
     @accepts(Int('id'), Str('name'))
-    async def get_bucket_location(self, id, name):
+    def get_bucket_location(self, id, name):
         """
         Returns bucket `name` location (region) from credential `id`.
         """
-        client = await self.get_client(id)
+        client = self.get_client(id)
         response = client.get_bucket_location(Bucket=name)
         return response['LocationConstraint']
 
@@ -228,6 +368,9 @@ region = {region}
                 secret_key=credential['attributes']['secret_key'],
                 region=backup['attributes']['region'] or '',
             ))
+            if credential['attributes'].get('endpoint'):
+                # S3 compatible services other than AWS
+                f.write('endpoint = {}\n'.format(credential['attributes']['endpoint']))
             f.flush()
 
             args = [
@@ -276,73 +419,52 @@ region = {region}
                 raise ValueError('rclone failed: {}'.format(check_task.result()))
             return True
 
-    @private
-    async def put(self, backup, filename, read_fd):
-        client = await self.get_client(backup['id'])
-        folder = backup['attributes']['folder'] or ''
-        key = os.path.join(folder, filename)
-        parts = []
-        idx = 1
-
-        try:
-            with os.fdopen(read_fd, 'rb') as f:
-                mp = client.create_multipart_upload(
-                    Bucket=backup['attributes']['bucket'],
-                    Key=key
-                )
+    def _transfer(self, backup, filename, job=None, options=None):
+        options = options or {}
 
-                while True:
-                    chunk = f.read(CHUNK_SIZE)
-                    if chunk == b'':
-                        break
+        def progress(transferred, total):
+            if total:
+                percent = transferred * 100 / total
+                description = f'{transferred} of {total} bytes transferred'
+            else:
+                percent = None
+                description = f'{transferred} bytes transferred'
+            self.middleware.loop.call_soon_threadsafe(
+                job.set_progress, percent, description, {'transferred': transferred, 'total': total},
+            )
 
-                    resp = client.upload_part(
-                        Bucket=backup['attributes']['bucket'],
-                        Key=key,
-                        PartNumber=idx,
-                        UploadId=mp['UploadId'],
-                        ContentLength=CHUNK_SIZE,
-                        Body=chunk
-                    )
-
-                    parts.append({
-                        'ETag': resp['ETag'],
-                        'PartNumber': idx
-                    })
-
-                    idx += 1
-
-                client.complete_multipart_upload(
-                    Bucket=backup['attributes']['bucket'],
-                    Key=key,
-                    UploadId=mp['UploadId'],
-                    MultipartUpload={
-                        'Parts': parts
-                    }
-                )
-        finally:
-            pass
+        return S3Transfer(
+            self.get_client(backup['credential']['id']),
+            backup['attributes']['bucket'],
+            os.path.join(backup['attributes']['folder'] or '', filename),
+            part_size=options.get('part_size'),
+            workers=options.get('workers'),
+            memory=options.get('memory'),
+            progress=progress if job else None,
+        )
 
     @private
-    async def get(self, backup, filename, write_fd):
-        client = await self.get_client(backup['id'])
-        folder = backup['attributes']['folder'] or ''
-        key = os.path.join(folder, filename)
-        obj = client.get_object(
-            Bucket=backup['attributes']['bucket'],
-            Key=key
-        )
+    def put(self, backup, filename, read_fd, job=None, options=None):
+        """
+        Upload the stream of `read_fd` as `filename` in the backup folder.
+
+        `options` may set the `part_size`, the number of parallel `workers`
+        and the `memory` used for parts in flight.
+        """
+        with os.fdopen(read_fd, 'rb') as f:
+            self._transfer(backup, filename, job, options).upload(f)
 
+    @private
+    def get(self, backup, filename, write_fd, job=None, options=None):
+        """
+        Download `filename` of the backup folder to `write_fd`.
+        """
         with os.fdopen(write_fd, 'wb') as f:
-            while True:
-                chunk = obj['Body'].read(CHUNK_SIZE)
-                if chunk == b'':
-                    break
-                f.write(chunk)
+            self._transfer(backup, filename, job, options).download(f)
 
     @private
-    async def ls(self, cred_id, bucket, path):
-        client = await self.get_client(cred_id)
+    def ls(self, cred_id, bucket, path):
+        client = self.get_client(cred_id)
         obj = client.list_objects_v2(
             Bucket=bucket,
             Prefix=path,
@@ -1,8 +1,14 @@
+from collections import defaultdict, OrderedDict
+from middlewared.client import ejson as json
 from middlewared.service import Service, private
+from middlewared.utils import filter_list
 from middlewared.schema import accepts, Any, Bool, Dict, Int, List, Ref, Str
 
+import asyncio
+import copy
 import os
 import sys
+import threading
 
 sys.path.append('/usr/local/www')
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'freenasUI.settings')
@@ -13,7 +19,7 @@ if not apps.ready:
     django.setup()
 
 from django.apps import apps
-from django.db import connection
+from django.db import connection, transaction
 from django.db.models import Q
 from django.db.models.fields.related import ForeignKey
 
@@ -23,11 +29,140 @@ from django.db.models.fields.related import ForeignKey
 from freenasUI.freeadmin.sqlite3_ha import base as sqlite3_ha_base
 sqlite3_ha_base.execute_sync = True
 
-from middlewared.utils import django_modelobj_serialize
+from freenasUI.contrib.IPAddressField import (
+    IPAddressField, IP4AddressField, IP6AddressField
+)
+
+# Keep it well below SQLITE_MAX_VARIABLE_NUMBER
+IN_BATCH_SIZE = 500
+# Number of distinct queries cached per table
+QUERY_CACHE_SIZE = 32
+
+
+def serialize_objects(model, objs, field_prefix=None):
+    """
+    Serialize model instances `objs` the same way `django_modelobj_serialize`
+    does, fetching the rows referenced by each foreign key with batched `IN`
+    queries instead of a query per row.
+    """
+    related = {}
+    for field in model._meta.fields:
+        if not isinstance(field, ForeignKey):
+            continue
+        ids = list(set(getattr(i, field.attname) for i in objs) - {None})
+        rows = {}
+        for i in range(0, len(ids), IN_BATCH_SIZE):
+            rows.update(field.rel.model.objects.in_bulk(ids[i:i + IN_BATCH_SIZE]))
+        keys = list(rows.keys())
+        related[field.name] = dict(zip(keys, serialize_objects(field.rel.model, [rows[k] for k in keys])))
+
+    result = []
+    for obj in objs:
+        data = {}
+        for field in model._meta.fields:
+            name = field.name
+            if field_prefix and name.startswith(field_prefix):
+                name = name[len(field_prefix):]
+            if isinstance(field, ForeignKey):
+                # If foreign key does not exist set it to None
+                data[name] = related[field.name].get(getattr(obj, field.attname))
+            elif isinstance(field, (
+                IPAddressField, IP4AddressField, IP6AddressField
+            )):
+                data[name] = str(getattr(obj, field.name))
+            else:
+                data[name] = getattr(obj, field.name)
+        result.append(data)
+    return result
+
+
+class QueryCache(object):
+    """
+    Serialized results of queries per table.
+
+    Results of a table are dropped when it, or any table it references,
+    is written through the datastore. The database file is also written by
+    other processes (e.g. django) so any change of its mtime or size drops
+    everything.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.validator = None
+        self.tables = defaultdict(OrderedDict)
+        self.dependents = None
+        self.lock = threading.Lock()
+
+    def __stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def token(self):
+        """
+        Returns the state of the database to be given to `set`.
+        """
+        validator = self.__stat()
+        with self.lock:
+            if validator != self.validator:
+                self.tables.clear()
+                self.validator = validator
+        return validator
+
+    def get(self, model, key):
+        self.token()
+        with self.lock:
+            entries = self.tables[model]
+            if key in entries:
+                entries.move_to_end(key)
+                return entries[key]
+
+    def set(self, model, key, value, token):
+        """
+        Cache `value` unless the database changed since `token` was taken.
+        """
+        if token is None or self.__stat() != token:
+            return
+        with self.lock:
+            if token != self.validator:
+                return
+            entries = self.tables[model]
+            entries[key] = value
+            while len(entries) > QUERY_CACHE_SIZE:
+                entries.popitem(last=False)
+
+    def invalidate(self, model=None):
+        with self.lock:
+            if model is None:
+                self.tables.clear()
+                return
+
+            if self.dependents is None:
+                self.dependents = defaultdict(set)
+                for m in apps.get_models():
+                    for field in m._meta.fields:
+                        if isinstance(field, ForeignKey):
+                            self.dependents[field.rel.model].add(m)
+
+            stack = [model]
+            seen = set()
+            while stack:
+                m = stack.pop()
+                if m in seen:
+                    continue
+                seen.add(m)
+                self.tables.pop(m, None)
+                stack.extend(self.dependents[m])
 
 
 class DatastoreService(Service):
 
+    def __init__(self, *args, **kwargs):
+        super(DatastoreService, self).__init__(*args, **kwargs)
+        self.__cache = QueryCache(connection.settings_dict['NAME'])
+
     def _filters_to_queryset(self, filters, field_prefix=None):
         opmap = {
             '=': 'exact',
@@ -37,6 +172,8 @@ class DatastoreService(Service):
             '<': 'lt',
             '<=': 'lte',
             '~': 'regex',
+            '^': 'startswith',
+            '$': 'endswith',
             'in': 'in',
             'nin': 'in',
         }
@@ -79,10 +216,8 @@ class DatastoreService(Service):
         app, model = name.split('.', 1)
         return apps.get_model(app, model)
 
-    async def __queryset_serialize(self, qs, extend=None, field_prefix=None):
-        result = await self.middleware.threaded(lambda: list(qs))
-        for i in result:
-            yield await django_modelobj_serialize(self.middleware, i, extend=extend, field_prefix=field_prefix)
+    def __queryset_serialize(self, qs, field_prefix=None):
+        return serialize_objects(qs.model, list(qs), field_prefix=field_prefix)
 
     @accepts(
         Str('name'),
@@ -95,6 +230,9 @@ class DatastoreService(Service):
             Bool('count'),
             Bool('get'),
             Str('prefix'),
+            Int('offset'),
+            Int('limit'),
+            List('select'),
             register=True,
         ),
     )
@@ -107,7 +245,7 @@ class DatastoreService(Service):
             simple_filter: '[' attribute_name, OPERATOR, value ']'
             conjunction: '[' CONJUNTION, '[' simple_filter (',' simple_filter)* ']]'
 
-            OPERATOR: ('=' | '!=' | '>' | '>=' | '<' | '<=' | '~' | 'in' | 'nin')
+            OPERATOR: ('=' | '!=' | '>' | '>=' | '<' | '<=' | '~' | '^' | '$' | 'in' | 'nin')
             CONJUNCTION: 'OR'
 
         e.g.
@@ -136,6 +274,31 @@ class DatastoreService(Service):
             # which might happen with "prefix"
             options = options.copy()
 
+        extend = options.pop('extend', None)
+        select = options.pop('select', None)
+        key = json.dumps([filters, options], sort_keys=True, default=str)
+        cached = self.__cache.get(model, key)
+        if cached is None:
+            token = self.__cache.token()
+            cached = await self.middleware.threaded(self.__query, model, filters, options)
+            self.__cache.set(model, key, cached, token)
+
+        if options.get('count') is True:
+            return cached
+
+        result = [copy.deepcopy(i) for i in cached]
+        if extend:
+            result = list(await asyncio.gather(*[self.middleware.call(extend, i) for i in result]))
+
+        if select:
+            result = filter_list(result, None, {'select': select})
+
+        if options.get('get') is True:
+            return result[0]
+
+        return result
+
+    def __query(self, model, filters, options):
         qs = model.objects.all()
 
         extra = options.get('extra')
@@ -162,16 +325,14 @@ class DatastoreService(Service):
         if options.get('count') is True:
             return qs.count()
 
-        result = []
-        async for i in self.__queryset_serialize(
-            qs, extend=options.get('extend'), field_prefix=options.get('prefix')
-        ):
-            result.append(i)
+        offset = options.get('offset') or 0
+        limit = options.get('limit')
+        if options.get('get') is True and not limit:
+            limit = 1
+        if offset or limit:
+            qs = qs[offset:offset + limit if limit else None]
 
-        if options.get('get') is True:
-            return result[0]
-
-        return result
+        return self.__queryset_serialize(qs, field_prefix=prefix)
 
     @accepts(Str('name'), Ref('query-options'))
     async def config(self, name, options=None):
@@ -185,30 +346,18 @@ class DatastoreService(Service):
         options['get'] = True
         return await self.query(name, None, options)
 
-    @accepts(Str('name'), Dict('data', additional_attrs=True))
-    async def insert(self, name, data):
-        """
-        Insert a new entry to `name`.
-        """
-        model = self.__get_model(name)
+    def __insert(self, model, data):
         for field in model._meta.fields:
             if field.name not in data:
                 continue
             if isinstance(field, ForeignKey):
                 data[field.name] = field.rel.to.objects.get(pk=data[field.name])
         obj = model(**data)
-        await self.middleware.threaded(obj.save)
+        obj.save()
         return obj.pk
 
-    @accepts(Str('name'), Any('id'), Dict('data', additional_attrs=True), Dict('options', Str('prefix')))
-    async def update(self, name, id, data, options=None):
-        """
-        Update an entry `id` in `name`.
-        """
-        options = options or {}
-        prefix = options.get('prefix')
-        model = self.__get_model(name)
-        obj = await self.middleware.threaded(lambda oid: model.objects.get(pk=oid), id)
+    def __update(self, model, id, data, prefix=None):
+        obj = model.objects.get(pk=id)
         for field in model._meta.fields:
             if prefix:
                 name = field.name.replace(prefix, '')
@@ -222,18 +371,78 @@ class DatastoreService(Service):
             if prefix:
                 k = f'{prefix}{k}'
             setattr(obj, k, v)
-        await self.middleware.threaded(obj.save)
+        obj.save()
         return obj.pk
 
+    def __delete(self, model, id):
+        model.objects.get(pk=id).delete()
+        return id
+
+    @accepts(Str('name'), Dict('data', additional_attrs=True))
+    async def insert(self, name, data):
+        """
+        Insert a new entry to `name`.
+        """
+        model = self.__get_model(name)
+        try:
+            return await self.middleware.threaded(self.__insert, model, data)
+        finally:
+            self.__cache.invalidate(model)
+
+    @accepts(Str('name'), Any('id'), Dict('data', additional_attrs=True), Dict('options', Str('prefix')))
+    async def update(self, name, id, data, options=None):
+        """
+        Update an entry `id` in `name`.
+        """
+        options = options or {}
+        model = self.__get_model(name)
+        try:
+            return await self.middleware.threaded(self.__update, model, id, data, options.get('prefix'))
+        finally:
+            self.__cache.invalidate(model)
+
     @accepts(Str('name'), Any('id'))
     async def delete(self, name, id):
         """
         Delete an entry `id` in `name`.
         """
         model = self.__get_model(name)
-        await self.middleware.threaded(lambda oid: model.objects.get(pk=oid).delete(), id)
+        try:
+            await self.middleware.threaded(self.__delete, model, id)
+        finally:
+            self.__cache.invalidate(model)
         return True
 
+    @private
+    @accepts(Str('name'), List('operations'))
+    def batch(self, name, operations):
+        """
+        Run a list of `operations` on `name` within a single transaction.
+
+        Every operation is one of:
+          - ["insert", data]
+          - ["update", id, data]
+          - ["delete", id]
+
+        Returns the id of the entry of every operation.
+        """
+        model = self.__get_model(name)
+        methods = {
+            'insert': self.__insert,
+            'update': self.__update,
+            'delete': self.__delete,
+        }
+        rv = []
+        try:
+            with transaction.atomic():
+                for op, *args in operations:
+                    if op not in methods:
+                        raise ValueError(f'Invalid operation: {op}')
+                    rv.append(methods[op](model, *args))
+        finally:
+            self.__cache.invalidate(model)
+        return rv
+
     @private
     def sql(self, query, params=None):
         cursor = connection.cursor()
@@ -246,8 +455,28 @@ class DatastoreService(Service):
             rv = cursor.fetchall()
         finally:
             cursor.close()
+            self.__cache.invalidate()
         return rv
 
+    @private
+    @accepts(List('queries'))
+    def sql_batch(self, queries):
+        """
+        Receives a list of (query, params) replicated from the other node
+        and executes them in order within a transaction.
+        """
+        with transaction.atomic():
+            cursor = connection.cursor()
+            try:
+                for query, params in queries:
+                    if params is None:
+                        cursor.executelocal(query)
+                    else:
+                        cursor.executelocal(query, params)
+            finally:
+                cursor.close()
+                self.__cache.invalidate()
+
     @private
     @accepts(List('queries'))
     def restore(self, queries):
@@ -255,7 +484,10 @@ class DatastoreService(Service):
         Receives a list of SQL queries (usually a database dump)
         and executes it within a transaction.
         """
-        return connection.dump_recv(queries)
+        try:
+            return connection.dump_recv(queries)
+        finally:
+            self.__cache.invalidate()
 
     @private
     @accepts()
@@ -266,3 +498,46 @@ class DatastoreService(Service):
         # FIXME: This could return a few hundred KB of data,
         # we need to investigate a way of doing that in chunks.
         return connection.dump()
+
+    @private
+    @accepts()
+    def sync_status(self):
+        """
+        Returns the epoch and version of the other node this node was last
+        synced with.
+        """
+        connection.ha_track()
+        return connection.ha_synced()
+
+    @private
+    @accepts(Str('epoch'), Int('version'))
+    def sync_ack(self, epoch, version):
+        connection.ha_synced(epoch, version)
+
+    @private
+    @accepts()
+    def sync(self):
+        """
+        Bring the database of the other node up to date.
+
+        Only rows changed since its last sync are sent, in chunks, unless
+        the history of changes since then was lost in which case the whole
+        database is sent.
+        """
+        connection.ha_track()
+        remote = self.middleware.call_sync('failover.call_remote', 'datastore.sync_status')
+        epoch, version = connection.ha_version()
+
+        # Anything journaled is part of the changes, keep new queries from
+        # being journaled meanwhile.
+        with sqlite3_ha_base.Journal() as j:
+            full = not connection.ha_can_sync(remote['epoch'], remote['version'])
+            if full:
+                self.middleware.call_sync('failover.call_remote', 'datastore.restore', [connection.dump()])
+            else:
+                for queries in connection.ha_changes(remote['version'], version):
+                    self.middleware.call_sync('failover.call_remote', 'datastore.sql_batch', [queries])
+            self.middleware.call_sync('failover.call_remote', 'datastore.sync_ack', [epoch, version])
+            j.clear()
+
+        return {'full': full, 'epoch': epoch, 'version': version}
@@ -10,7 +10,7 @@ import sys
 import sysctl
 
 from bsd import geom
-from middlewared.schema import accepts, Str
+from middlewared.schema import accepts, List, Str
 from middlewared.service import filterable, job, private, CallError, CRUDService
 from middlewared.utils import Popen, run
 
@@ -20,17 +20,30 @@ if '/usr/local/www' not in sys.path:
     sys.path.insert(0, '/usr/local/www')
 from freenasUI.services.utils import SmartAlert
 
+# Seconds to wait for further devfs events before syncing the disks
+# notified about, attaching an enclosure creates all of its disks at once.
+DEVFS_SETTLE = 1
 DISK_EXPIRECACHE_DAYS = 7
 MIRROR_MAX = 5
 RE_DA = re.compile('^da[0-9]+$')
 RE_DD = re.compile(r'^(\d+) bytes transferred .*\((\d+) bytes')
 RE_DSKNAME = re.compile(r'^([a-z]+)([0-9]+)$')
+RE_IDENTIFIER = re.compile(r'^\{(?P<type>.+?)\}(?P<value>.+)$')
 RE_ISDISK = re.compile(r'^(da|ada|vtbd|mfid|nvd)[0-9]+$')
 RE_MPATH_NAME = re.compile(r'[a-z]+(\d+)')
 
 
 class DiskService(CRUDService):
 
+    def __init__(self, *args, **kwargs):
+        super(DiskService, self).__init__(*args, **kwargs)
+        # Identity of every device, forgotten as soon as devfs notifies
+        # about the device.
+        self.__identities = {}
+        self.__devfs_pending = set()
+        self.__devfs_handle = None
+        self.__devfs_lock = asyncio.Lock()
+
     @filterable
     async def query(self, filters=None, options=None):
         if filters is None:
@@ -116,9 +129,10 @@ class DiskService(CRUDService):
             units[int(unit)] = int(port)
         return units
 
-    async def __get_smartctl_args(self, devname):
+    async def __get_smartctl_args(self, devname, camcontrol=None, twcli=None):
         args = [f'/dev/{devname}']
-        camcontrol = await self.__camcontrol_list()
+        if camcontrol is None:
+            camcontrol = await self.__camcontrol_list()
         info = camcontrol.get(devname)
         if info is not None:
             if info.get('drv') == 'rr274x_3x':
@@ -151,33 +165,88 @@ class DiskService(CRUDService):
                     'cciss,%d' % (info['channel'], )
                 ]
             elif info.get('drv') == 'twa':
-                twcli = await self.__get_twcli(info['controller'])
+                if twcli is None:
+                    twcli = {}
+                if info['controller'] not in twcli:
+                    twcli[info['controller']] = await self.__get_twcli(info['controller'])
                 args = [
                     '/dev/%s%d' % (info['drv'], info['controller']),
                     '-d',
-                    '3ware,%d' % (twcli.get(info['channel'], -1), )
+                    '3ware,%d' % (twcli[info['controller']].get(info['channel'], -1), )
                 ]
         return args
 
+    @private
+    async def smartctl_args(self, names):
+        """
+        Returns the smartctl arguments for every device of `names`, listing
+        CAM devices only once.
+        """
+        camcontrol = await self.__camcontrol_list()
+        twcli = {}
+        return {name: await self.__get_smartctl_args(name, camcontrol, twcli) for name in names}
+
     @private
     async def toggle_smart_off(self, devname):
         args = await self.__get_smartctl_args(devname)
         await run('/usr/local/sbin/smartctl', '--smart=off', *args, check=False)
+        await self.middleware.call('smart.forget', devname)
 
     @private
     async def toggle_smart_on(self, devname):
         args = await self.__get_smartctl_args(devname)
         await run('/usr/local/sbin/smartctl', '--smart=on', *args, check=False)
+        await self.middleware.call('smart.forget', devname)
 
     @private
     async def serial_from_device(self, name):
-        args = await self.__get_smartctl_args(name)
-        p1 = await Popen(['smartctl', '-i'] + args, stdout=subprocess.PIPE)
-        output = (await p1.communicate())[0].decode()
-        search = re.search(r'Serial Number:\s+(?P<serial>.+)', output, re.I)
-        if search:
-            return search.group('serial')
-        return None
+        return await self.middleware.call('smart.serial', name)
+
+    async def __forget(self, name):
+        self.__identities.pop(name, None)
+        await self.middleware.call('smart.forget', name)
+
+    async def __identity(self, name, serial=None):
+        """
+        Serial, lunid, size and rotation rate of disk `name` as of the last
+        geom.scan, cached until a devfs event is seen for the device.
+
+        smartctl is only used for the serial if geom does not know it and
+        no `serial` was previously stored for the disk.
+        """
+        identity = self.__identities.get(name)
+        if identity is None:
+            identity = {'serial': '', 'lunid': '', 'size': None, 'rotationrate': None}
+            g = geom.geom_by_name('DISK', name)
+            if g:
+                identity.update({
+                    'serial': g.provider.config.get('ident') or '',
+                    'lunid': g.provider.config.get('lunid') or '',
+                    'size': g.provider.mediasize or None,
+                    'rotationrate': g.provider.config.get('rotationrate'),
+                })
+            if not identity['serial']:
+                identity['serial'] = serial or await self.serial_from_device(name) or ''
+            self.__identities[name] = identity
+        return identity
+
+    def __disk_attrs(self, disk, name, identity):
+        disk['disk_name'] = name
+        if identity['serial']:
+            disk['disk_serial'] = identity['serial']
+        if identity['size']:
+            disk['disk_size'] = str(identity['size'])
+        reg = RE_DSKNAME.search(name)
+        if reg:
+            disk['disk_subsystem'] = reg.group(1)
+            disk['disk_number'] = int(reg.group(2))
+
+    async def __is_backup_node(self):
+        return (
+            not await self.middleware.call('system.is_freenas') and
+            await self.middleware.call('notifier.failover_licensed') and
+            await self.middleware.call('notifier.failover_status') == 'BACKUP'
+        )
 
     @private
     @accepts(Str('name'))
@@ -197,7 +266,9 @@ class DiskService(CRUDService):
             str - identifier
         """
         await self.middleware.threaded(geom.scan)
+        return await self.__device_to_identifier(name)
 
+    async def __device_to_identifier(self, name):
         g = geom.geom_by_name('DISK', name)
         if g and g.provider.config.get('ident'):
             serial = g.provider.config['ident']
@@ -229,6 +300,70 @@ class DiskService(CRUDService):
 
         return ''
 
+    async def __identifier_to_device(self, ident):
+        """
+        Same as notifier.identifier_to_device using the last geom.scan
+        instead of parsing the geom XML for every identifier.
+        """
+        reg = RE_IDENTIFIER.match(ident or '')
+        if not reg:
+            return None
+        _type, value = reg.group('type'), reg.group('value')
+
+        if _type == 'uuid':
+            klass = geom.class_by_name('PART')
+            for g in (klass.geoms if klass else []):
+                if g.name.startswith('label'):
+                    continue
+                for p in g.providers:
+                    if p.config.get('rawuuid') == value:
+                        return g.name
+        elif _type == 'label':
+            klass = geom.class_by_name('LABEL')
+            for g in (klass.geoms if klass else []):
+                for p in g.providers:
+                    if p.name == value:
+                        return g.name
+        elif _type in ('serial', 'serial_lunid'):
+            klass = geom.class_by_name('DISK')
+            geoms = klass.geoms if klass else []
+            for g in geoms:
+                serial = g.provider.config.get('ident') or ''
+                if _type == 'serial_lunid':
+                    serial = f'{serial}_{g.provider.config.get("lunid")}'
+                if serial == value:
+                    return g.name
+            if _type == 'serial':
+                for g in geoms:
+                    if ' '.join((g.provider.config.get('ident') or '').split()) == ' '.join(value.split()):
+                        return g.name
+                # Serial from smartctl is only used as identifier when geom
+                # does not know it.
+                records = await self.middleware.call(
+                    'smart.probe', [g.name for g in geoms if not g.provider.config.get('ident')],
+                )
+                for name, record in sorted(records.items()):
+                    if record and record['serial'] == value:
+                        return name
+        elif _type == 'devicename':
+            if geom.geom_by_name('DEV', value):
+                return value
+        return None
+
+    async def __write(self, original, disks, deleted=None):
+        """
+        Write the rows of `disks` which differ from `original` and delete
+        `deleted` in a single transaction.
+        """
+        operations = [['delete', identifier] for identifier in deleted or []]
+        for identifier, disk in disks.items():
+            if identifier not in original:
+                operations.append(['insert', disk])
+            elif disk != original[identifier]:
+                operations.append(['update', identifier, disk])
+        if operations:
+            await self.middleware.call('datastore.batch', 'storage.disk', operations)
+
     @private
     @accepts(Str('name'))
     async def sync(self, name):
@@ -236,56 +371,99 @@ class DiskService(CRUDService):
         Syncs a disk `name` with the database cache.
         """
         # Skip sync disks on backup node
-        if (
-            not await self.middleware.call('system.is_freenas') and
-            await self.middleware.call('notifier.failover_licensed') and
-            await self.middleware.call('notifier.failover_status') == 'BACKUP'
-        ):
+        if await self.__is_backup_node():
             return
 
         # Do not sync geom classes like multipath/hast/etc
         if name.find("/") != -1:
             return
 
-        disks = list((await self.middleware.call('device.get_info', 'DISK')).keys())
+        sys_disks = list((await self.middleware.call('device.get_info', 'DISK')).keys())
 
         # Abort if the disk is not recognized as an available disk
-        if name not in disks:
+        if name not in sys_disks:
             return
-        ident = await self.device_to_identifier(name)
-        qs = await self.middleware.call('datastore.query', 'storage.disk', [('disk_identifier', '=', ident)], {'order_by': ['disk_expiretime']})
-        if ident and qs:
-            disk = qs[0]
-            new = False
-        else:
-            new = True
-            qs = await self.middleware.call('datastore.query', 'storage.disk', [('disk_name', '=', name)])
-            for i in qs:
-                i['disk_expiretime'] = datetime.utcnow() + timedelta(days=DISK_EXPIRECACHE_DAYS)
-                await self.middleware.call('datastore.update', 'storage.disk', i['disk_identifier'], i)
-            disk = {'disk_identifier': ident}
-        disk.update({'disk_name': name, 'disk_expiretime': None})
+        await self.__sync_devices([name], sys_disks)
 
-        await self.middleware.threaded(geom.scan)
-        g = geom.geom_by_name('DISK', name)
-        if g:
-            if g.provider.config['ident']:
-                disk['disk_serial'] = g.provider.config['ident']
-            if g.provider.mediasize:
-                disk['disk_size'] = g.provider.mediasize
-        if not disk.get('disk_serial'):
-            disk['disk_serial'] = await self.serial_from_device(name) or ''
-        reg = RE_DSKNAME.search(name)
-        if reg:
-            disk['disk_subsystem'] = reg.group(1)
-            disk['disk_number'] = int(reg.group(2))
-        if not new:
-            await self.middleware.call('datastore.update', 'storage.disk', disk['disk_identifier'], disk)
-        else:
-            disk['disk_identifier'] = await self.middleware.call('datastore.insert', 'storage.disk', disk)
+    @private
+    @accepts(List('names', items=[Str('name')]))
+    async def sync_devices(self, names):
+        """
+        Syncs disks `names` with the database cache.
 
-        # FIXME: use a truenas middleware plugin
-        await self.middleware.call('notifier.sync_disk_extra', disk['disk_identifier'], False)
+        Disks which are present are added or updated and disks which are
+        gone are marked to expire. Unlike `sync_all` no other disk is probed.
+        """
+        # Skip sync disks on backup node
+        if await self.__is_backup_node():
+            return
+
+        sys_disks = list((await self.middleware.call('device.get_info', 'DISK')).keys())
+        await self.__sync_devices([name for name in names if name.find('/') == -1], sys_disks)
+
+    async def __sync_devices(self, names, sys_disks):
+        # device.get_info has just scanned geom
+        qs = await self.middleware.call('datastore.query', 'storage.disk', [], {'order_by': ['disk_expiretime']})
+        rows = {disk['disk_identifier']: disk for disk in qs}
+        original = {identifier: dict(disk) for identifier, disk in rows.items()}
+        active = {disk['disk_name']: disk for disk in qs if disk['disk_expiretime'] is None}
+        expiretime = datetime.utcnow() + timedelta(days=DISK_EXPIRECACHE_DAYS)
+        present = [name for name in names if name in sys_disks]
+        disks = {}
+        extra = []
+
+        for name in names:
+            if name in present or name not in active:
+                continue
+            disk = active.pop(name)
+            # Identifier may still be reachable through another device
+            # (e.g. the other path of a multipath disk)
+            other = await self.__identifier_to_device(disk['disk_identifier'])
+            if other and other in sys_disks and other not in active and other not in names:
+                disk['disk_name'] = other
+                active[other] = disk
+            else:
+                disk['disk_expiretime'] = expiretime
+            disks[disk['disk_identifier']] = disk
+
+        # Serials of the other disks to tell whether a new device is just
+        # another path to one of them.
+        serials = {}
+        for other, disk in active.items():
+            if other in sys_disks and other not in present:
+                identity = await self.__identity(other, disk['disk_serial'])
+                if identity['serial']:
+                    serials[identity['serial'] + identity['lunid']] = other
+
+        for name in present:
+            identity = await self.__identity(name)
+            serial = identity['serial'] + identity['lunid']
+            if serial:
+                if serial in serials:
+                    # Probably dealing with multipath here, do not add another
+                    continue
+                serials[serial] = name
+
+            identifier = await self.__device_to_identifier(name)
+            if not identifier:
+                continue
+            # Disks previously known by this name are gone
+            stale = active.get(name)
+            if stale and stale['disk_identifier'] != identifier:
+                stale['disk_expiretime'] = expiretime
+                disks[stale['disk_identifier']] = stale
+
+            disk = rows.get(identifier) or {'disk_identifier': identifier}
+            disk['disk_expiretime'] = None
+            self.__disk_attrs(disk, name, identity)
+            disks[identifier] = disk
+            extra.append((identifier, identifier not in rows))
+
+        await self.__write(original, disks)
+
+        for identifier, add in extra:
+            # FIXME: use a truenas middleware plugin
+            await self.middleware.call('notifier.sync_disk_extra', identifier, add)
 
     @private
     @accepts()
@@ -294,102 +472,110 @@ class DiskService(CRUDService):
         Synchronyze all disks with the cache in database.
         """
         # Skip sync disks on backup node
-        if (
-            not await self.middleware.call('system.is_freenas') and
-            await self.middleware.call('notifier.failover_licensed') and
-            await self.middleware.call('notifier.failover_status') == 'BACKUP'
-        ):
+        if await self.__is_backup_node():
             return
 
         sys_disks = list((await self.middleware.call('device.get_info', 'DISK')).keys())
-
+        for name in list(self.__identities):
+            if name not in sys_disks:
+                await self.__forget(name)
+
+        # device.get_info has just scanned geom
+        qs = await self.middleware.call('datastore.query', 'storage.disk', [], {'order_by': ['disk_expiretime']})
+        rows = {disk['disk_identifier']: disk for disk in qs}
+        original = {identifier: dict(disk) for identifier, disk in rows.items()}
+        disks = {}
+        deleted = []
+        extra = []
         seen_disks = {}
-        serials = []
-        await self.middleware.threaded(geom.scan)
-        for disk in (await self.middleware.call('datastore.query', 'storage.disk', [], {'order_by': ['disk_expiretime']})):
+        serials = set()
+        for disk in qs:
 
-            name = await self.middleware.call('notifier.identifier_to_device', disk['disk_identifier'])
+            name = await self.__identifier_to_device(disk['disk_identifier'])
             if not name or name in seen_disks:
                 # If we cant translate the indentifier to a device, give up
                 # If name has already been seen once then we are probably
                 # dealing with with multipath here
                 if not disk['disk_expiretime']:
                     disk['disk_expiretime'] = datetime.utcnow() + timedelta(days=DISK_EXPIRECACHE_DAYS)
-                    await self.middleware.call('datastore.update', 'storage.disk', disk['disk_identifier'], disk)
                 elif disk['disk_expiretime'] < datetime.utcnow():
                     # Disk expire time has surpassed, go ahead and remove it
-                    await self.middleware.call('datastore.delete', 'storage.disk', disk['disk_identifier'])
+                    deleted.append(disk['disk_identifier'])
+                    continue
+                disks[disk['disk_identifier']] = disk
                 continue
             else:
                 disk['disk_expiretime'] = None
-                disk['disk_name'] = name
-
-            reg = RE_DSKNAME.search(name)
-            if reg:
-                disk['disk_subsystem'] = reg.group(1)
-                disk['disk_number'] = int(reg.group(2))
-            serial = ''
-            g = geom.geom_by_name('DISK', name)
-            if g:
-                if g.provider.config['ident']:
-                    serial = disk['disk_serial'] = g.provider.config['ident']
-                serial += g.provider.config.get('lunid') or ''
-                if g.provider.mediasize:
-                    disk['disk_size'] = g.provider.mediasize
-            if not disk.get('disk_serial'):
-                serial = disk['disk_serial'] = await self.serial_from_device(name) or ''
 
+            identity = await self.__identity(name, disk['disk_serial'])
+            self.__disk_attrs(disk, name, identity)
+            serial = identity['serial'] + identity['lunid']
             if serial:
-                serials.append(serial)
+                serials.add(serial)
 
             # If for some reason disk is not identified as a system disk
             # mark it to expire.
-            if name not in sys_disks and not disk['disk_expiretime']:
-                    disk['disk_expiretime'] = datetime.utcnow() + timedelta(days=DISK_EXPIRECACHE_DAYS)
-            await self.middleware.call('datastore.update', 'storage.disk', disk['disk_identifier'], disk)
-
-            # FIXME: use a truenas middleware plugin
-            await self.middleware.call('notifier.sync_disk_extra', disk['disk_identifier'], False)
+            if name not in sys_disks:
+                disk['disk_expiretime'] = datetime.utcnow() + timedelta(days=DISK_EXPIRECACHE_DAYS)
+            disks[disk['disk_identifier']] = disk
+            extra.append((disk['disk_identifier'], False))
             seen_disks[name] = disk
 
         for name in sys_disks:
             if name not in seen_disks:
-                disk_identifier = await self.device_to_identifier(name)
-                qs = await self.middleware.call('datastore.query', 'storage.disk', [('disk_identifier', '=', disk_identifier)])
-                if qs:
-                    new = False
-                    disk = qs[0]
-                else:
-                    new = True
-                    disk = {'disk_identifier': disk_identifier}
-                disk['disk_name'] = name
-                serial = ''
-                g = geom.geom_by_name('DISK', name)
-                if g:
-                    if g.provider.config['ident']:
-                        serial = disk['disk_serial'] = g.provider.config['ident']
-                    serial += g.provider.config.get('lunid') or ''
-                    if g.provider.mediasize:
-                        disk['disk_size'] = g.provider.mediasize
-                if not disk.get('disk_serial'):
-                    serial = disk['disk_serial'] = await self.serial_from_device(name) or ''
+                disk_identifier = await self.__device_to_identifier(name)
+                if disk_identifier in deleted:
+                    deleted.remove(disk_identifier)
+                disk = rows.get(disk_identifier) or {'disk_identifier': disk_identifier}
+                identity = await self.__identity(name, disk.get('disk_serial'))
+                serial = identity['serial'] + identity['lunid']
                 if serial:
                     if serial in serials:
                         # Probably dealing with multipath here, do not add another
                         continue
                     else:
-                        serials.append(serial)
-                reg = RE_DSKNAME.search(name)
-                if reg:
-                    disk['disk_subsystem'] = reg.group(1)
-                    disk['disk_number'] = int(reg.group(2))
+                        serials.add(serial)
+                disk['disk_expiretime'] = None
+                self.__disk_attrs(disk, name, identity)
+                disks[disk_identifier] = disk
+                extra.append((disk_identifier, True))
 
-                if not new:
-                    await self.middleware.call('datastore.update', 'storage.disk', disk['disk_identifier'], disk)
-                else:
-                    disk['disk_identifier'] = await self.middleware.call('datastore.insert', 'storage.disk', disk)
-                # FIXME: use a truenas middleware plugin
-                await self.middleware.call('notifier.sync_disk_extra', disk['disk_identifier'], True)
+        await self.__write(original, disks, deleted)
+
+        for identifier, add in extra:
+            # FIXME: use a truenas middleware plugin
+            await self.middleware.call('notifier.sync_disk_extra', identifier, add)
+
+    @private
+    async def devfs_notify(self, name):
+        """
+        Queue disk `name` to be synced after a devfs event about it.
+
+        Events are coalesced for DEVFS_SETTLE seconds so that hot-plugging
+        a whole enclosure results in a single sync of the disks involved.
+        """
+        await self.__forget(name)
+        self.__devfs_pending.add(name)
+        if self.__devfs_handle is None:
+            self.__devfs_handle = asyncio.get_event_loop().call_later(
+                DEVFS_SETTLE, lambda: asyncio.ensure_future(self.__devfs_sync()),
+            )
+
+    async def __devfs_sync(self):
+        async with self.__devfs_lock:
+            self.__devfs_handle = None
+            names, self.__devfs_pending = self.__devfs_pending, set()
+            try:
+                await self.sync_devices(sorted(names))
+                await self.multipath_sync()
+            except Exception:
+                self.logger.error('Failed to sync disks %r', sorted(names), exc_info=True)
+            for name in names:
+                try:
+                    with SmartAlert() as sa:
+                        sa.device_delete(name)
+                except Exception:
+                    pass
 
     async def __multipath_create(self, name, consumers, mode=None):
         """
@@ -797,30 +983,17 @@ async def _event_devfs(middleware, event_type, args):
         # Device notified about is not a disk
         if data['cdev'] not in disks:
             return
-        # TODO: hack so every disk is not synced independently during boot
-        # This is a performance issue
-        if os.path.exists('/tmp/.sync_disk_done'):
-            await middleware.call('disk.sync', data['cdev'])
-            await middleware.call('disk.multipath_sync')
-            try:
-                with SmartAlert() as sa:
-                    sa.device_delete(data['cdev'])
-            except Exception:
-                pass
     elif data['type'] == 'DESTROY':
         # Device notified about is not a disk
         if not RE_ISDISK.match(data['cdev']):
             return
-        # TODO: hack so every disk is not synced independently during boot
-        # This is a performance issue
-        if os.path.exists('/tmp/.sync_disk_done'):
-            await middleware.call('disk.sync_all')
-            await middleware.call('disk.multipath_sync')
-            try:
-                with SmartAlert() as sa:
-                    sa.device_delete(data['cdev'])
-            except Exception:
-                pass
+    else:
+        return
+
+    # TODO: hack so every disk is not synced independently during boot
+    # This is a performance issue
+    if os.path.exists('/tmp/.sync_disk_done'):
+        await middleware.call('disk.devfs_notify', data['cdev'])
 
 
 def setup(middleware):
@@ -1,6 +1,8 @@
 from middlewared.schema import Bool, Dict, Int, List, Str, accepts
 from middlewared.service import ConfigService
 
+from datetime import timedelta
+
 import os
 import sys
 
@@ -39,4 +41,6 @@ class MailService(ConfigService):
         # TODO: For now this is just a wrapper for freenasUI send_mail,
         #       when the time comes we will do the reverse, logic here
         #       and calling this method from freenasUI.
+        if message.get('interval') is not None:
+            message['interval'] = timedelta(seconds=message['interval'])
         return send_mail(**message)
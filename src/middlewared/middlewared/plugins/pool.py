@@ -2,15 +2,32 @@ import asyncio
 import libzfs
 import os
 import sysctl
+import time
 
+from bsd import geom
 from datetime import datetime
 
 from middlewared.schema import accepts, Int
 from middlewared.service import filterable, item_method, private, CRUDService
 
 
+def int_property(prop):
+    try:
+        return int(prop.rawvalue)
+    except (TypeError, ValueError):
+        return None
+
+
 class PoolService(CRUDService):
 
+    # Seconds the pool state is cached for, unless a pool event comes first
+    STATE_TTL = 10
+
+    def __init__(self, *args, **kwargs):
+        super(PoolService, self).__init__(*args, **kwargs)
+        self.__state = None
+        self.__state_expire = 0
+
     @filterable
     async def query(self, filters=None, options=None):
         filters = filters or []
@@ -55,6 +72,53 @@ class PoolService(CRUDService):
             pool['is_decrypted'] = True
         return pool
 
+    @private
+    def state(self):
+        """
+        Snapshot of the state of all imported pools (capacity, health,
+        feature flags upgrade status) and of the GELI providers attached,
+        gathered in a single libzfs and geom pass.
+        """
+        if self.__state is not None and time.monotonic() < self.__state_expire:
+            return self.__state
+
+        pools = {}
+        for zpool in libzfs.ZFS().pools:
+            props = zpool.properties
+            status = props['health'].value
+            if status == 'ONLINE':
+                status = 'HEALTHY'
+            version = props['version'].value
+            if version == '-':
+                upgraded = all(
+                    feature.state != libzfs.FeatureState.DISABLED
+                    for feature in zpool.features
+                )
+            else:
+                upgraded = False
+            pools[zpool.name] = {
+                'name': zpool.name,
+                'status': status,
+                'size': int_property(props['size']),
+                'alloc': int_property(props['allocated']),
+                'free': int_property(props['free']),
+                'capacity': int_property(props['capacity']),
+                'version': version,
+                'upgraded': upgraded,
+            }
+
+        geom.scan()
+        klass = geom.class_by_name('ELI')
+        geli = [g.name[:-len('.eli')] for g in klass.geoms] if klass else []
+
+        self.__state = {'pools': pools, 'geli': geli}
+        self.__state_expire = time.monotonic() + self.STATE_TTL
+        return self.__state
+
+    @private
+    def state_invalidate(self):
+        self.__state = None
+
     @item_method
     @accepts(Int('id'))
     async def get_disks(self, oid):
@@ -110,5 +174,18 @@ class PoolService(CRUDService):
         sysctl.filter('vfs.zfs.scan_idle')[0].value = scan_idle
 
 
+async def _event_zfs(middleware, event_type, args):
+    await middleware.call('pool.state_invalidate')
+
+
+async def _event_devfs(middleware, event_type, args):
+    if args['data'].get('cdev', '').endswith('.eli'):
+        await middleware.call('pool.state_invalidate')
+
+
 def setup(middleware):
     asyncio.ensure_future(middleware.call('pool.configure_resilver_priority'))
+    # Pools imported, exported, degraded... and GELI providers attached or
+    # detached make the cached pool state stale.
+    middleware.event_subscribe('devd.zfs', _event_zfs)
+    middleware.event_subscribe('devd.devfs', _event_devfs)
@@ -1,15 +1,956 @@
-from middlewared.schema import accepts, Dict, Str
-from middlewared.service import private, CallError, Service
-from middlewared.utils import Popen
+from collections import defaultdict
+from datetime import datetime, timedelta
 
+from middlewared.schema import accepts, Bool, Dict, Int, List, Str
+from middlewared.service import job, private, CallError, Service
+from middlewared.stream import BLOCK_SIZE, COMPRESSORS, StreamTransport
+from middlewared.utils import Popen, run
+
+import abc
+import asyncio
 import base64
 import errno
+import hashlib
 import os
+import pickle
+import psutil
+import re
+import shlex
 import subprocess
+import time
+
+# Seconds a listing of snapshots of a remote system is kept in cache
+REMOTE_SNAPSHOTS_TTL = 300
+REMOTE_SNAPSHOTS_TIMEOUT = 30
+
+# Seconds an idle SSH master connection to a remote system is kept around
+REPLICATION_SSH_PERSIST = 600
+REPLICATION_PROGRESS_INTERVAL = 2
+# Seconds a send stream may not move any data before it is aborted
+REPLICATION_STALL_TIMEOUT = 3600
+# Replication taking longer than that is run again right away so newer
+# snapshots are sent before they expire on our side.
+REPLICATION_RERUN = 300
+REPLICATION_RESULTFILE = '/tmp/.repl-result'
+REPLICATION_PROGRESSFILE = '/tmp/.repl_progress_{id}'
+
+RE_SEND_PROGRESS = re.compile(r'sending (\S+) \((\d+)%')
+
+# Pair of compression and decompression pipe commands for compressions
+# not done by the transport itself
+MAP_COMPRESSION = {
+    'plzip': ('/usr/local/bin/plzip', '/usr/bin/env plzip -d'),
+    'lz4': ('/usr/local/bin/lz4c', '/usr/bin/env lz4c -d'),
+}
+
+
+def remote_key(remote):
+    """
+    Key identifying a remote system of a replication task.
+    Multiple replication tasks may share the same remote system.
+    """
+    if remote['ssh_remote_dedicateduser_enabled']:
+        user = remote['ssh_remote_dedicateduser']
+    else:
+        user = 'root'
+    return (remote['ssh_remote_hostname'], remote['ssh_remote_port'], user)
+
+
+def is_time_between(time_to_test, begin_time, end_time):
+    if begin_time <= end_time:
+        return begin_time <= time_to_test <= end_time
+    else:
+        # e.g. from 18:00 to 9:00
+        return time_to_test >= begin_time or time_to_test <= end_time
+
+
+def replication_plan(map_source, map_target, followdelete):
+    """
+    Calculate the replication path from source to target given the snapshots
+    (name, creation) of each dataset on both sides, ordered by creation.
+
+    Returns a dict of dataset to the list of snapshots to send (`None` first
+    meaning a full stream, `None` last meaning the dataset is to be removed)
+    and a dict of dataset to remote snapshots to be deleted.
+    """
+    tasks = {}
+    delete_tasks = {}
+    for dataset in map_source:
+        if dataset in map_target:
+            # Find out the last common snapshot.
+            #
+            # We have two ordered lists, list_source and list_target
+            # which are ordered by the creation time.  Because they
+            # are ordered, we can have two pointers and scan backward
+            # until we hit one identical item, or hit the end of
+            # either list.
+            list_source = map_source[dataset]
+            list_target = map_target[dataset]
+            i = len(list_source) - 1
+            j = len(list_target) - 1
+            sourcesnap, sourcetime = list_source[i]
+            targetsnap, targettime = list_target[j]
+            while i >= 0 and j >= 0:
+                # found.
+                if sourcesnap == targetsnap and sourcetime == targettime:
+                    break
+                elif sourcetime > targettime:
+                    i -= 1
+                    if i < 0:
+                        break
+                    sourcesnap, sourcetime = list_source[i]
+                else:
+                    j -= 1
+                    if j < 0:
+                        break
+                    targetsnap, targettime = list_target[j]
+            if sourcesnap == targetsnap and sourcetime == targettime:
+                # found: i, j points to the right position.
+                # we do not care much if j is pointing to the last snapshot
+                # if source side have new snapshot(s), report it.
+                if i < len(list_source) - 1:
+                    tasks[dataset] = [m[0] for m in list_source[i:]]
+                if followdelete:
+                    # All snapshots that do not exist on the source side should
+                    # be deleted when followdelete is requested.
+                    delete_set = set([m[0] for m in list_target]) - set([m[0] for m in list_source])
+                    if len(delete_set) > 0:
+                        delete_tasks[dataset] = delete_set
+            else:
+                # no identical snapshot found, nuke and repave.
+                tasks[dataset] = [None] + [m[0] for m in list_source[i:]]
+        else:
+            # New dataset on source side: replicate to the target.
+            tasks[dataset] = [None] + [m[0] for m in map_source[dataset]]
+
+    # Removed dataset(s)
+    for dataset in map_target:
+        if dataset not in map_source:
+            tasks[dataset] = [map_target[dataset][-1][0], None]
+
+    return tasks, delete_tasks
+
+
+def resume_token_info(output):
+    """
+    Parse the output of `zfs send -nvP -t <token>` into the snapshot being
+    received, the bytes of it received already and the estimated size of
+    the remaining stream.
+    """
+    info = {'toname': None, 'bytes': 0, 'size': None}
+    for line in output.splitlines():
+        if line.strip().startswith('toname = '):
+            info['toname'] = line.split(' = ', 1)[1].strip()
+        elif line.strip().startswith('bytes = '):
+            info['bytes'] = int(line.split(' = ', 1)[1].strip(), 0)
+        elif line.startswith('size\t'):
+            info['size'] = int(line.split('\t', 1)[1])
+    return info
+
+
+class ReplicationTransport(abc.ABC):
+    """
+    Runs commands on the remote system of replication tasks.
+    """
+
+    def __init__(self, remote, logger):
+        self.logger = logger
+        self.semaphore = None
+        self.parallel = None
+        # Whether the remote system supports resumable receive (zfs receive -s)
+        self.resumable = False
+        self.update(remote)
+
+    def update(self, remote):
+        self.remote = remote
+        parallel = max(remote['ssh_remote_parallel'], 1)
+        if parallel != self.parallel:
+            # Limit of datasets being sent to the remote system at a time
+            self.semaphore = asyncio.Semaphore(parallel)
+            self.parallel = parallel
+
+    @abc.abstractmethod
+    def command(self):
+        """
+        Shell command to run its argument on the remote system.
+        """
+
+    async def connect(self):
+        pass
+
+    @abc.abstractmethod
+    async def run(self, command):
+        """
+        Run shell `command` on the remote system, returning its completed
+        process with decoded output.
+        """
+
+
+class ReplicationSSH(ReplicationTransport):
+    """
+    Persistent multiplexed SSH connection (ControlMaster) to a remote system.
+
+    Remote commands and send streams are opened as new sessions of the
+    master connection instead of going through a whole SSH handshake each.
+    If the master connection cannot be established sessions fall back to
+    a connection of their own.
+    """
+
+    def __init__(self, remote, logger):
+        super(ReplicationSSH, self).__init__(remote, logger)
+        self.lock = asyncio.Lock()
+        key = remote_key(remote) + (remote['ssh_cipher'],)
+        self.control_path = '/var/run/ssh-replication-{}'.format(hashlib.sha1(repr(key).encode()).hexdigest()[:16])
+
+    def args(self, *options):
+        hostname, port, user = remote_key(self.remote)
+        args = ['/usr/local/bin/ssh']
+        if self.remote['ssh_cipher'] == 'fast':
+            args += ['-c', 'arcfour256,arcfour128,blowfish-cbc,aes128-ctr,aes192-ctr,aes256-ctr']
+        elif self.remote['ssh_cipher'] == 'disabled':
+            args += ['-ononeenabled=yes', '-ononeswitch=yes']
+        args += [
+            '-i', '/data/ssh/replication',
+            '-o', 'BatchMode=yes',
+            '-o', 'StrictHostKeyChecking=yes',
+            # There's nothing magical about ConnectTimeout, it's an average
+            # of wiliam and josh's thoughts on a Wednesday morning.
+            # It will prevent hunging in the status of "Sending".
+            '-o', 'ConnectTimeout=7',
+            '-o', f'ControlPath={self.control_path}',
+        ]
+        args += list(options)
+        args += ['-p', str(port), '-l', user, hostname]
+        return args
+
+    def command(self):
+        return ' '.join(shlex.quote(i) for i in self.args('-o', 'ControlMaster=no'))
+
+    async def connect(self):
+        """
+        Make sure the master connection is up.
+        """
+        async with self.lock:
+            cp = await run(*self.args('-O', 'check'), check=False)
+            if cp.returncode == 0:
+                return
+            # Master goes to background once connected, do not hold its output
+            # or we would wait on it until it exits.
+            proc = await asyncio.create_subprocess_exec(
+                *self.args(
+                    '-o', 'ControlMaster=yes',
+                    '-o', f'ControlPersist={REPLICATION_SSH_PERSIST}',
+                    '-f', '-N',
+                ),
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            if await proc.wait() != 0:
+                self.logger.debug(f'Failed to open SSH master connection to {self.remote["ssh_remote_hostname"]}')
+
+    async def run(self, command):
+        cp = await run(*self.args('-o', 'ControlMaster=no'), command, check=False)
+        cp.stdout = cp.stdout.decode(errors='ignore')
+        cp.stderr = cp.stderr.decode(errors='ignore').replace('WARNING: ENABLED NONE CIPHER', '').strip()
+        return cp
+
+
+class ReplicationProgress(object):
+    """
+    Aggregate progress of concurrent send streams as the job progress and
+    publish transport stats of every replication task.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.total = 0
+        self.done = 0
+        self.streams = {}
+
+    def update(self):
+        now = time.monotonic()
+        by_replication = defaultdict(list)
+        for stream in self.streams.values():
+            stream['stats'] = stream['transport'].stats.get()
+            by_replication[stream['id']].append(stream['stats'])
+
+            if now - stream['transport'].stats.active > REPLICATION_STALL_TIMEOUT:
+                # Nothing went through for too long, abort the stream
+                for proc in stream['procs']:
+                    if proc.returncode is None:
+                        proc.kill()
+
+            try:
+                # zfs send -V reports its progress in the process title
+                title = ' '.join(psutil.Process(stream['pid']).cmdline())
+            except psutil.Error:
+                continue
+            reg = RE_SEND_PROGRESS.search(title)
+            if reg:
+                stream['percent'] = int(reg.group(2))
+
+        for id, stats in by_replication.items():
+            bytes_in = sum(i['bytes_in'] for i in stats)
+            bytes_out = sum(i['bytes_out'] for i in stats)
+            self.job.middleware.send_event('replication.stats', 'CHANGED', id=id, fields={
+                'streams': len(stats),
+                'bytes_in': bytes_in,
+                'bytes_out': bytes_out,
+                'rate': sum(i['rate'] for i in stats),
+                'ratio': bytes_in / bytes_out if bytes_out else 1.0,
+                'stall': sum(i['stall'] for i in stats),
+                'throttled': sum(i['throttled'] for i in stats),
+            })
+
+        if self.total:
+            sent = self.done + sum(i['percent'] for i in self.streams.values()) / 100
+            percent = min(sent / self.total * 100, 100)
+        else:
+            percent = 0
+        self.job.set_progress(percent, f'Sending {len(self.streams)} stream(s)', {
+            'streams': [
+                {'snapshot': i['snapshot'], 'percent': i['percent'], **i.get('stats', {})}
+                for i in self.streams.values()
+            ],
+        })
 
 
 class ReplicationService(Service):
 
+    def __init__(self, *args, **kwargs):
+        super(ReplicationService, self).__init__(*args, **kwargs)
+        # remote key -> {'time': monotonic time of the listing, 'snapshots': set}
+        self.__remote_snapshots = {}
+        self.__remote_snapshots_fetching = {}
+        # remote key and cipher -> ReplicationSSH
+        self.__ssh = {}
+
+    async def __remote_snapshots_fetch(self, key):
+        hostname, port, user = key
+        proc = await Popen([
+            '/usr/local/bin/ssh',
+            '-i', '/data/ssh/replication',
+            '-o', 'ConnectTimeout=3',
+            '-o', 'BatchMode=yes',
+            '-o', 'StrictHostKeyChecking=yes',
+            '-p', str(port),
+            f'{user}@{hostname}',
+            'zfs list -Ht snapshot -o name',
+        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            output = (await asyncio.wait_for(proc.communicate(), REMOTE_SNAPSHOTS_TIMEOUT))[0]
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            self.logger.debug(f'Timed out listing snapshots of {hostname}:{port}')
+            return None
+        if proc.returncode != 0:
+            self.logger.debug(f'Failed to list snapshots of {hostname}:{port}')
+            return None
+        return set(output.decode(errors='ignore').split())
+
+    async def __remote_snapshots_refresh(self, key, cached):
+        try:
+            snapshots = await self.__remote_snapshots_fetch(key)
+            if snapshots is None:
+                # Remote is not reachable, keep serving the stale listing (if any)
+                # until next TTL so we do not stall on it every time.
+                snapshots = cached['snapshots'] if cached else set()
+            self.__remote_snapshots[key] = {'time': time.monotonic(), 'snapshots': snapshots}
+            return snapshots
+        finally:
+            self.__remote_snapshots_fetching.pop(key, None)
+
+    async def __remote_snapshots_get(self, key, refresh=False):
+        cached = self.__remote_snapshots.get(key)
+        if not refresh and cached and time.monotonic() - cached['time'] < REMOTE_SNAPSHOTS_TTL:
+            return cached['snapshots']
+
+        # Share the same listing (or failure) between concurrent callers of
+        # the same remote, a caller going away does not cancel it for others.
+        fut = self.__remote_snapshots_fetching.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(self.__remote_snapshots_refresh(key, cached))
+            self.__remote_snapshots_fetching[key] = fut
+        return await asyncio.shield(fut)
+
+    @private
+    @accepts(Bool('refresh'))
+    async def remote_snapshots(self, refresh=False):
+        """
+        Make sure snapshots listing of every replication remote system is cached,
+        querying all expired remotes concurrently.
+
+        Returns the number of snapshots known per remote.
+        """
+        keys = set()
+        for repl in await self.middleware.call('datastore.query', 'storage.replication'):
+            keys.add(remote_key(repl['repl_remote']))
+        keys = list(keys)
+        listings = await asyncio.gather(*[self.__remote_snapshots_get(key, refresh) for key in keys])
+        return {f'{key[0]}:{key[1]}': len(snapshots) for key, snapshots in zip(keys, listings)}
+
+    @private
+    @accepts(
+        Int('id'),
+        List('added', items=[Str('snapshot')]),
+        List('removed', items=[Str('snapshot')]),
+    )
+    async def remote_snapshots_update(self, id, added=None, removed=None):
+        """
+        Incrementally update cached snapshots of the remote system of
+        replication `id` after snapshots were sent or destroyed on it.
+        """
+        repl = await self.middleware.call('datastore.query', 'storage.replication', [('id', '=', id)], {'get': True})
+        self.__remote_snapshots_apply(repl['repl_remote'], added, removed)
+
+    def __remote_snapshots_apply(self, remote, added=None, removed=None):
+        cached = self.__remote_snapshots.get(remote_key(remote))
+        if cached is None:
+            return
+        cached['snapshots'].update(added or [])
+        cached['snapshots'].difference_update(removed or [])
+
+    @private
+    @accepts(List('snapshots', items=[Str('snapshot')]))
+    async def snapshots_replicated(self, snapshots):
+        """
+        Returns which of the local `snapshots` already exist on the remote
+        system of a replication task.
+        """
+        by_filesystem = {}
+        for repl in await self.middleware.call('datastore.query', 'storage.replication'):
+            by_filesystem.setdefault(repl['repl_filesystem'], []).append(repl)
+        if not by_filesystem:
+            return []
+
+        await self.remote_snapshots()
+
+        rv = []
+        for snapshot in snapshots:
+            fs, name = snapshot.split('@', 1)
+            parts = fs.split('/')
+            # Look up replication tasks of the dataset itself or any of its
+            # parents (for recursive tasks) instead of going over every task.
+            found = False
+            for i in range(len(parts), 0, -1):
+                parent = '/'.join(parts[:i])
+                for repl in by_filesystem.get(parent, []):
+                    if parent != fs and not repl['repl_userepl']:
+                        continue
+                    # Make sure remote snapshot is checked correctly
+                    # when destination is root dataset
+                    if '/' not in repl['repl_zfs']:
+                        replace = '{}/{}'.format(repl['repl_zfs'], parent.rsplit('/')[-1])
+                    else:
+                        replace = repl['repl_zfs']
+                    remote = self.__remote_snapshots.get(remote_key(repl['repl_remote']))
+                    if remote and f'{replace}{fs[len(parent):]}@{name}' in remote['snapshots']:
+                        found = True
+                        break
+                if found:
+                    break
+            if found:
+                rv.append(snapshot)
+        return rv
+
+    def __results_read(self):
+        try:
+            with open(REPLICATION_RESULTFILE, 'rb') as f:
+                results = pickle.loads(f.read())
+        except Exception:
+            results = {}
+        return defaultdict(dict, results)
+
+    def __results_write(self, results):
+        with open(REPLICATION_RESULTFILE, 'wb') as f:
+            f.write(pickle.dumps(dict(results)))
+
+    def __ssh_get(self, remote):
+        key = remote_key(remote) + (remote['ssh_cipher'],)
+        ssh = self.__ssh.get(key)
+        if ssh is None:
+            ssh = ReplicationSSH(remote, self.logger)
+            self.__ssh[key] = ssh
+        else:
+            ssh.update(remote)
+        return ssh
+
+    async def __mail(self, subject, text, interval):
+        await self.middleware.call('mail.send', {
+            'subject': subject,
+            'text': text,
+            'interval': int(interval.total_seconds()),
+            'channel': 'autorepl',
+        })
+
+    @private
+    async def schedule(self):
+        """
+        Queue a replication run unless there is one waiting to start already,
+        which will send the latest snapshots anyway.
+        """
+        waiting = await self.middleware.call('core.get_jobs', [
+            ('method', '=', 'replication.run'), ('state', '=', 'WAITING'),
+        ])
+        if waiting:
+            return waiting[0]['id']
+        return (await self.middleware.call('replication.run')).id
+
+    @private
+    @accepts()
+    @job(lock='replication')
+    async def run(self, job):
+        """
+        Run every enabled replication task within its time window.
+
+        Tasks and the datasets of each task are replicated concurrently,
+        sessions to the same remote system sharing a single SSH connection
+        and sending at most `ssh_remote_parallel` datasets at a time.
+        """
+        while True:
+            start = time.monotonic()
+            await self.__run(job)
+            # In case this took longer than 5 minutes and a successful
+            # replication happened, lets re-run it to prevent periodic snapshots
+            # to be deleted prior to be replicated (this might happen when its the
+            # first snapshot being sent and it takes longer than the snapshots
+            # retention time.
+            if time.monotonic() - start <= REPLICATION_RERUN:
+                break
+            self.logger.debug('Replication took too long, running again')
+
+    async def __run(self, job):
+        now = (datetime.now() + timedelta(seconds=30)).replace(second=0, microsecond=0).time()
+
+        replications = []
+        for repl in await self.middleware.call('datastore.query', 'storage.replication', [('repl_enabled', '=', True)]):
+            if is_time_between(now, repl['repl_begin'], repl['repl_end']):
+                replications.append(repl)
+        if not replications:
+            return
+
+        is_freenas = await self.middleware.call('system.is_freenas')
+        results = self.__results_read()
+        progress = ReplicationProgress(job)
+        progress_loop = asyncio.ensure_future(self.__progress_loop(progress))
+        try:
+            await asyncio.gather(*[
+                self.__replicate(repl, self.__ssh_get(repl['repl_remote']), results, progress, is_freenas)
+                for repl in replications
+            ])
+        finally:
+            progress_loop.cancel()
+            self.__results_write(results)
+        progress.update()
+
+    async def __progress_loop(self, progress):
+        while True:
+            progress.update()
+            await asyncio.sleep(REPLICATION_PROGRESS_INTERVAL)
+
+    async def __replicate(self, repl, ssh, results, progress, is_freenas):
+        try:
+            await self.__replicate_task(repl, ssh, results, progress, is_freenas)
+        except Exception as e:
+            self.logger.error(f'Replication of {repl["repl_filesystem"]} failed', exc_info=True)
+            results[repl['id']]['msg'] = f'Failed: {e}'
+
+    async def __replicate_task(self, repl, ssh, results, progress, is_freenas):
+        result = results[repl['id']]
+        remote = repl['repl_remote']['ssh_remote_hostname']
+        localfs = repl['repl_filesystem']
+        remotefs = repl['repl_zfs']
+        remotefs_final = f'{remotefs}{localfs.partition("/")[1]}{localfs.partition("/")[2]}'
+
+        # Examine local list of snapshots, then remote snapshots, and determine if there is any work to do.
+        self.logger.debug(f'Checking dataset {localfs}')
+        map_source = defaultdict(list)
+        for snap in await self.middleware.call('zfs.snapshot.dataset_snapshots', localfs, repl['repl_userepl']):
+            if not snap['system']:
+                map_source[snap['dataset']].append((snap['snapshot_name'], snap['creation']))
+
+        await ssh.connect()
+
+        cp = await ssh.run(
+            f'zfs list -H -o name,readonly -t filesystem,volume -r {shlex.quote(remotefs_final.split("/")[0])}'
+        )
+        remote_zfslist = {}
+        for i in cp.stdout.splitlines():
+            data = i.split()
+            if len(data) == 2:
+                remote_zfslist[data[0]] = {'readonly': data[1] == 'on'}
+
+        # Attempt to create the remote datasets.  If it fails, we don't care at this point.
+        if '/' not in localfs:
+            localfs_tmp = f'{localfs}/{localfs}'
+        else:
+            localfs_tmp = localfs
+        create = []
+        ds = ''
+        for direc in (remotefs.partition('/')[2] + '/' + localfs_tmp.partition('/')[2]).split('/'):
+            # If this test fails there is no need to create datasets on the remote side
+            # eg: tank -> tank replication
+            if not direc:
+                continue
+            if '/' in remotefs or '/' in localfs:
+                ds = os.path.join(ds, direc)
+                ds_full = f'{remotefs.split("/")[0]}/{ds}'
+                if ds_full not in remote_zfslist:
+                    create.append(ds_full)
+        if create:
+            # Datasets are created in a single session, parents first
+            rcp = await ssh.run('; '.join(f'zfs create -o readonly=on {shlex.quote(i)}' for i in create))
+            if rcp.returncode:
+                self.logger.debug(f'Unable to create remote datasets {create}: {rcp.stderr}')
+            remote_zfslist.update({i: {'readonly': True} for i in create})
+
+        if not is_freenas:
+            # Bi-directional replication: the remote side indicates that they are
+            # willing to receive snapshots by setting readonly to 'on', which prevents
+            # local writes.
+            #
+            # Both the dataset and its children must be readonly, or not exist at all.
+            readonly = [
+                v['readonly'] for k, v in remote_zfslist.items()
+                if k == remotefs_final or k.startswith(f'{remotefs_final}/')
+            ]
+            # ssh exits with 255 if the remote system could not be reached
+            if cp.returncode == 255 or not all(readonly):
+                self.logger.debug(f'dataset {remotefs_final} and its children must be readonly.')
+                if cp.returncode != 255:
+                    result['msg'] = 'Remote destination must be set readonly'
+                    await self.__mail(f'Replication denied! ({remote})', f"""
+Hello,
+    The remote system have denied our replication from local ZFS
+    {localfs} to remote ZFS {remotefs_final}.  Please change the 'readonly' property
+    of:
+        {remotefs_final}
+    as well as its children to 'on' to allow receiving replication.
+""", timedelta(hours=24))
+                else:
+                    result['msg'] = 'Remote system not responding.'
+                    await self.__mail(f'Replication failed! ({remote})', f"""
+Hello,
+    Replication of local ZFS {localfs} to remote ZFS {remotefs_final} failed.  The remote system is not responding.
+""", timedelta(hours=24))
+                return
+
+        # Remote filesystem is the root dataset
+        # Make sure it has no .system dataset over there because zfs receive will try to
+        # remove it and fail (because its mounted and being used)
+        if '/' not in remotefs_final:
+            rcp = await ssh.run(f'mount | grep ^{shlex.quote(remotefs_final)}/.system')
+            if rcp.stdout.strip():
+                result['msg'] = 'Please move system dataset of remote side to another pool'
+                return
+
+        # Receives interrupted on a previous run are resumed first, only then
+        # snapshots on the remote side tell what is left to do.
+        resume_tokens = await self.__resume_tokens(ssh, remotefs_final)
+        if resume_tokens:
+            resumed = await asyncio.gather(*[
+                self.__resume(repl, ssh, results, progress, zfsname, token, remotefs_final)
+                for zfsname, token in resume_tokens.items()
+            ])
+            if not all(resumed):
+                return
+
+        # Grab map from remote system
+        rcp = await ssh.run(
+            'zfs list -H -t snapshot -p -o name,creation {} -r {}'.format(
+                '' if repl['repl_userepl'] else '-d 1',
+                shlex.quote(remotefs_final),
+            )
+        )
+        map_target = defaultdict(list)
+        if rcp.stdout.strip():
+            for line in rcp.stdout.splitlines():
+                if not line or re.match(r'^[^/]+/.system', line):
+                    continue
+                name, creation = line.split('\t')
+                # Process snapshot so that it matches the desired form of source side
+                dataset, snapname = (localfs + name[len(remotefs_final):]).split('@', 1)
+                map_target[dataset].append((snapname, int(creation)))
+        elif rcp.stderr:
+            result['msg'] = f'Failed: {rcp.stderr}'
+            return
+
+        tasks, delete_tasks = replication_plan(map_source, map_target, repl['repl_followdelete'])
+        if not tasks:
+            result['msg'] = 'Up to date'
+            return
+
+        progress.total += sum(len(i) - 1 for i in tasks.values() if i[-1] is not None)
+        result['msg'] = 'Running'
+        self.__results_write(results)
+
+        # Go through datasets in reverse order by level in hierarchy
+        # This is because in case datasets being remounted we need to make sure
+        # tank/foo is mounted after tank/foo/bar and the latter does not get hidden.
+        # See #12455
+        # Datasets of the same level are independent and are sent concurrently.
+        levels = defaultdict(list)
+        for dataset in tasks:
+            levels[len(dataset.split('/'))].append(dataset)
+        deleted = []
+        for level in sorted(levels, reverse=True):
+            await asyncio.gather(*[
+                self.__replicate_dataset(
+                    repl, ssh, result, progress, dataset, tasks[dataset], map_target.get(dataset),
+                    delete_tasks.get(dataset), remotefs_final, deleted,
+                )
+                for dataset in levels[level]
+            ])
+
+    async def __replicate_dataset(
+        self, repl, ssh, result, progress, dataset, tasklist, list_target, delete_set, remotefs_final, deleted,
+    ):
+        remote = repl['repl_remote']['ssh_remote_hostname']
+        localfs = repl['repl_filesystem']
+        zfsname = remotefs_final + dataset[len(localfs):]
+
+        async with ssh.semaphore:
+            if tasklist[0] is None:
+                # No matching snapshot(s) exist.  If there is any snapshots on the
+                # target side, destroy all existing snapshots so we can proceed.
+                if list_target:
+                    snaplist = [f'{zfsname}@{i[0]}' for i in list_target]
+                    self.logger.debug(
+                        f'Deleting {len(snaplist)} snapshot(s) in pull side because not a single matching '
+                        'snapshot was found'
+                    )
+                    # Destroy all of them in a single session, failed ones are echoed back
+                    rcp = await ssh.run('; '.join(
+                        f'zfs destroy {shlex.quote(i)} || echo {shlex.quote(i)}' for i in snaplist
+                    ))
+                    failed_snapshots = [i for i in rcp.stdout.splitlines() if i in snaplist]
+                    if rcp.returncode and not failed_snapshots:
+                        failed_snapshots = snaplist
+                    self.__remote_snapshots_apply(
+                        repl['repl_remote'], removed=list(set(snaplist) - set(failed_snapshots)),
+                    )
+                    if failed_snapshots:
+                        # We can't proceed in this situation, report
+                        for snapshot in failed_snapshots:
+                            self.logger.warn(f'Unable to destroy snapshot {snapshot} on remote system')
+                        await self.__mail(f'Replication failed! ({remote})', f"""
+Hello,
+    The replication failed for the local ZFS {localfs} because the remote system
+    has diverged snapshots with us and we were unable to remove them,
+    including:
+{failed_snapshots}
+""", timedelta(hours=2))
+                        result['msg'] = f'Unable to destroy remote snapshot: {failed_snapshots}'
+                psnap = tasklist[1]
+                success = await self.__send(repl, ssh, result, progress, dataset, None, psnap, remotefs_final)
+                if not success:
+                    # Report the situation
+                    await self.__mail(f'Replication failed when sending {dataset}@{psnap}', f"""
+Hello,
+    The replication failed for the local ZFS {dataset} while attempting to
+    send snapshot {psnap} to {remote}
+""", timedelta(hours=2))
+                    result['msg'] = f'Failed: {dataset} ({psnap})'
+                    return
+                await self.__send_incrementals(repl, ssh, result, progress, dataset, tasklist[1:], remotefs_final)
+            elif tasklist[1] is not None:
+                allsucceeded = await self.__send_incrementals(
+                    repl, ssh, result, progress, dataset, tasklist, remotefs_final,
+                )
+                if allsucceeded and delete_set:
+                    self.logger.debug(f'Deleting {len(delete_set)} stale snapshot(s) on pull side')
+                    await ssh.run(f'zfs destroy -d {shlex.quote(zfsname + "@" + ",".join(sorted(delete_set)))}')
+                    self.__remote_snapshots_apply(
+                        repl['repl_remote'], removed=[f'{zfsname}@{i}' for i in delete_set],
+                    )
+                if allsucceeded:
+                    result['msg'] = 'Succeeded'
+            else:
+                # Remove the named dataset.
+                if any(zfsname.startswith(i) for i in deleted):
+                    return
+                rcp = await ssh.run(f'zfs destroy -r {shlex.quote(zfsname)}')
+                if rcp.returncode:
+                    self.logger.warn(f'Unable to destroy dataset {zfsname} on remote system')
+                else:
+                    deleted.append(zfsname)
+
+    async def __send_incrementals(self, repl, ssh, result, progress, dataset, snapshots, remotefs_final):
+        remote = repl['repl_remote']['ssh_remote_hostname']
+        psnap = snapshots[0]
+        for nsnap in snapshots[1:]:
+            success = await self.__send(repl, ssh, result, progress, dataset, psnap, nsnap, remotefs_final)
+            if not success:
+                # Report the situation
+                await self.__mail(f'Replication failed at {dataset}@{psnap} -> {nsnap}', f"""
+Hello,
+    The replication failed for the local ZFS {dataset} while attempting to
+    apply incremental send of snapshot {psnap} -> {nsnap} to {remote}
+""", timedelta(hours=2))
+                result['msg'] = f'Failed: {dataset} ({psnap}->{nsnap})'
+                return False
+            psnap = nsnap
+        return True
+
+    async def __resume_tokens(self, ssh, remotefs_final):
+        """
+        Resume tokens of datasets partially received on the remote side.
+        """
+        rcp = await ssh.run(
+            'zfs get -H -o name,value -r -t filesystem,volume receive_resume_token '
+            f'{shlex.quote(remotefs_final.split("/")[0])}'
+        )
+        # Property is unknown to remote systems without resumable receive
+        ssh.resumable = rcp.returncode == 0
+        tokens = {}
+        if ssh.resumable:
+            for line in rcp.stdout.splitlines():
+                name, value = line.split('\t', 1)
+                if value != '-' and (name == remotefs_final or name.startswith(f'{remotefs_final}/')):
+                    tokens[name] = value
+        return tokens
+
+    async def __resume(self, repl, ssh, results, progress, zfsname, token, remotefs_final):
+        result = results[repl['id']]
+        cp = await run('/sbin/zfs', 'send', '-nvP', '-t', token, check=False)
+        info = resume_token_info(cp.stdout.decode(errors='ignore'))
+        if cp.returncode or info['toname'] is None:
+            # Snapshot being received is gone on our side, discard the partial
+            # state so the dataset can be sent as usual.
+            self.logger.warn(
+                f'Unable to resume receive of {zfsname}, aborting it: {cp.stderr.decode(errors="ignore").strip()}'
+            )
+            await ssh.run(f'zfs receive -A {shlex.quote(zfsname)}')
+            result.pop('resume', None)
+            return True
+
+        dataset, snapname = info['toname'].split('@', 1)
+        self.logger.debug(f'Resuming receive of {info["toname"]} after {info["bytes"]} bytes')
+        result['resume'] = {'snapshot': info['toname'], 'bytes': info['bytes'], 'size': info['size']}
+        result['msg'] = f'Resuming {info["toname"]} ({info["bytes"]} bytes received)'
+        self.__results_write(results)
+
+        progress.total += 1
+        async with ssh.semaphore:
+            success = await self.__send(repl, ssh, result, progress, dataset, None, snapname, remotefs_final, token)
+        if success:
+            result.pop('resume', None)
+        else:
+            remote = repl['repl_remote']['ssh_remote_hostname']
+            await self.__mail(f'Replication failed when resuming {info["toname"]}', f"""
+Hello,
+    The replication failed for the local ZFS {dataset} while attempting to
+    resume the interrupted send of snapshot {snapname} to {remote}
+""", timedelta(hours=2))
+            result['msg'] = f'Failed: {dataset} (resume {snapname})'
+        return success
+
+    async def __send(self, repl, ssh, result, progress, dataset, fromsnap, tosnap, remotefs_final, token=None):
+        """
+        Attempt to send a snapshot or incremental stream to remote.
+
+        A `token` resumes the partially received stream it was taken from.
+        """
+        localfs = repl['repl_filesystem']
+        cmd = ['/sbin/zfs', 'send', '-V']
+        # -p switch will send properties for whole dataset, including snapshots
+        # which will result in stale snapshots being delete as well
+        if repl['repl_followdelete'] and token is None:
+            cmd.append('-p')
+        if token is not None:
+            cmd.extend(['-t', token])
+        elif fromsnap is None:
+            cmd.append(f'{dataset}@{tosnap}')
+        else:
+            cmd.extend(['-i', f'{dataset}@{fromsnap}', f'{dataset}@{tosnap}'])
+
+        # Compression in the transport itself when possible, otherwise with
+        # the external compressor in the pipeline.
+        compression = repl['repl_compression']
+        if compression in COMPRESSORS:
+            compress, decompress = '', COMPRESSORS[compression][1] + ' | '
+        elif compression in MAP_COMPRESSION:
+            compress, decompress = [f'{i} | ' for i in MAP_COMPRESSION[compression]]
+        else:
+            compress, decompress = '', ''
+        # Interrupted receives keep their state (-s) so they can be resumed
+        receive = '{}/sbin/zfs receive {}-F -d {} && echo Succeeded'.format(
+            decompress, '-s ' if ssh.resumable else '', shlex.quote(repl['repl_zfs']),
+        )
+        replcmd = f'{compress}{ssh.command()} {shlex.quote(receive)}'
+        self.logger.debug(f'Sending zfs snapshot: {" ".join(cmd)} | {replcmd}')
+
+        transport = StreamTransport(
+            max(repl['repl_buffer'] * 1024 * 1024 // BLOCK_SIZE, 1),
+            compression=compression,
+            limit=repl['repl_limit'] * 1024 if repl['repl_limit'] else None,
+        )
+        sendfd, transportinfd = os.pipe()
+        transportoutfd, receivefd = os.pipe()
+        try:
+            zproc = await asyncio.create_subprocess_exec(*cmd, stdout=transportinfd)
+            proc = await asyncio.create_subprocess_shell(
+                replcmd, stdin=receivefd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            )
+        except Exception:
+            os.close(sendfd)
+            os.close(transportoutfd)
+            raise
+        finally:
+            os.close(transportinfd)
+            os.close(receivefd)
+
+        progressfile = REPLICATION_PROGRESSFILE.format(id=repl['id'])
+        with open(progressfile, 'w') as f:
+            f.write(str(zproc.pid))
+        stream = (repl['id'], dataset)
+        progress.streams[stream] = {
+            'id': repl['id'],
+            'pid': zproc.pid,
+            'snapshot': f'{dataset}@{tosnap}',
+            'percent': 0,
+            'transport': transport,
+            'procs': [zproc, proc],
+        }
+        try:
+            # Not in the middleware threadpool, streams may take hours
+            fut = asyncio.get_event_loop().run_in_executor(None, transport.run, sendfd, transportoutfd)
+            try:
+                await fut
+            except Exception as e:
+                self.logger.debug(f'Transport of {dataset}@{tosnap} failed: {e}')
+            finally:
+                # Closing send side makes zfs send give up if transport failed,
+                # closing receive side ends the stream.
+                os.close(sendfd)
+                os.close(transportoutfd)
+            msg = (await proc.communicate())[0].decode(errors='ignore')
+            await zproc.wait()
+        finally:
+            progress.streams.pop(stream, None)
+            try:
+                os.unlink(progressfile)
+            except OSError:
+                pass
+        progress.done += 1
+
+        msg = msg.replace('WARNING: ENABLED NONE CIPHER', '').strip()
+        self.logger.debug(f'Replication result: {msg}')
+        result['msg'] = msg
+        # When replicating to a target "container" dataset that doesn't exist on the sending
+        # side the target dataset will have to be readonly, however that will preclude
+        # creating mountpoints for the datasets that are sent.
+        # In that case you'll get back a failed to create mountpoint message, which
+        # we'll go ahead and consider a success.
+        success = 'Succeeded' in msg or 'failed to create mountpoint' in msg
+        if success:
+            self.__remote_snapshots_apply(
+                repl['repl_remote'], added=[f'{remotefs_final}{dataset[len(localfs):]}@{tosnap}'],
+            )
+            if dataset == localfs:
+                result['last_snapshot'] = tosnap
+        return success
+
     @private
     async def ssh_keyscan(self, host, port):
         proc = await Popen([
@@ -0,0 +1,193 @@
+from middlewared.schema import Bool, List, Str, accepts
+from middlewared.service import Service, filterable, private
+from middlewared.utils import Popen, filter_list
+
+import asyncio
+import copy
+import functools
+import re
+import subprocess
+import time
+
+SMARTCTL = '/usr/local/sbin/smartctl'
+# Seconds a probe of a disk is served from cache
+SMART_TTL = 300
+# Number of smartctl running at once
+SMART_WORKERS = 8
+
+RE_INFO = re.compile(r'^(?P<key>[A-Za-z][\w /-]*?):\s+(?P<value>.+?)\s*$', re.M)
+RE_ATTRIBUTE = re.compile(
+    r'^\s*(?P<id>\d+)\s+(?P<name>\S+)\s+(?P<flag>0x[0-9a-fA-F]+)\s+(?P<value>\d+)\s+(?P<worst>\d+)\s+'
+    r'(?P<thresh>\S+)\s+(?P<type>\S+)\s+(?P<updated>\S+)\s+(?P<when_failed>\S+)\s+(?P<raw>.+?)\s*$',
+    re.M,
+)
+RE_NUMBER = re.compile(r'^-?\d+')
+RE_STANDBY = re.compile(r'Device is in (STANDBY|SLEEP|IDLE)')
+
+
+def to_int(value):
+    reg = RE_NUMBER.match(value or '')
+    return int(reg.group(0)) if reg else None
+
+
+def parse_smartctl(output):
+    """
+    Parse `smartctl -a` output of an ATA, SCSI or NVMe device.
+    """
+    info = {}
+    for reg in RE_INFO.finditer(output):
+        info.setdefault(reg.group('key').strip().lower(), reg.group('value'))
+
+    record = {
+        'serial': info.get('serial number'),
+        'model': info.get('device model') or info.get('model number'),
+        'firmware': info.get('firmware version') or info.get('revision'),
+        'capacity': None,
+        'rotationrate': None,
+        'health': (
+            info.get('smart overall-health self-assessment test result') or info.get('smart health status')
+        ),
+        'temperature': None,
+        'attributes': [],
+    }
+    if not record['model'] and info.get('product'):
+        record['model'] = ' '.join(filter(None, [info.get('vendor'), info['product']]))
+
+    capacity = info.get('user capacity') or info.get('total nvm capacity')
+    if capacity and 'bytes' in capacity:
+        # Thousands separator depends on the locale
+        record['capacity'] = int(re.sub(r'\D', '', capacity.split('bytes')[0]) or 0) or None
+
+    rotation = info.get('rotation rate')
+    if rotation:
+        record['rotationrate'] = 0 if rotation.startswith('Solid State') else to_int(rotation)
+
+    for reg in RE_ATTRIBUTE.finditer(output):
+        record['attributes'].append({
+            'id': int(reg.group('id')),
+            'name': reg.group('name'),
+            'value': int(reg.group('value')),
+            'worst': int(reg.group('worst')),
+            'thresh': to_int(reg.group('thresh')),
+            'when_failed': None if reg.group('when_failed') == '-' else reg.group('when_failed'),
+            'raw': reg.group('raw'),
+        })
+
+    # Temperature_Celsius, then Airflow_Temperature_Cel for ATA
+    attributes = {i['id']: i for i in record['attributes']}
+    for _id in (194, 190):
+        if _id in attributes:
+            record['temperature'] = to_int(attributes[_id]['raw'])
+            break
+    else:
+        # SCSI and NVMe
+        record['temperature'] = to_int(info.get('current drive temperature') or info.get('temperature'))
+
+    return record
+
+
+class SMARTService(Service):
+    """
+    SMART data of disks shared by every consumer.
+
+    smartctl is run for many disks at once, at most SMART_WORKERS at a
+    time, and its output is parsed into a record per disk which is served
+    for SMART_TTL seconds.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SMARTService, self).__init__(*args, **kwargs)
+        self.__records = {}
+        self.__probes = {}
+        self.__workers = asyncio.Semaphore(SMART_WORKERS)
+
+    @filterable
+    async def query(self, filters=None, options=None):
+        """
+        Query SMART records of disks.
+
+        Disks in standby are not woken up, only their identity is read.
+        """
+        names = [disk['name'] for disk in await self.middleware.call('disk.query')]
+        # Do not probe every disk to look up a few of them
+        for f in filters or []:
+            if len(f) == 3 and f[0] == 'name' and f[1] in ('=', 'in'):
+                wanted = f[2] if f[1] == 'in' else [f[2]]
+                names = [name for name in names if name in wanted]
+        records = await self.probe(names)
+        return filter_list([records[name] for name in names if records[name]], filters, options)
+
+    @private
+    @accepts(List('names', items=[Str('name')]), Bool('force', default=False))
+    async def probe(self, names, force=False):
+        """
+        Returns the SMART record of every disk of `names` (None if it
+        could not be probed).
+
+        Only disks not probed in the last SMART_TTL seconds (or all of them
+        if `force`) are probed, in parallel.
+        """
+        now = time.monotonic()
+        missing = [
+            name for name in names
+            if name not in self.__probes and (
+                force or name not in self.__records or self.__records[name][0] < now
+            )
+        ]
+        if missing:
+            args = await self.middleware.call('disk.smartctl_args', missing)
+            for name in missing:
+                probe = asyncio.ensure_future(self.__probe(name, args[name]))
+                probe.add_done_callback(functools.partial(self.__probed, name))
+                self.__probes[name] = probe
+
+        records = {}
+        for name in names:
+            record = None
+            probe = self.__probes.get(name)
+            if probe is not None:
+                try:
+                    record = await asyncio.shield(probe)
+                except Exception:
+                    self.logger.debug('Failed to probe SMART of %s', name, exc_info=True)
+            if record is None and name in self.__records:
+                record = self.__records[name][1]
+            records[name] = copy.deepcopy(record)
+        return records
+
+    def __probed(self, name, probe):
+        # Disk may have been forgotten while it was probed
+        if self.__probes.get(name) is not probe:
+            return
+        self.__probes.pop(name)
+        if not probe.cancelled() and probe.exception() is None:
+            self.__records[name] = (time.monotonic() + SMART_TTL, probe.result())
+
+    async def __probe(self, name, args):
+        async with self.__workers:
+            proc = await Popen(
+                [SMARTCTL, '-a', '-n', 'standby'] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+            output = (await proc.communicate())[0].decode(errors='ignore')
+            standby = bool(RE_STANDBY.search(output))
+            if standby:
+                # Identity is still available without spinning up the disk
+                proc = await Popen([SMARTCTL, '-i'] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                output = (await proc.communicate())[0].decode(errors='ignore')
+
+        record = parse_smartctl(output)
+        record.update({'name': name, 'standby': standby})
+        return record
+
+    @private
+    async def serial(self, name):
+        record = (await self.probe([name]))[name]
+        return record['serial'] if record else None
+
+    @private
+    async def forget(self, name):
+        """
+        Drop the record of disk `name`, e.g. it has been replaced.
+        """
+        self.__records.pop(name, None)
+        self.__probes.pop(name, None)
@@ -1,12 +1,20 @@
+from collections import OrderedDict
 from middlewared.client import ejson as json
 from middlewared.schema import Dict, Int, List, Str, accepts
-from middlewared.service import Service
-from middlewared.utils import Popen
+from middlewared.service import Service, private
 
-import glob
+import asyncio
+import math
 import os
 import re
 import subprocess
+import threading
+import time
+
+try:
+    import rrdtool
+except ImportError:
+    rrdtool = None
 
 
 RRD_PATH = '/var/db/collectd/rrd/localhost/'
@@ -14,25 +22,140 @@ RE_DSTYPE = re.compile(r'ds\[(\w+)\]\.type = "(\w+)"')
 RE_STEP = re.compile(r'step = (\d+)')
 RE_LAST_UPDATE = re.compile(r'last_update = (\d+)')
 
+# collectd writes every 10 seconds, data points do not change faster than that
+DEFAULT_STEP = 10
+# Number of xport results kept around
+XPORT_CACHE_SIZE = 64
+
+# librrd is not thread safe, see #3478
+RRD_LOCK = threading.Lock()
+
+
+class RRDCatalog(object):
+    """
+    Sources and metrics available in RRD_PATH.
+
+    A directory mtime changes whenever an entry is added or removed so
+    only directories that changed since the last call are listed again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.sources = {}
+
+    def get(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            self.mtime = None
+            self.sources = {}
+            return {}
+
+        if mtime != self.mtime:
+            self.mtime = mtime
+            self.sources = {
+                i: self.sources.get(i, (None, []))
+                for i in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, i))
+            }
+
+        for source, (cached, metrics) in list(self.sources.items()):
+            path = os.path.join(self.path, source)
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                self.sources.pop(source)
+                continue
+            if mtime != cached:
+                self.sources[source] = (mtime, [i[:-4] for i in os.listdir(path) if i.endswith('.rrd')])
+
+        return {k: list(v[1]) for k, v in self.sources.items() if v[1]}
+
+
+def rrd_info(rrdfile):
+    if rrdtool is None:
+        cp = subprocess.run(
+            ['/usr/local/bin/rrdtool', 'info', rrdfile],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        if cp.returncode != 0:
+            raise ValueError('rrdtool failed: {}'.format(cp.stderr.decode()))
+        data = cp.stdout.decode()
+        info = {'datasets': {}}
+        for dataset, _type in RE_DSTYPE.findall(data):
+            info['datasets'][dataset] = {'type': _type}
+        reg = RE_STEP.search(data)
+        if reg:
+            info['step'] = int(reg.group(1))
+        reg = RE_LAST_UPDATE.search(data)
+        if reg:
+            info['last_update'] = int(reg.group(1))
+        return info
+
+    with RRD_LOCK:
+        data = rrdtool.info(rrdfile)
+    info = {'datasets': {}}
+    for key, value in data.items():
+        reg = re.match(r'^ds\[(\w+)\]\.type$', key)
+        if reg:
+            info['datasets'][reg.group(1)] = {'type': value}
+    if 'step' in data:
+        info['step'] = int(data['step'])
+    if 'last_update' in data:
+        info['last_update'] = int(data['last_update'])
+    return info
+
+
+def rrd_xport(args):
+    """
+    Returns the same structure as `rrdtool xport --json`.
+    """
+    if rrdtool is None:
+        cp = subprocess.run(
+            ['/usr/local/bin/rrdtool', 'xport', '--json'] + args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        if cp.returncode != 0:
+            raise ValueError('rrdtool failed: {}'.format(cp.stderr.decode()))
+        return json.loads(cp.stdout.decode())
+
+    with RRD_LOCK:
+        try:
+            data = rrdtool.xport(*args)
+        except rrdtool.error as e:
+            raise ValueError('rrdtool failed: {}'.format(e))
+    return {
+        'meta': {
+            'start': data['meta']['start'],
+            'end': data['meta']['end'],
+            'step': data['meta']['step'],
+            'legend': data['meta']['legend'],
+        },
+        'data': [
+            [None if v is None or math.isnan(v) else v for v in row]
+            for row in data['data']
+        ],
+    }
+
 
 class StatsService(Service):
 
+    def __init__(self, *args, **kwargs):
+        super(StatsService, self).__init__(*args, **kwargs)
+        self.__catalog = RRDCatalog(RRD_PATH)
+        self.__catalog_lock = threading.Lock()
+        self.__info = {}
+        self.__xport = OrderedDict()
+
     @accepts()
     def get_sources(self):
         """
         Returns an object with all available sources tried with metric datasets.
         """
-        sources = {}
-        if not os.path.exists(RRD_PATH):
-            return {}
-        for i in glob.glob('{}/*/*.rrd'.format(RRD_PATH)):
-            source, metric = i.replace(RRD_PATH, '').split('/', 1)
-            if metric.endswith('.rrd'):
-                metric = metric[:-4]
-            if source not in sources:
-                sources[source] = []
-            sources[source].append(metric)
-        return sources
+        with self.__catalog_lock:
+            return self.__catalog.get()
 
     @accepts(Str('source'), Str('type'))
     async def get_dataset_info(self, source, _type):
@@ -40,30 +163,23 @@ class StatsService(Service):
         Returns info about a given dataset from some source.
         """
         rrdfile = '{}/{}/{}.rrd'.format(RRD_PATH, source, _type)
-        proc = await Popen(
-            ['/usr/local/bin/rrdtool', 'info', rrdfile],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        data, err = await proc.communicate()
-        if proc.returncode != 0:
-            raise ValueError('rrdtool failed: {}'.format(err.decode()))
-        data = data.decode()
+        try:
+            mtime = os.stat(rrdfile).st_mtime
+        except FileNotFoundError:
+            raise ValueError('rrdtool failed: {} does not exist'.format(rrdfile))
+
+        # RRD file is only modified by an update, which makes the mtime a
+        # good validator for the cached info.
+        cached = self.__info.get(rrdfile)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, await self.middleware.threaded(rrd_info, rrdfile))
+            self.__info[rrdfile] = cached
 
         info = {
             'source': source,
             'type': _type,
-            'datasets': {}
         }
-        for dataset, _type in RE_DSTYPE.findall(data):
-            info['datasets'][dataset] = {'type': _type}
-
-        reg = RE_STEP.search(data)
-        if reg:
-            info['step'] = int(reg.group(1))
-        reg = RE_LAST_UPDATE.search(data)
-        if reg:
-            info['last_update'] = int(reg.group(1))
+        info.update(cached[1])
         return info
 
     @accepts(
@@ -98,19 +214,32 @@ class StatsService(Service):
                 'DEF:xxx{}={}:{}:{}'.format(i, rrdfile, data['dataset'], data['cf']),
                 'XPORT:xxx{}:{}/{}'.format(i, data['source'], data['type']),
             ])
-        proc = await Popen(
-            [
-                '/usr/local/bin/rrdtool', 'xport', '--json',
-                '--start', stats['start'], '--end', stats['end'],
-            ] + (['--step', str(stats['step'])] if stats.get('step') else []) + defs,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        data, err = await proc.communicate()
-        if proc.returncode != 0:
-            raise ValueError('rrdtool failed: {}'.format(err.decode()))
-        data = json.loads(data.decode())
+        args = [
+            '--start', stats['start'], '--end', stats['end'],
+        ] + (['--step', str(stats['step'])] if stats.get('step') else []) + defs
+
+        data = dict(await self.xport(args, stats.get('step') or DEFAULT_STEP))
 
         # Custom about property
         data['about'] = 'Data for ' + ','.join(['/'.join(i) for i in names_pair])
         return data
+
+    @private
+    async def xport(self, args, resolution):
+        """
+        Memoized xport of `args`.
+
+        Rows within a window of `resolution` seconds are the same, so the
+        result is shared by every call with the same arguments in the same
+        window and concurrent callers wait on a single run.
+        """
+        key = (tuple(args), int(time.time() // max(resolution, DEFAULT_STEP)))
+        fut = self.__xport.get(key)
+        if fut is None or (fut.done() and fut.exception()):
+            fut = asyncio.ensure_future(self.middleware.threaded(rrd_xport, args))
+            self.__xport[key] = fut
+            while len(self.__xport) > XPORT_CACHE_SIZE:
+                self.__xport.popitem(last=False)
+        else:
+            self.__xport.move_to_end(key)
+        return await asyncio.shield(fut)
@@ -1,13 +1,34 @@
+from datetime import datetime
 import errno
+import os
+import pickle
 import socket
 import ssl
+import sys
+import uuid
 
-from middlewared.schema import Dict, Int, Str, accepts
-from middlewared.service import CallError, CRUDService, filterable
+from middlewared.schema import Bool, Dict, Int, Str, accepts
+from middlewared.service import CallError, CRUDService, filterable, private
 
-from pyVim import connect
+from lockfile import LockFile
+from pyVim import connect, task as VimTask
 from pyVmomi import vim
 
+if '/usr/local/www' not in sys.path:
+    sys.path.append('/usr/local/www')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'freenasUI.settings')
+
+import django
+from django.apps import apps
+if not apps.ready:
+    django.setup()
+
+from freenasUI.common.system import send_mail
+
+VMWARE_FAILS = '/var/tmp/.vmwaresnap_fails'
+VMWARELOGIN_FAILS = '/var/tmp/.vmwarelogin_fails'
+VMWARESNAPDELETE_FAILS = '/var/tmp/.vmwaresnapdelete_fails'
+
 
 class VMWareService(CRUDService):
 
@@ -123,3 +144,218 @@ class VMWareService(CRUDService):
             }
             vms[vm.config.uuid] = data
         return vms
+
+    @private
+    @accepts(Str('filesystem'), Bool('recursive'), Str('snapname'))
+    def snapshot_begin(self, filesystem, recursive, snapname):
+        """
+        Take VMware snapshots of every running VM using a datastore backed by
+        `filesystem` (or its children if `recursive`), prior to taking the ZFS
+        snapshot `snapname`.
+
+        Returns a context to be handed to `vmware.snapshot_end` once the ZFS
+        snapshot has been taken.
+        """
+        items = [
+            i for i in self.middleware.call_sync('vmware.query')
+            if i['filesystem'] == filesystem or (recursive and i['filesystem'].startswith(filesystem + '/'))
+        ]
+
+        context = {
+            'snapname': snapname,
+            # Unique name that (hopefully) won't collide with anything on the VMWare side.
+            'vmsnapname': str(uuid.uuid4()),
+            'items': items,
+            'snapvms': {},
+            'snapvmfails': {},
+            'snapvmskips': {},
+            'vmsynced': False,
+        }
+        if not items:
+            return context
+
+        # Helpful description visible on the VMWare side so dangling
+        # snapshots can be traced back.
+        vmsnapdescription = str(datetime.now()).split('.')[0] + ' FreeNAS Created Snapshot'
+
+        vmlogin_fails = {}
+        for item in items:
+            snapvms = context['snapvms'][item['id']] = []
+            snapvmfails = context['snapvmfails'][item['id']] = []
+            snapvmskips = context['snapvmskips'][item['id']] = []
+            try:
+                si = self.__connect(item)
+                content = si.RetrieveContent()
+            except Exception as e:
+                self.logger.warn('VMware login failed to %s', item['hostname'], exc_info=True)
+                vmlogin_fails[item['id']] = getattr(e, 'msg', str(e))
+                continue
+
+            # There's no point to even consider VMs that are paused or powered off.
+            vm_view = content.viewManager.CreateContainerView(content.rootFolder, [vim.VirtualMachine], True)
+            for vm in vm_view.view:
+                if vm.summary.runtime.powerState != 'poweredOn':
+                    continue
+                if not self.__vm_depends_on_datastore(vm, item['datastore']):
+                    continue
+                try:
+                    if self.__vm_can_snapshot(vm):
+                        # A VM using two datasets of the same volume may have
+                        # been snapshotted already in this iteration.
+                        if self.__vm_snapshot_by_name(vm, context['vmsnapname']) is False:
+                            VimTask.WaitForTask(vm.CreateSnapshot_Task(
+                                name=context['vmsnapname'],
+                                description=vmsnapdescription,
+                                memory=False, quiesce=False,
+                            ))
+                    else:
+                        self.logger.info(
+                            'Can\'t snapshot VM %s that depends on datastore %s and filesystem %s. '
+                            'Possibly using PT devices. Skipping.',
+                            vm.name, item['datastore'], filesystem,
+                        )
+                        snapvmskips.append(vm.config.uuid)
+                except Exception:
+                    self.logger.warn('Snapshot of VM %s failed', vm.name)
+                    snapvmfails.append([vm.config.uuid, vm.name])
+                snapvms.append(vm.config.uuid)
+            connect.Disconnect(si)
+
+        try:
+            with LockFile(VMWARELOGIN_FAILS):
+                with open(VMWARELOGIN_FAILS, 'wb') as f:
+                    pickle.dump(vmlogin_fails, f)
+        except Exception:
+            self.logger.debug('Failed to write vmware login fails file', exc_info=True)
+
+        # Send out email alerts for VMs we tried to snapshot that failed.
+        # Also put the failures into a sentinel file that the alert
+        # system can understand.
+        for item in items:
+            if context['snapvmfails'][item['id']]:
+                fails = self.__read_fails(VMWARE_FAILS)
+                fails[snapname] = [i[1] for i in context['snapvmfails'][item['id']]]
+                self.__write_fails(VMWARE_FAILS, fails)
+                send_mail(
+                    subject=f'VMware Snapshot failed! ({snapname})',
+                    text='\nHello,\n    The following VM failed to snapshot {}:\n{}\n'.format(
+                        snapname, '    \n'.join(fails[snapname]),
+                    ),
+                    channel='snapvmware',
+                )
+
+        # The ZFS snapshot is consistent with VM snapshots if every VM
+        # has been snapshotted.
+        context['vmsynced'] = all(
+            context['snapvms'][item['id']] and not context['snapvmfails'][item['id']]
+            for item in items
+        )
+        return context
+
+    @private
+    @accepts(Dict('context', additional_attrs=True))
+    def snapshot_end(self, context):
+        """
+        Delete all VMware snapshots taken by `vmware.snapshot_begin`, they
+        impact the performance of the VMs.
+        """
+        snapname = context['snapname']
+        for item in context['items']:
+            try:
+                si = self.__connect(item)
+            except Exception:
+                # TODO: We need to alert here as this will leave
+                # dangling VMWare snapshots.
+                self.logger.warn('VMware login failed to %s', item['hostname'])
+                continue
+
+            snapdeletefails = []
+            failed_uuids = [i[0] for i in context['snapvmfails'][item['id']]]
+            for vm_uuid in context['snapvms'][item['id']]:
+                vm = si.content.searchIndex.FindByUuid(None, vm_uuid, True)
+                if not vm:
+                    self.logger.debug('Could not find VM %s', vm_uuid)
+                    continue
+                if vm_uuid in failed_uuids or vm_uuid in context['snapvmskips'][item['id']]:
+                    continue
+                snap = self.__vm_snapshot_by_name(vm, context['vmsnapname'])
+                try:
+                    if snap is not False:
+                        VimTask.WaitForTask(snap.RemoveSnapshot_Task(True))
+                except Exception:
+                    self.logger.debug('Exception removing snapshot %s %s', vm.name, context['vmsnapname'], exc_info=True)
+                    snapdeletefails.append(vm.name)
+
+            if snapdeletefails:
+                fails = self.__read_fails(VMWARESNAPDELETE_FAILS)
+                fails[snapname] = snapdeletefails
+                self.__write_fails(VMWARESNAPDELETE_FAILS, fails)
+                send_mail(
+                    subject=f'VMware Snapshot deletion failed! ({snapname})',
+                    text='\nHello,\n    The following VM snapshot(s) failed to delete {}:\n{}\n'.format(
+                        snapname, '    \n'.join(snapdeletefails),
+                    ),
+                    channel='snapvmware',
+                )
+            connect.Disconnect(si)
+
+    def __connect(self, item):
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        ssl_context.verify_mode = ssl.CERT_NONE
+        return connect.SmartConnect(
+            host=item['hostname'], user=item['username'], pwd=item['password'], sslContext=ssl_context,
+        )
+
+    def __read_fails(self, path):
+        try:
+            with LockFile(path):
+                with open(path, 'rb') as f:
+                    return pickle.load(f)
+        except Exception:
+            return {}
+
+    def __write_fails(self, path, fails):
+        with LockFile(path):
+            with open(path, 'wb') as f:
+                pickle.dump(fails, f)
+
+    def __vm_depends_on_datastore(self, vm, datastore):
+        try:
+            # simple case, VM config data is on a datastore.
+            for i in vm.datastore:
+                if i.info.name.startswith(datastore):
+                    return True
+            # check if VM has disks on the data store
+            for device in vm.config.hardware.device:
+                if device.backing is None:
+                    continue
+                if hasattr(device.backing, 'fileName'):
+                    if device.backing.datastore.info.name == datastore:
+                        return True
+        except Exception:
+            self.logger.debug('Exception in __vm_depends_on_datastore', exc_info=True)
+        return False
+
+    def __vm_can_snapshot(self, vm):
+        try:
+            # PCI pass-through devices can't be snapshotted
+            for device in vm.config.hardware.device:
+                if isinstance(device, vim.VirtualPCIPassthrough):
+                    return False
+        except Exception:
+            self.logger.debug('Exception in __vm_can_snapshot', exc_info=True)
+        return True
+
+    def __vm_snapshot_by_name(self, vm, name):
+        try:
+            tree = vm.snapshot.rootSnapshotList
+            while tree[0].childSnapshotList is not None:
+                snap = tree[0]
+                if snap.name == name:
+                    return snap.snapshot
+                if len(tree[0].childSnapshotList) < 1:
+                    break
+                tree = tree[0].childSnapshotList
+        except Exception:
+            self.logger.debug('Exception in __vm_snapshot_by_name')
+        return False
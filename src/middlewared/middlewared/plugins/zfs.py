@@ -1,13 +1,20 @@
 from bsd import geom
 
-from middlewared.schema import Dict, List, Str, accepts
-from middlewared.service import CallError, Service, job
+from middlewared.schema import Bool, Dict, List, Str, accepts
+from middlewared.service import CallError, Service, filterable, job
+from middlewared.utils import filter_list
 
+import asyncio
+import bisect
 import errno
 import libzfs
 import threading
 import time
 
+BOOT_POOL_NAME = 'freenas-boot'
+# Interval in seconds between full reconciliations of the snapshot index
+SNAPSHOT_INDEX_RECONCILE = 600
+
 
 def find_vdev(pool, vname):
     """
@@ -173,3 +180,222 @@ class ZFSPoolService(Service):
         t = threading.Thread(target=watch, daemon=True)
         t.start()
         t.join()
+
+
+class SnapshotIndex(object):
+    """
+    In-memory index of every ZFS snapshot in the system.
+
+    Snapshots are kept per dataset, ordered by creation (createtxg), and
+    dataset names are kept sorted so a whole subtree of datasets can be
+    found (and replaced) with a couple of bisect lookups.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.datasets = {}
+        self.names = []
+
+    def _subtree(self, dataset, recursive):
+        """
+        Names of indexed datasets under `dataset` (inclusive).
+        Every name sharing the "dataset/" prefix is contiguous in the sorted list.
+        """
+        rv = []
+        if dataset in self.datasets:
+            rv.append(dataset)
+        if recursive:
+            prefix = dataset + '/'
+            idx = bisect.bisect_left(self.names, prefix)
+            while idx < len(self.names) and self.names[idx].startswith(prefix):
+                rv.append(self.names[idx])
+                idx += 1
+        return rv
+
+    def replace(self, snapshots, dataset=None, recursive=True):
+        """
+        Replace indexed snapshots of `dataset` (and its children if `recursive`)
+        with `snapshots`, a dict of dataset name -> list of snapshot entries.
+        `dataset` set to None replaces the whole index.
+        """
+        for entries in snapshots.values():
+            entries.sort(key=lambda x: x['createtxg'])
+            for i, entry in enumerate(entries):
+                entry['mostrecent'] = i == len(entries) - 1
+
+        with self.lock:
+            if dataset is None:
+                self.datasets = snapshots
+                self.names = sorted(snapshots.keys())
+                self.loaded = True
+                return
+
+            for name in self._subtree(dataset, recursive):
+                del self.datasets[name]
+                self.names.pop(bisect.bisect_left(self.names, name))
+
+            for name, entries in snapshots.items():
+                if name not in self.datasets:
+                    bisect.insort(self.names, name)
+                self.datasets[name] = entries
+
+    def get(self, dataset=None, recursive=False):
+        """
+        Snapshot entries of all datasets (or `dataset` subtree),
+        ordered by dataset name and then by creation.
+        """
+        with self.lock:
+            if dataset is None:
+                names = self.names
+            else:
+                names = self._subtree(dataset, recursive)
+            rv = []
+            for name in names:
+                rv.extend(self.datasets[name])
+            return rv
+
+
+class ZFSSnapshotService(Service):
+
+    class Config:
+        namespace = 'zfs.snapshot'
+        private = True
+
+    def __init__(self, *args, **kwargs):
+        super(ZFSSnapshotService, self).__init__(*args, **kwargs)
+        self.__index = SnapshotIndex()
+
+    def __serialize(self, snap, dataset_type):
+        dataset, snapshot_name = snap.name.split('@', 1)
+        props = snap.properties
+        vmsynced = props.get('freenas:vmsynced')
+        return {
+            'name': snap.name,
+            'dataset': dataset,
+            'snapshot_name': snapshot_name,
+            'pool': dataset.split('/')[0],
+            'type': dataset_type,
+            'system': dataset.split('/')[1:2] == ['.system'],
+            'createtxg': int(props['createtxg'].rawvalue),
+            'creation': int(props['creation'].rawvalue),
+            'used': int(props['used'].rawvalue),
+            'referenced': int(props['referenced'].rawvalue),
+            'vmsynced': vmsynced is not None and vmsynced.value == 'Y',
+        }
+
+    def __load(self, datasets):
+        snapshots = {}
+        for ds in datasets:
+            dataset_type = ds.type.name
+            snapshots[ds.name] = [self.__serialize(snap, dataset_type) for snap in ds.snapshots]
+        return snapshots
+
+    @accepts(Str('dataset'), Bool('recursive', default=True))
+    def reload(self, dataset=None, recursive=True):
+        """
+        Reload snapshots of `dataset` (and its children if `recursive`) into the index.
+        This is the hook to be called after snapshots are taken or destroyed.
+
+        A `dataset` of null reloads snapshots of every pool.
+        """
+        zfs = libzfs.ZFS()
+        if dataset is None:
+            datasets = []
+            for pool in zfs.pools:
+                if pool.name == BOOT_POOL_NAME:
+                    continue
+                datasets.append(pool.root_dataset)
+                datasets.extend(pool.root_dataset.children_recursive)
+        elif dataset.split('/')[0] == BOOT_POOL_NAME:
+            return
+        else:
+            try:
+                ds = zfs.get_dataset(dataset)
+            except libzfs.ZFSException:
+                # Dataset is gone, drop it from the index
+                datasets = []
+            else:
+                datasets = [ds]
+                if recursive:
+                    datasets.extend(ds.children_recursive)
+
+        self.__index.replace(self.__load(datasets), dataset=dataset, recursive=recursive)
+
+    @filterable
+    def query(self, filters=None, options=None):
+        """
+        Query snapshots from the in-memory snapshot index.
+
+        Filters on `dataset` or `name` equality are served straight from the
+        per-dataset index instead of going over every snapshot.
+        """
+        if not self.__index.loaded:
+            self.reload()
+
+        filters = list(filters or [])
+        dataset = None
+        name = None
+        for f in list(filters):
+            if len(f) == 3 and f[1] == '=' and f[0] in ('dataset', 'name'):
+                if f[0] == 'dataset':
+                    dataset = f[2]
+                else:
+                    name = f[2]
+                filters.remove(f)
+                break
+
+        if name is not None:
+            snapshots = [
+                i for i in self.__index.get(dataset=name.split('@')[0])
+                if i['name'] == name
+            ]
+        elif dataset is not None:
+            snapshots = self.__index.get(dataset=dataset)
+        else:
+            snapshots = self.__index.get()
+
+        return filter_list(snapshots, filters, options)
+
+    @accepts(Str('dataset'), Bool('recursive', default=True))
+    def dataset_snapshots(self, dataset, recursive=True):
+        """
+        Indexed snapshots of `dataset` (and its children if `recursive`),
+        ordered by creation within each dataset.
+        """
+        if not self.__index.loaded:
+            self.reload()
+
+        return self.__index.get(dataset=dataset, recursive=recursive)
+
+    @accepts(List('datasets', items=[Str('dataset')]))
+    def names(self, datasets=None):
+        """
+        Names of every indexed snapshot of `datasets` and their children.
+        """
+        if not self.__index.loaded:
+            self.reload()
+
+        if datasets is None:
+            return [i['name'] for i in self.__index.get()]
+        names = set()
+        for dataset in datasets:
+            names.update(i['name'] for i in self.__index.get(dataset=dataset, recursive=True))
+        return sorted(names)
+
+
+async def snapshot_index_loop(middleware):
+    """
+    Periodically reconcile the snapshot index with the system so changes
+    made outside of the reload hook (e.g. zfs cli, replication) are picked up.
+    """
+    while True:
+        try:
+            await middleware.call('zfs.snapshot.reload')
+        except Exception:
+            middleware.logger.warn('Failed to reconcile snapshot index', exc_info=True)
+        await asyncio.sleep(SNAPSHOT_INDEX_RECONCILE)
+
+
+def setup(middleware):
+    asyncio.ensure_future(snapshot_index_loop(middleware))
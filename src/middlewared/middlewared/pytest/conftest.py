@@ -40,9 +40,13 @@ class Connection(object):
         self.ws = WSClient(f'ws://{self.conf.target_hostname()}/websocket')
         self.ws.call('auth.login', self.conf.target_username(), self.conf.target_password())
 
-connection = Connection()
+# Only connect to the target when functional tests ask for it so unit
+# tests can run without one.
+connection = None
 
 @pytest.fixture
 def conn():
     global connection
+    if connection is None:
+        connection = Connection()
     return connection
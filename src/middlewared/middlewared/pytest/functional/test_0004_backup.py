@@ -13,6 +13,17 @@ def _check():
         pytest.skip("No credentials")
 
 
+def _attributes():
+    attributes = {
+        'access_key': os.environ['BACKUP_AWS_ACCESS_KEY'],
+        'secret_key': os.environ['BACKUP_AWS_SECRET_KEY'],
+    }
+    # Local S3 compatible service (e.g. minio) instead of AWS
+    if 'BACKUP_AWS_ENDPOINT' in os.environ:
+        attributes['endpoint'] = os.environ['BACKUP_AWS_ENDPOINT']
+    return attributes
+
+
 def _get_pool(conn):
     req = conn.rest.get('pool')
     assert req.status_code == 200
@@ -40,10 +51,7 @@ def test_backup_002_credential_create(conn, creds):
     req = conn.rest.post('backup/credential', data=[{
         'name': 'backtestcreds',
         'provider': 'AMAZON',
-        'attributes': {
-            'access_key': os.environ['BACKUP_AWS_ACCESS_KEY'],
-            'secret_key': os.environ['BACKUP_AWS_SECRET_KEY'],
-        },
+        'attributes': _attributes(),
     }])
     assert req.status_code == 200
     creds['credid'] = req.json()
@@ -55,10 +63,7 @@ def test_backup_003_credential_update(conn, creds):
     req = conn.rest.post('backup/credential', data=[{
         'name': 'back_test_creds',
         'provider': 'AMAZON',
-        'attributes': {
-            'access_key': os.environ['BACKUP_AWS_ACCESS_KEY'],
-            'secret_key': os.environ['BACKUP_AWS_SECRET_KEY'],
-        },
+        'attributes': _attributes(),
     }])
     assert req.status_code == 200
 
@@ -8,3 +8,32 @@ def test_datastore_restore(conn):
     dump = conn.ws.call('datastore.dump')
     restore = conn.ws.call('datastore.restore', dump)
     assert restore is True
+
+
+def test_datastore_query_page(conn):
+    users = conn.ws.call('datastore.query', 'account.bsdusers')
+    page = conn.ws.call('datastore.query', 'account.bsdusers', [], {'order_by': ['-id'], 'offset': 1, 'limit': 2})
+    assert page == sorted(users, key=lambda i: -i['id'])[1:3]
+    assert conn.ws.call('datastore.query', 'account.bsdusers', [], {'count': True}) == len(users)
+
+
+def test_datastore_query_foreign_key(conn):
+    share = conn.ws.call('datastore.insert', 'sharing.nfs_share', {'nfs_comment': 'datastore test'})
+    try:
+        filters = [('share', '=', share)]
+        # Cached (empty) result is dropped by the insert
+        assert conn.ws.call('datastore.query', 'sharing.nfs_share_path', filters) == []
+        for path in ('/mnt/a', '/mnt/b'):
+            conn.ws.call('datastore.insert', 'sharing.nfs_share_path', {'share': share, 'path': path})
+
+        result = conn.ws.call('datastore.query', 'sharing.nfs_share_path', filters)
+        assert [i['path'] for i in result] == ['/mnt/a', '/mnt/b']
+        assert all(i['share']['id'] == share and i['share']['nfs_comment'] == 'datastore test' for i in result)
+
+        # Referenced rows are serialized again once they change
+        conn.ws.call('datastore.update', 'sharing.nfs_share', share, {'nfs_comment': 'datastore test 2'})
+        result = conn.ws.call('datastore.query', 'sharing.nfs_share_path', filters)
+        assert all(i['share']['nfs_comment'] == 'datastore test 2' for i in result)
+    finally:
+        conn.ws.call('datastore.delete', 'sharing.nfs_share', share)
+    assert conn.ws.call('datastore.query', 'sharing.nfs_share_path', filters) == []
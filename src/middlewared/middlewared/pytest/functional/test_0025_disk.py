@@ -32,6 +32,13 @@ def test_disk_sync(conn):
         conn.ws.call('disk.sync', disk['name'])
 
 
+def test_disk_sync_devices(conn):
+    disks = [d['name'] for d in conn.ws.call('disk.query')]
+    conn.ws.call('disk.sync_devices', disks)
+
+    assert sorted(d['name'] for d in conn.ws.call('disk.query')) == sorted(disks)
+
+
 def test_disk_sync_all(conn):
     conn.ws.call('disk.sync_all')
 
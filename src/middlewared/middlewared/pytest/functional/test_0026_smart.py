@@ -0,0 +1,14 @@
+def test_smart_query(conn):
+    records = conn.ws.call('smart.query')
+    assert isinstance(records, list)
+
+    disks = set(d['name'] for d in conn.ws.call('disk.query'))
+    for record in records:
+        assert record['name'] in disks
+
+
+def test_smart_probe_cached(conn):
+    disks = [d['name'] for d in conn.ws.call('disk.query')]
+    first = conn.ws.call('smart.probe', disks)
+    second = conn.ws.call('smart.probe', disks)
+    assert first == second
@@ -0,0 +1,173 @@
+import io
+import os
+import random
+import threading
+from unittest import mock
+
+import pytest
+
+from middlewared.plugins import backup
+from middlewared.plugins.backup import S3Transfer
+
+PART_SIZE = 1024
+
+
+class FakeS3(object):
+    """
+    In-process stand-in of a boto3 S3 client for multipart uploads and
+    ranged downloads, tracking how many requests run at once.
+    """
+
+    def __init__(self, failures=None):
+        # Part number (or range start) -> number of times it fails
+        self.failures = failures or {}
+        self.objects = {}
+        self.uploads = {}
+        self.aborted = []
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def __request(self, key, *args):
+        with self.lock:
+            self.calls.append(args)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            failing = self.failures.get(key, 0)
+            if failing:
+                self.failures[key] = failing - 1
+        try:
+            # Requests complete out of order (time.sleep is mocked away)
+            threading.Event().wait(random.random() / 100)
+            if failing:
+                raise IOError(f'Request {key} failed')
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = str(len(self.uploads))
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, ContentLength, Body):
+        assert len(Body) == ContentLength
+        self.__request(PartNumber, 'upload_part', PartNumber)
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = MultipartUpload['Parts']
+        assert [i['PartNumber'] for i in parts] == list(range(1, len(parts) + 1))
+        uploaded = self.uploads.pop(UploadId)
+        self.objects[Key] = b''.join(uploaded[i['PartNumber']] for i in parts)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(UploadId)
+        self.uploads.pop(UploadId)
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.objects[Key])}
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = map(int, Range[len('bytes='):].split('-'))
+        self.__request(start, 'get_object', start)
+        return {'Body': io.BytesIO(self.objects[Key][start:end + 1])}
+
+
+@pytest.fixture(autouse=True)
+def no_backoff():
+    with mock.patch.object(backup, 'CHUNK_SIZE', PART_SIZE):
+        with mock.patch.object(backup.time, 'sleep'):
+            yield
+
+
+def transfer(client, **kwargs):
+    kwargs.setdefault('workers', 4)
+    return S3Transfer(client, 'bucket', 'folder/backup', part_size=PART_SIZE, **kwargs)
+
+
+def test_upload():
+    client = FakeS3()
+    data = os.urandom(PART_SIZE * 10 + 1)
+    progress = []
+    transfer(client, progress=lambda transferred, total: progress.append(transferred)).upload(io.BytesIO(data))
+
+    assert client.objects['folder/backup'] == data
+    assert len(client.calls) == 11
+    assert max(progress) == len(data)
+
+
+def test_upload_empty():
+    client = FakeS3()
+    transfer(client).upload(io.BytesIO())
+    assert client.objects['folder/backup'] == b''
+
+
+def test_download_in_order():
+    client = FakeS3()
+    data = os.urandom(PART_SIZE * 10 + 1)
+    client.objects['folder/backup'] = data
+    f = io.BytesIO()
+    transfer(client).download(f)
+    assert f.getvalue() == data
+    assert client.max_running > 1
+
+
+@pytest.mark.parametrize('memory,workers', [
+    (None, 4),
+    # Memory allows fewer parts than workers in flight
+    (PART_SIZE * 2, 2),
+    (PART_SIZE // 2, 1),
+])
+def test_parts_bound(memory, workers):
+    client = FakeS3()
+    t = transfer(client, workers=4, memory=memory)
+    assert t.workers == workers
+    t.upload(io.BytesIO(os.urandom(PART_SIZE * 20)))
+    assert client.max_running <= workers
+
+    client.max_running = 0
+    t.download(io.BytesIO())
+    assert client.max_running <= workers
+
+
+def test_part_size_minimum():
+    assert S3Transfer(FakeS3(), 'bucket', 'key', part_size=1).part_size == PART_SIZE
+
+
+def test_upload_retry():
+    client = FakeS3(failures={3: backup.TRANSFER_RETRIES - 1})
+    data = os.urandom(PART_SIZE * 5)
+    transfer(client).upload(io.BytesIO(data))
+    assert client.objects['folder/backup'] == data
+    assert [i for i in client.calls if i[1] == 3] == [('upload_part', 3)] * backup.TRANSFER_RETRIES
+
+
+def test_download_retry():
+    client = FakeS3(failures={PART_SIZE * 2: backup.TRANSFER_RETRIES - 1})
+    data = os.urandom(PART_SIZE * 5)
+    client.objects['folder/backup'] = data
+    f = io.BytesIO()
+    transfer(client).download(f)
+    assert f.getvalue() == data
+
+
+def test_upload_abort():
+    client = FakeS3(failures={3: backup.TRANSFER_RETRIES})
+    with pytest.raises(IOError):
+        transfer(client).upload(io.BytesIO(os.urandom(PART_SIZE * 5)))
+    assert client.aborted == ['0']
+    assert client.uploads == {}
+    assert 'folder/backup' not in client.objects
+
+
+def test_download_failure():
+    client = FakeS3(failures={PART_SIZE * 2: backup.TRANSFER_RETRIES})
+    client.objects['folder/backup'] = os.urandom(PART_SIZE * 5)
+    f = io.BytesIO()
+    with pytest.raises(IOError):
+        transfer(client).download(f)
+    # Nothing past the failed part is written
+    assert len(f.getvalue()) <= PART_SIZE * 2
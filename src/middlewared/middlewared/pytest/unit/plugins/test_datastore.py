@@ -0,0 +1,119 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+sys.path.append('/usr/local/www')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'freenasUI.settings')
+
+settings = pytest.importorskip('freenasUI.settings')
+
+ROWS = 10000
+NAME = 'sharing.nfs_share_path'
+
+
+class Middleware(object):
+    """
+    Just enough of the middleware for DatastoreService to run in-process.
+    Threaded calls run inline so their queries can be captured.
+    """
+
+    async def threaded(self, method, *args, **kwargs):
+        return method(*args, **kwargs)
+
+
+@pytest.fixture(scope='module')
+def database():
+    """
+    Generated database of ROWS NFS share paths, on the plain sqlite3
+    backend so nothing goes to a standby node.
+    """
+    from django.apps import apps
+    if apps.ready:
+        pytest.skip('Django is already set up on another database')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'freenas-v1.db')
+        settings.DATABASES['default'].update({
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': path,
+        })
+        import django
+        django.setup()
+
+        from django.db import connection
+        from freenasUI.sharing.models import NFS_Share, NFS_Share_Path
+        with connection.schema_editor() as editor:
+            editor.create_model(NFS_Share)
+            editor.create_model(NFS_Share_Path)
+
+        share = NFS_Share.objects.create(nfs_comment='datastore bench')
+        NFS_Share_Path.objects.bulk_create([
+            NFS_Share_Path(share=share, path='/mnt/bench/{}'.format(i)) for i in range(ROWS)
+        ], batch_size=500)
+        yield path, share.id
+
+
+@pytest.fixture
+def datastore(database):
+    from middlewared.plugins.datastore import DatastoreService
+    return DatastoreService(Middleware())
+
+
+def query(datastore, *args):
+    """
+    Run datastore.query, returns its result, the time it took and the
+    number of SQL queries it ran.
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    with CaptureQueriesContext(connection) as queries:
+        start = time.monotonic()
+        result = asyncio.get_event_loop().run_until_complete(datastore.query(*args))
+        elapsed = time.monotonic() - start
+    return result, elapsed, len(queries)
+
+
+def test_datastore_query_bench(database, datastore):
+    path, share = database
+    filters = [('share', '=', share)]
+
+    # Any change of the database file drops the cache
+    os.utime(path)
+    result, cold, cold_queries = query(datastore, NAME, filters)
+    assert len(result) == ROWS
+    assert result[0]['share']['id'] == share
+    # Foreign keys are fetched in batches, not once per row
+    assert cold_queries <= 3
+
+    cached_result, cached, cached_queries = query(datastore, NAME, filters)
+    assert cached_result == result
+    assert cached_queries == 0
+
+    print('{} rows: cold {:.3f}s ({} queries), cached {:.3f}s'.format(ROWS, cold, cold_queries, cached))
+    assert cached < cold
+
+
+def test_datastore_query_page_bench(database, datastore):
+    path, share = database
+    filters = [('share', '=', share)]
+    options = {'order_by': ['-id'], 'offset': 100, 'limit': 50}
+
+    os.utime(path)
+    result, cold, cold_queries = query(datastore, NAME, filters, options)
+    assert [i['path'] for i in result] == [
+        '/mnt/bench/{}'.format(i) for i in range(ROWS - 101, ROWS - 151, -1)
+    ]
+    assert cold_queries <= 3
+
+    count, elapsed, count_queries = query(datastore, NAME, filters, {'count': True})
+    assert count == ROWS
+    assert count_queries == 1
+
+    full, full_elapsed, full_queries = query(datastore, NAME, filters)
+    print('page of 50: {:.3f}s, count: {:.3f}s, {} rows: {:.3f}s'.format(cold, elapsed, ROWS, full_elapsed))
+    # Only the page is fetched and serialized
+    assert cold < full_elapsed
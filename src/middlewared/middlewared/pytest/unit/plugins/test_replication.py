@@ -0,0 +1,178 @@
+import asyncio
+import subprocess
+from collections import defaultdict
+from unittest import mock
+
+import pytest
+
+from middlewared.plugins import replication
+from middlewared.plugins.replication import ReplicationService, ReplicationTransport, resume_token_info
+
+TOKEN = '1-e604ea4bf-e0-789c63a2'
+
+SEND_NVP = """resume token contents:
+nvlist version: 0
+\tobject = 0x6
+\toffset = 0x2d0000
+\tbytes = 0x2d4e78
+\ttoguid = 0x6f9d2a9e3b6ff0c8
+\ttoname = tank/data@auto-20171001.0000-2w
+full\ttank/data@auto-20171001.0000-2w\t8432120
+size\t8432120
+"""
+
+REMOTE = {
+    'ssh_remote_hostname': 'backup',
+    'ssh_remote_port': 22,
+    'ssh_remote_dedicateduser_enabled': False,
+    'ssh_remote_dedicateduser': None,
+    'ssh_remote_parallel': 1,
+    'ssh_cipher': 'standard',
+}
+
+REPL = {
+    'id': 1,
+    'repl_filesystem': 'tank/data',
+    'repl_zfs': 'backup',
+    'repl_remote': REMOTE,
+    'repl_followdelete': True,
+    'repl_compression': 'off',
+    'repl_buffer': 1,
+    'repl_limit': 0,
+}
+
+
+class FakeTransport(ReplicationTransport):
+    """
+    Remote system answering every command with `returncode`.
+    """
+
+    def __init__(self, remote, returncode=0):
+        super(FakeTransport, self).__init__(remote, mock.Mock())
+        self.returncode = returncode
+        self.commands = []
+
+    def command(self):
+        return 'ssh backup'
+
+    async def run(self, command):
+        self.commands.append(command)
+        return subprocess.CompletedProcess(command, self.returncode, stdout='', stderr='')
+
+
+def run_async(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def local_run(returncode, stdout='', stderr=''):
+    async def run(*args, **kwargs):
+        return subprocess.CompletedProcess(args, returncode, stdout=stdout.encode(), stderr=stderr.encode())
+    return run
+
+
+@pytest.fixture
+def service():
+    service = ReplicationService(mock.Mock())
+    service._ReplicationService__mail = mock.Mock(side_effect=lambda *args: asyncio.sleep(0))
+    service._ReplicationService__results_write = mock.Mock()
+    return service
+
+
+def resume(service, success, returncode=0, stdout=SEND_NVP):
+    sent = []
+
+    async def send(*args):
+        sent.append(args)
+        return success
+
+    async def main():
+        ssh = FakeTransport(REMOTE)
+        results = defaultdict(dict)
+        progress = mock.Mock(total=0)
+        service._ReplicationService__send = send
+        with mock.patch.object(replication, 'run', local_run(returncode, stdout, 'cannot resume send')):
+            rv = await service._ReplicationService__resume(
+                REPL, ssh, results, progress, 'backup/data', TOKEN, 'backup/data',
+            )
+        return rv, ssh, results[REPL['id']]
+
+    return run_async(main()) + (sent,)
+
+
+def test_resume_token_info():
+    assert resume_token_info(SEND_NVP) == {
+        'toname': 'tank/data@auto-20171001.0000-2w',
+        'bytes': 0x2d4e78,
+        'size': 8432120,
+    }
+
+
+def test_resume_token_info_invalid():
+    assert resume_token_info('') == {'toname': None, 'bytes': 0, 'size': None}
+
+
+def test_transport_is_abstract():
+    with pytest.raises(TypeError):
+        ReplicationTransport(REMOTE, mock.Mock())
+
+
+def test_resume_sends_token(service):
+    rv, ssh, result, sent = resume(service, True)
+
+    assert rv is True
+    assert len(sent) == 1
+    dataset, fromsnap, tosnap, remotefs_final, token = sent[0][4:]
+    assert (dataset, fromsnap, tosnap, token) == ('tank/data', None, 'auto-20171001.0000-2w', TOKEN)
+    assert 'resume' not in result
+    assert ssh.commands == []
+    service._ReplicationService__mail.assert_not_called()
+
+
+def test_resume_failed_is_reported(service):
+    rv, ssh, result, sent = resume(service, False)
+
+    assert rv is False
+    assert result['resume'] == {'snapshot': 'tank/data@auto-20171001.0000-2w', 'bytes': 0x2d4e78, 'size': 8432120}
+    assert result['msg'] == 'Failed: tank/data (resume auto-20171001.0000-2w)'
+    assert service._ReplicationService__mail.call_count == 1
+
+
+def test_resume_unknown_snapshot_aborts_receive(service):
+    rv, ssh, result, sent = resume(service, True, returncode=1, stdout='')
+
+    assert rv is True
+    assert sent == []
+    assert ssh.commands == ['zfs receive -A backup/data']
+    assert 'resume' not in result
+
+
+def test_send_token(service):
+    commands = []
+
+    async def create_subprocess_exec(*args, **kwargs):
+        commands.append(list(args))
+        return mock.Mock(pid=1)
+
+    async def create_subprocess_shell(cmd, **kwargs):
+        commands.append(cmd)
+        raise OSError('stop')
+
+    async def main():
+        ssh = FakeTransport(REMOTE)
+        ssh.resumable = True
+        with mock.patch.object(asyncio, 'create_subprocess_exec', create_subprocess_exec):
+            with mock.patch.object(asyncio, 'create_subprocess_shell', create_subprocess_shell):
+                with pytest.raises(OSError):
+                    await service._ReplicationService__send(
+                        REPL, ssh, {}, mock.Mock(), 'tank/data', None, 'auto-20171001.0000-2w', 'backup/data',
+                        TOKEN,
+                    )
+
+    run_async(main())
+    # Properties (-p) are part of the stream being resumed already
+    assert commands[0] == ['/sbin/zfs', 'send', '-V', '-t', TOKEN]
+    assert commands[1] == "ssh backup '/sbin/zfs receive -s -F -d backup && echo Succeeded'"
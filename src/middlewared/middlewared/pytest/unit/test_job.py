@@ -0,0 +1,55 @@
+import os
+import tempfile
+from datetime import datetime
+
+import pytest
+
+from middlewared.job import JobsHistory
+
+
+def job(id, method, state='SUCCESS'):
+    return {
+        'id': id,
+        'method': method,
+        'arguments': [],
+        'state': state,
+        'time_started': datetime(2017, 1, 1, 0, 0, id % 60),
+        'time_finished': datetime(2017, 1, 1, 0, 1, id % 60),
+        'result': None,
+    }
+
+
+@pytest.fixture
+def history():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        yield JobsHistory(os.path.join(tmpdir, 'jobs.db'), maxlen=1000, method_maxlen=5)
+
+
+def ids(jobs):
+    return [i['id'] for i in jobs]
+
+
+def test_history_method_max(history):
+    history.add(job(1, 'backup.sync'))
+    for i in range(2, 22):
+        history.add(job(i, 'replication.run'))
+    # Frequent jobs do not push the others out
+    assert ids(history.query([('method', '=', 'backup.sync')])) == [1]
+    assert ids(history.query([('method', '=', 'replication.run')])) == [17, 18, 19, 20, 21]
+
+
+def test_history_query_limit(history):
+    for i in range(1, 6):
+        history.add(job(i, 'backup.sync', 'FAILED' if i % 2 else 'SUCCESS'))
+
+    assert ids(history.query([('method', '=', 'backup.sync')], ['-id'], 2)) == [5, 4]
+    assert ids(history.query([('state', '=', 'FAILED')], ['-id'], 2)) == [5, 3]
+    assert ids(history.query(None, ['state', '-id'], 3)) == [5, 3, 1]
+
+
+def test_history_query_not_indexed(history):
+    for i in range(1, 6):
+        history.add(job(i, 'backup.sync'))
+    # Filters left to the caller, every match is returned
+    assert ids(history.query([('arguments', '=', [])], ['-id'], 2)) == [1, 2, 3, 4, 5]
+    assert ids(history.query(None, ['progress.percent'], 2)) == [1, 2, 3, 4, 5]
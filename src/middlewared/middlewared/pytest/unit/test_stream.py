@@ -0,0 +1,129 @@
+import gzip
+import lzma
+import os
+import threading
+from unittest import mock
+
+import pytest
+
+from middlewared import stream
+from middlewared.stream import BLOCK_SIZE, RingBuffer, StreamTransport, TokenBucket
+
+
+def transport(data, *args, **kwargs):
+    """
+    Run `data` through a StreamTransport, returning what came out.
+    """
+    t = StreamTransport(*args, **kwargs)
+    infd, writefd = os.pipe()
+    readfd, outfd = os.pipe()
+    output = []
+
+    def feed():
+        with os.fdopen(writefd, 'wb') as f:
+            f.write(data)
+
+    def drain():
+        with os.fdopen(readfd, 'rb') as f:
+            output.append(f.read())
+
+    threads = [threading.Thread(target=feed), threading.Thread(target=drain)]
+    for thread in threads:
+        thread.start()
+    try:
+        t.run(infd, outfd)
+    finally:
+        os.close(infd)
+        os.close(outfd)
+    for thread in threads:
+        thread.join()
+    return t, output[0]
+
+
+def test_ring_buffer_order():
+    buffer = RingBuffer(2)
+    for i in range(5):
+        buffer.put(i)
+        assert buffer.get() == i
+    buffer.put('a')
+    buffer.put('b')
+    buffer.close()
+    assert [buffer.get(), buffer.get(), buffer.get()] == ['a', 'b', None]
+
+
+def test_ring_buffer_full_waits():
+    buffer = RingBuffer(1)
+    buffer.put(1)
+    waited = []
+    producer = threading.Thread(target=lambda: waited.append(buffer.put(2)))
+    producer.start()
+    producer.join(0.1)
+    assert producer.is_alive()
+
+    assert buffer.get() == 1
+    producer.join()
+    assert waited[0] > 0
+    assert buffer.get() == 2
+
+
+def test_ring_buffer_abort():
+    buffer = RingBuffer(1)
+    buffer.put(1)
+    producer = threading.Thread(target=buffer.put, args=(2,))
+    producer.start()
+    buffer.abort()
+    producer.join()
+    assert buffer.get() is None
+
+
+def test_token_bucket():
+    now = [0.0]
+    with mock.patch.object(stream.time, 'monotonic', lambda: now[0]):
+        with mock.patch.object(stream.time, 'sleep') as sleep:
+            bucket = TokenBucket(1000, burst=1000)
+            assert bucket.consume(1000) == 0
+            # Bucket is empty, 500 bytes are half a second worth of tokens
+            assert bucket.consume(500) == 0.5
+            sleep.assert_called_once_with(0.5)
+            now[0] = 1.5
+            assert bucket.consume(500) == 0
+
+
+def test_transport():
+    data = os.urandom(BLOCK_SIZE * 3 + 100)
+    t, output = transport(data, 2)
+    assert output == data
+    stats = t.stats.get()
+    assert stats['bytes_in'] == stats['bytes_out'] == len(data)
+
+
+@pytest.mark.parametrize('compression,decompress', [
+    ('pigz', gzip.decompress),
+    ('xz', lzma.decompress),
+])
+def test_transport_compression(compression, decompress):
+    data = b'freenas' * BLOCK_SIZE
+    t, output = transport(data, 4, compression=compression, threads=2)
+    # Blocks are compressed as concatenated members, in order
+    assert decompress(output) == data
+    assert t.stats.get()['ratio'] > 1
+
+
+def test_transport_destination_gone():
+    t = StreamTransport(2)
+    infd, writefd = os.pipe()
+    readfd, outfd = os.pipe()
+    os.close(readfd)
+    # Source keeps producing data, it never reaches the end of file
+    feeder = threading.Thread(target=lambda: os.write(writefd, b'\0' * BLOCK_SIZE * 4), daemon=True)
+    feeder.start()
+    threads = threading.active_count()
+    try:
+        with pytest.raises(BrokenPipeError):
+            t.run(infd, outfd)
+        # Reader is done with the source once run returns
+        assert threading.active_count() <= threads
+    finally:
+        os.close(infd)
+        os.close(writefd)
+        os.close(outfd)
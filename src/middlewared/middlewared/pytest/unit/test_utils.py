@@ -0,0 +1,159 @@
+import pytest
+
+from middlewared.utils import FILTER_OPERATORS, FilterIndex, filter_list
+
+
+USERS = [
+    {'id': 1, 'username': 'root', 'uid': 0, 'shell': '/bin/csh', 'group': {'name': 'wheel', 'gid': 0}},
+    {'id': 2, 'username': 'daemon', 'uid': 1, 'shell': '/usr/sbin/nologin', 'group': {'name': 'daemon', 'gid': 1}},
+    {'id': 3, 'username': 'www', 'uid': 80, 'shell': '/usr/sbin/nologin', 'group': {'name': 'www', 'gid': 80}},
+    {'id': 4, 'username': 'alice', 'uid': 1001, 'shell': '/bin/sh', 'group': {'name': 'staff', 'gid': 20}},
+    {'id': 5, 'username': 'bob', 'uid': 1002, 'shell': None, 'group': {'name': 'staff', 'gid': 20}},
+]
+
+
+def ids(items):
+    return [i['id'] for i in items]
+
+
+@pytest.mark.parametrize('filters,expected', [
+    ([('uid', '=', 80)], [3]),
+    ([('uid', '!=', 80)], [1, 2, 4, 5]),
+    ([('uid', '>', 80)], [4, 5]),
+    ([('uid', '>=', 80)], [3, 4, 5]),
+    ([('uid', '<', 80)], [1, 2]),
+    ([('uid', '<=', 80)], [1, 2, 3]),
+    ([('username', 'in', ['root', 'bob'])], [1, 5]),
+    ([('username', 'nin', ['root', 'bob'])], [2, 3, 4]),
+    ([('shell', '^', '/usr/')], [2, 3]),
+    ([('shell', '$', 'sh')], [1, 4]),
+    ([('username', '~', '^[a-d]')], [2, 4, 5]),
+])
+def test_filter_operators(filters, expected):
+    assert ids(filter_list(USERS, filters)) == expected
+
+
+def test_filter_operators_covered():
+    # Keep the cases above in sync with the supported operators
+    assert set(FILTER_OPERATORS) == {'=', '!=', '>', '>=', '<', '<=', 'in', 'nin', '^', '$', '~'}
+
+
+def test_filter_none_values():
+    # None does not match ordering nor string operators
+    assert ids(filter_list(USERS, [('shell', '>', '')])) == [1, 2, 3, 4]
+    assert ids(filter_list(USERS, [('shell', '^', '/')])) == [1, 2, 3, 4]
+    assert ids(filter_list(USERS, [('shell', '=', None)])) == [5]
+
+
+def test_filter_invalid():
+    with pytest.raises(ValueError):
+        filter_list(USERS, [('uid', '==', 0)])
+    with pytest.raises(ValueError):
+        filter_list(USERS, [('AND', [('uid', '=', 0)])])
+
+
+def test_filter_and():
+    assert ids(filter_list(USERS, [('uid', '>', 0), ('shell', '$', 'nologin')])) == [2, 3]
+
+
+def test_filter_or():
+    assert ids(filter_list(USERS, [
+        ('OR', [('username', '=', 'root'), ('uid', '>', 1001)]),
+    ])) == [1, 5]
+    assert ids(filter_list(USERS, [
+        ('OR', [('username', '=', 'root'), ('uid', '>', 1000)]),
+        ('shell', '!=', None),
+    ])) == [1, 4]
+
+
+def test_filter_dotted_field():
+    assert ids(filter_list(USERS, [('group.name', '=', 'staff')])) == [4, 5]
+    assert ids(filter_list(USERS, [('OR', [('group.gid', '=', 0), ('group.gid', '=', 80)])])) == [1, 3]
+    assert filter_list(USERS, [('group.gid', '=', 20)], {'select': ['username', 'group.gid']}) == [
+        {'username': 'alice', 'group.gid': 20},
+        {'username': 'bob', 'group.gid': 20},
+    ]
+
+
+def test_filter_objects():
+    class User(object):
+        def __init__(self, d):
+            self.__dict__.update(d)
+
+    users = [User(i) for i in USERS]
+    assert [i.id for i in filter_list(users, [('uid', '>=', 1000)])] == [4, 5]
+
+
+def test_order_by_none_first():
+    assert ids(filter_list(USERS, [], {'order_by': ['shell']})) == [5, 1, 4, 2, 3]
+    assert ids(filter_list(USERS, [], {'order_by': ['-shell']})) == [2, 3, 4, 1, 5]
+
+
+def test_order_by_mixed_directions():
+    assert ids(filter_list(USERS, [], {'order_by': ['-shell', 'uid']})) == [2, 3, 4, 1, 5]
+    assert ids(filter_list(USERS, [], {'order_by': ['shell', '-uid']})) == [5, 1, 4, 3, 2]
+    assert ids(filter_list(USERS, [], {'order_by': ['group.gid', '-username']})) == [1, 2, 5, 4, 3]
+
+
+def test_options_get():
+    assert filter_list(USERS, [('uid', '>', 0)], {'get': True})['id'] == 2
+    assert filter_list(USERS, [], {'order_by': ['-uid'], 'get': True})['id'] == 5
+    with pytest.raises(IndexError):
+        filter_list(USERS, [('uid', '<', 0)], {'get': True})
+
+
+def test_options_count():
+    assert filter_list(USERS, [('group.name', '=', 'staff')], {'count': True}) == 2
+    assert filter_list(USERS, [], {'count': True}) == 5
+    # Count ignores pagination
+    assert filter_list(USERS, [], {'count': True, 'limit': 2}) == 5
+
+
+def test_options_offset_limit():
+    assert ids(filter_list(USERS, [], {'limit': 2})) == [1, 2]
+    assert ids(filter_list(USERS, [], {'offset': 3})) == [4, 5]
+    assert ids(filter_list(USERS, [], {'offset': 1, 'limit': 2})) == [2, 3]
+    assert ids(filter_list(USERS, [], {'order_by': ['-id'], 'offset': 1, 'limit': 2})) == [4, 3]
+    assert filter_list(USERS, [], {'offset': 10}) == []
+
+
+def test_options_select():
+    assert filter_list(USERS, [('uid', '<', 2)], {'select': ['username']}) == [
+        {'username': 'root'},
+        {'username': 'daemon'},
+    ]
+
+
+@pytest.mark.parametrize('filters', [
+    [('username', '=', 'www')],
+    [('username', '=', 'nobody')],
+    [('group.name', '=', 'staff')],
+    [('group.name', 'in', ['staff', 'wheel'])],
+    [('shell', '=', None)],
+    [('uid', '>', 0), ('group.name', '=', 'staff')],
+    [('group.name', '=', 'staff'), ('uid', '<', 1002)],
+    [('OR', [('uid', '=', 0), ('uid', '=', 1)])],
+    [('uid', 'in', [[0]])],
+])
+def test_filter_index_matches_scan(filters):
+    index = FilterIndex(USERS)
+    for options in ({}, {'order_by': ['-uid']}, {'count': True}):
+        assert filter_list(index, filters, options) == filter_list(USERS, filters, options)
+
+
+def test_filter_index_candidates():
+    index = FilterIndex(USERS)
+    assert ids(index.candidates([('group.name', '=', 'staff')])) == [4, 5]
+    assert ids(index.candidates([('uid', '>', 0), ('username', 'in', ['bob', 'root'])])) == [1, 5]
+    # Only equality filters use an index
+    assert index.candidates([('uid', '>', 0)]) is None
+    # Fields missing from some items cannot be indexed
+    assert index.candidates([('missing', '=', 1)]) is None
+
+
+def test_filter_index_reindex():
+    index = FilterIndex(USERS[:2])
+    assert ids(filter_list(index, [('username', '=', 'www')])) == []
+    index.append(USERS[2])
+    index.reindex()
+    assert ids(filter_list(index, [('username', '=', 'www')])) == [3]
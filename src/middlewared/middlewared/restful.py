@@ -10,9 +10,21 @@ from .client import ejson as json
 
 
 async def authenticate(middleware, req):
+    """
+    Authenticate using either Basic username and password or a token
+    generated by `auth.generate_token`, e.g. `Authorization: Token <id>`.
+    """
 
     auth = req.headers.get('Authorization')
-    if auth is None or not auth.startswith('Basic '):
+    if auth is None:
+        raise web.HTTPUnauthorized()
+
+    if auth.startswith('Token '):
+        if not await middleware.call('auth.check_token', auth[6:].strip()):
+            raise web.HTTPUnauthorized()
+        return
+
+    if not auth.startswith('Basic '):
         raise web.HTTPUnauthorized()
     try:
         username, password = base64.b64decode(auth[6:]).decode('utf8').split(':', 1)
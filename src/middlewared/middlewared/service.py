@@ -147,10 +147,24 @@ class CoreService(Service):
 
     @filterable
     def get_jobs(self, filters=None, options=None):
-        """Get the long running jobs."""
-        jobs = filter_list([
-            i.__encode__() for i in list(self.middleware.jobs.all().values())
-        ], filters, options)
+        """
+        Get the long running jobs, including finished jobs from the history
+        no longer kept in memory.
+        """
+        options = options or {}
+        jobs = [i.__encode__() for i in list(self.middleware.jobs.all().values())]
+        ids = set(i['id'] for i in jobs)
+        # No more than the jobs of the page requested are needed from the
+        # history, whatever jobs are in memory.
+        limit = None
+        if options.get('get') or options.get('limit'):
+            if not options.get('count'):
+                limit = (options.get('offset') or 0) + (1 if options.get('get') else options['limit'])
+        history = [
+            i for i in self.middleware.jobs.history.query(filters, options.get('order_by'), limit)
+            if i['id'] not in ids
+        ]
+        jobs = filter_list(sorted(history + jobs, key=lambda i: i['id']), filters, options)
         return jobs
 
     @accepts(Int('id'), Dict(
@@ -0,0 +1,248 @@
+"""
+Buffered transport of a byte stream (e.g. zfs send) from a file descriptor
+to another, with optional parallel block compression and rate limiting.
+"""
+import concurrent.futures
+import lzma
+import os
+import threading
+import time
+import zlib
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def gzip_compress(data):
+    # Every block is a gzip member of its own, concatenated members are
+    # decompressed as a single stream.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def xz_compress(data):
+    # Same goes for concatenated xz streams
+    return lzma.compress(data, format=lzma.FORMAT_XZ)
+
+
+# Compression done in-process by blocks: compress function and the
+# decompression command for the receiving side.
+COMPRESSORS = {
+    'pigz': (gzip_compress, '/usr/bin/env pigz -d'),
+    'xz': (xz_compress, '/usr/bin/env xzdec'),
+}
+
+
+class RingBuffer(object):
+    """
+    Fixed number of block slots shared by a producer and a consumer thread.
+    """
+
+    def __init__(self, slots):
+        self.slots = [None] * max(slots, 1)
+        self.head = 0
+        self.count = 0
+        self.closed = False
+        self.aborted = False
+        self.cond = threading.Condition()
+
+    def put(self, item):
+        """
+        Put `item` in the next free slot, waiting for one to be available.
+
+        Returns the seconds spent waiting.
+        """
+        waited = 0
+        with self.cond:
+            if self.count == len(self.slots) and not self.aborted:
+                start = time.monotonic()
+                while self.count == len(self.slots) and not self.aborted:
+                    self.cond.wait()
+                waited = time.monotonic() - start
+            if self.aborted:
+                return waited
+            self.slots[(self.head + self.count) % len(self.slots)] = item
+            self.count += 1
+            self.cond.notify_all()
+        return waited
+
+    def get(self):
+        """
+        Get the oldest item, waiting for one to be available.
+
+        Returns `None` once the buffer is closed and drained.
+        """
+        with self.cond:
+            while self.count == 0 and not self.closed and not self.aborted:
+                self.cond.wait()
+            if self.count == 0 or self.aborted:
+                return None
+            item = self.slots[self.head]
+            self.slots[self.head] = None
+            self.head = (self.head + 1) % len(self.slots)
+            self.count -= 1
+            self.cond.notify_all()
+            return item
+
+    def close(self):
+        """
+        No more items will be put, let the consumer drain the buffer.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def abort(self):
+        """
+        Drop buffered items and release both producer and consumer.
+        """
+        with self.cond:
+            self.aborted = True
+            self.slots = [None] * len(self.slots)
+            self.count = 0
+            self.cond.notify_all()
+
+
+class TokenBucket(object):
+    """
+    Limit throughput to `rate` bytes per second.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, BLOCK_SIZE)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def consume(self, size):
+        """
+        Take `size` tokens, sleeping until the bucket is not in debt.
+
+        Returns the seconds slept.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= size
+        if self.tokens >= 0:
+            return 0
+        wait = -self.tokens / self.rate
+        time.sleep(wait)
+        return wait
+
+
+class StreamStats(object):
+
+    def __init__(self):
+        self.started = time.monotonic()
+        # Last time any data went through
+        self.active = self.started
+        # Bytes read from source and written to destination (compressed)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Seconds the source was held back because the buffer was full
+        self.stall = 0.0
+        # Seconds the destination was held back by the rate limit
+        self.throttled = 0.0
+        self.__last = (self.started, 0)
+
+    def get(self):
+        """
+        Returns stats with the throughput since the last call.
+        """
+        now = time.monotonic()
+        last_time, last_bytes = self.__last
+        self.__last = (now, self.bytes_out)
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'rate': (self.bytes_out - last_bytes) / (now - last_time) if now > last_time else 0,
+            'ratio': self.bytes_in / self.bytes_out if self.bytes_out else 1.0,
+            'stall': self.stall,
+            'throttled': self.throttled,
+            'elapsed': now - self.started,
+        }
+
+
+class StreamTransport(object):
+    """
+    Moves data from a file descriptor to another through a ring buffer of
+    `slots` blocks, so a bursty source does not wait on a slow destination
+    as long as the buffer is not full.
+
+    Blocks are compressed in `threads` threads if `compression` is one of
+    COMPRESSORS and written to the destination in order, at most `limit`
+    bytes per second.
+    """
+
+    def __init__(self, slots, compression=None, limit=None, threads=None):
+        self.buffer = RingBuffer(slots)
+        self.compress = COMPRESSORS[compression][0] if compression in COMPRESSORS else None
+        self.bucket = TokenBucket(limit) if limit else None
+        self.threads = threads or min(os.cpu_count() or 1, 4)
+        self.stats = StreamStats()
+        self.error = None
+
+    def run(self, infd, outfd):
+        """
+        Transport data until end of file of `infd`. This blocks, run it in a thread.
+
+        Closing the file descriptors is left to the caller, neither of them
+        is in use anymore once this returns.
+        """
+        executor = None
+        if self.compress:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+        reader = threading.Thread(target=self.__read, args=(infd, executor), daemon=True)
+        reader.start()
+        try:
+            self.__write(outfd)
+        except Exception as e:
+            self.error = self.error or e
+            # Destination is gone, reader goes away on its next read
+            self.buffer.abort()
+        finally:
+            reader.join()
+            if executor:
+                executor.shutdown(wait=False)
+        if self.error:
+            raise self.error
+
+    def __read(self, infd, executor):
+        try:
+            eof = False
+            while not eof and not self.buffer.aborted:
+                block = bytearray()
+                while len(block) < BLOCK_SIZE:
+                    data = os.read(infd, BLOCK_SIZE - len(block))
+                    if not data:
+                        eof = True
+                        break
+                    block += data
+                if not block:
+                    break
+                self.stats.bytes_in += len(block)
+                self.stats.active = time.monotonic()
+                if executor:
+                    item = executor.submit(self.compress, bytes(block))
+                else:
+                    item = bytes(block)
+                self.stats.stall += self.buffer.put(item)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.buffer.close()
+
+    def __write(self, outfd):
+        while True:
+            item = self.buffer.get()
+            if item is None:
+                break
+            if isinstance(item, concurrent.futures.Future):
+                item = item.result()
+            if self.bucket:
+                self.stats.throttled += self.bucket.consume(len(item))
+            view = memoryview(item)
+            while view:
+                view = view[os.write(outfd, view):]
+            self.stats.bytes_out += len(item)
+            self.stats.active = time.monotonic()
@@ -1,6 +1,11 @@
 import asyncio
+import functools
+import itertools
+import operator
+import re
 import sys
 import subprocess
+from collections import defaultdict
 from datetime import datetime, timedelta
 from functools import wraps
 from threading import Lock
@@ -65,58 +70,221 @@ async def run(*args, **kwargs):
     return cp
 
 
+def _regex_match(x, y):
+    return x is not None and y.search(x) is not None
+
+
+def _in(x, y):
+    try:
+        return x in y
+    except TypeError:
+        # Unhashable value looked up in a set
+        return False
+
+
+FILTER_OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '>': lambda x, y: x is not None and x > y,
+    '>=': lambda x, y: x is not None and x >= y,
+    '<': lambda x, y: x is not None and x < y,
+    '<=': lambda x, y: x is not None and x <= y,
+    'in': _in,
+    'nin': lambda x, y: not _in(x, y),
+    '^': lambda x, y: x is not None and x.startswith(y),
+    '$': lambda x, y: x is not None and x.endswith(y),
+    '~': _regex_match,
+}
+
+
+def get_field(item, name):
+    """
+    Value of field `name` of a dict or object, `name` may be a dotted path
+    to a nested field (e.g. "group.bsdgrp_gid").
+    """
+    if isinstance(item, dict):
+        if name in item:
+            return item[name]
+    elif hasattr(item, name):
+        return getattr(item, name)
+    if '.' not in name:
+        raise KeyError(name)
+    for part in name.split('.'):
+        if isinstance(item, dict):
+            item = item[part]
+        else:
+            item = getattr(item, part)
+    return item
+
+
+def compile_filters(filters):
+    """
+    Compile `filters` into a single predicate.
+    """
+    predicates = []
+    for f in filters:
+        if not isinstance(f, (list, tuple)):
+            raise ValueError('Filter must be a list: {0}'.format(f))
+        if len(f) == 3:
+            name, op, value = f
+            if op not in FILTER_OPERATORS:
+                raise ValueError('Invalid operation: {}'.format(op))
+            if op in ('in', 'nin') and isinstance(value, list):
+                try:
+                    value = set(value)
+                except TypeError:
+                    pass
+            elif op == '~':
+                value = re.compile(value)
+            predicates.append(functools.partial(
+                lambda i, name, op, value: op(get_field(i, name), value),
+                name=name, op=FILTER_OPERATORS[op], value=value,
+            ))
+        elif len(f) == 2:
+            op, value = f
+            if op != 'OR':
+                raise ValueError('Invalid operation: {}'.format(op))
+            alternatives = [compile_filters([i]) for i in value]
+            predicates.append(lambda i, alternatives=alternatives: any(p(i) for p in alternatives))
+        else:
+            raise ValueError('Invalid filter {0}'.format(f))
+
+    if not predicates:
+        return lambda i: True
+    if len(predicates) == 1:
+        return predicates[0]
+    return lambda i: all(p(i) for p in predicates)
+
+
+def _sort_key(value):
+    # None first, comparing it to other types would fail
+    return (value is not None, value)
+
+
+class FilterIndex(list):
+    """
+    List which keeps hash indexes of fields used in equality filters, for
+    lists queried repeatedly with `filter_list`.
+
+    Indexes are built on first use and must be dropped with `reindex` if
+    the items change.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(FilterIndex, self).__init__(*args, **kwargs)
+        self.__indexes = {}
+
+    def reindex(self):
+        self.__indexes.clear()
+
+    def index_of(self, name):
+        """
+        Returns a dict of value to item positions for field `name`, or None
+        if it cannot be indexed.
+        """
+        if name not in self.__indexes:
+            index = defaultdict(list)
+            try:
+                for pos, item in enumerate(self):
+                    index[get_field(item, name)].append(pos)
+            except (KeyError, AttributeError, TypeError):
+                index = None
+            self.__indexes[name] = index
+        return self.__indexes[name]
+
+    def candidates(self, filters):
+        """
+        Narrow the items down using the index of the first indexable
+        equality filter. Returns None if no filter could use an index.
+        """
+        for f in filters:
+            if len(f) != 3 or f[1] not in ('=', 'in'):
+                continue
+            name, op, value = f
+            index = self.index_of(name)
+            if index is None:
+                continue
+            try:
+                if op == '=':
+                    positions = index.get(value, [])
+                else:
+                    positions = sorted(set(itertools.chain.from_iterable(index.get(i, []) for i in value)))
+            except TypeError:
+                # Unhashable value
+                continue
+            return [self[i] for i in positions]
+        return None
+
+
 def filter_list(_list, filters=None, options=None):
+    """
+    Filter, sort and paginate `_list` of dicts or objects.
 
-    opmap = {
-        '=': lambda x, y: x == y,
-        '!=': lambda x, y: x != y,
-    }
+    `filters` uses the same format as datastore.query, with the operators
+    '=', '!=', '>', '>=', '<', '<=', 'in', 'nin', '^' (starts with),
+    '$' (ends with) and '~' (regex search), on fields which may be a
+    dotted path to nested fields, and 'OR' conjunctions.
+    """
 
     if filters is None:
-        filters = {}
+        filters = []
     if options is None:
         options = {}
 
-    rv = []
+    rv = _list
     if filters:
-        for i in _list:
-            valid = True
-            for f in filters:
-                if len(f) == 3:
-                    name, op, value = f
-                    if op not in opmap:
-                        raise ValueError('Invalid operation: {}'.format(op))
-                    if isinstance(i, dict):
-                        source = i[name]
-                    else:
-                        source = getattr(i, name)
-                    if not opmap[op](source, value):
-                        valid = False
-                        break
-            if not valid:
-                continue
-            rv.append(i)
-            if options.get('get') is True:
-                return i
-    else:
-        rv = _list
+        if isinstance(_list, FilterIndex):
+            candidates = _list.candidates(filters)
+            if candidates is not None:
+                rv = candidates
+        predicate = compile_filters(filters)
+        rv = filter(predicate, rv)
+
+    order_by = options.get('order_by')
+    if order_by:
+        keys = []
+        for o in order_by:
+            if o.startswith('-'):
+                keys.append((o[1:], True))
+            else:
+                keys.append((o, False))
+        if len(set(reverse for name, reverse in keys)) == 1:
+            rv = sorted(
+                rv,
+                key=lambda x: tuple(_sort_key(get_field(x, name)) for name, reverse in keys),
+                reverse=keys[0][1],
+            )
+        else:
+            def compare(x, y):
+                for name, reverse in keys:
+                    a, b = _sort_key(get_field(x, name)), _sort_key(get_field(y, name))
+                    if a != b:
+                        return (1 if a > b else -1) * (-1 if reverse else 1)
+                return 0
+            rv = sorted(rv, key=functools.cmp_to_key(compare))
 
     if options.get('count') is True:
-        return len(rv)
+        if isinstance(rv, list):
+            return len(rv)
+        return sum(1 for i in rv)
 
-    if options.get('order_by'):
-        for o in options.get('order_by'):
-            if o.startswith('-'):
-                o = o[1:]
-                reverse = True
-            else:
-                reverse = False
-            rv = sorted(rv, key=lambda x: x[o], reverse=reverse)
+    offset = options.get('offset') or 0
+    limit = options.get('limit')
+    if options.get('get') is True:
+        limit = 1
+    if offset or limit:
+        rv = itertools.islice(rv, offset, offset + limit if limit else None)
+
+    select = options.get('select')
+    if select:
+        rv = ({name: get_field(i, name) for name in select} for i in rv)
 
     if options.get('get') is True:
-        return rv[0]
+        for i in rv:
+            return i
+        raise IndexError('list index out of range')
 
-    return rv
+    return rv if isinstance(rv, list) else list(rv)
 
 
 def sw_version():
@@ -0,0 +1,77 @@
+#!/usr/local/bin/python
+# Copyright (c) 2017 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Compare the cost of a full disk sync against syncing only the disks
+# notified about by devd, replaying hot-plug of a number of the disks
+# attached (e.g. a shelf of a JBOD).
+#
+# e.g. diskbench.py -d 24 -r 5
+
+import argparse
+import statistics
+import sys
+import time
+
+from middlewared.client import Client
+
+
+def timeit(c, rounds, method, *args):
+    times = []
+    for i in range(rounds):
+        start = time.monotonic()
+        c.call(method, *args, timeout=600)
+        times.append(time.monotonic() - start)
+    return times
+
+
+def report(name, times):
+    print('%-28s min %8.3fs  median %8.3fs  max %8.3fs' % (
+        name, min(times), statistics.median(times), max(times),
+    ), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark full and incremental disk sync.')
+    parser.add_argument('-u', '--uri', help='Websocket URI (default: local middlewared)')
+    parser.add_argument('-d', '--disks', type=int, default=24, help='Disks hot-plugged at once (default: 24)')
+    parser.add_argument('-r', '--rounds', type=int, default=5, help='Rounds of every sync (default: 5)')
+    args = parser.parse_args()
+
+    with Client(uri=args.uri) as c:
+        disks = sorted(c.call('device.get_info', 'DISK'))
+        if not disks:
+            print('No disks found', file=sys.stderr)
+            sys.exit(1)
+        burst = disks[:args.disks]
+        print('%d disks attached, replaying %d' % (len(disks), len(burst)), file=sys.stderr)
+
+        report('sync_all', timeit(c, args.rounds, 'disk.sync_all'))
+        report('sync_devices (1 disk)', timeit(c, args.rounds, 'disk.sync_devices', burst[:1]))
+        report(f'sync_devices ({len(burst)} disks)', timeit(c, args.rounds, 'disk.sync_devices', burst))
+        report('multipath_sync', timeit(c, args.rounds, 'disk.multipath_sync'))
+
+
+if __name__ == '__main__':
+    main()
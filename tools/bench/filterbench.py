@@ -0,0 +1,98 @@
+#!/usr/local/bin/python
+# Copyright (c) 2017 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Microbenchmarks of middlewared filter_list over a generated list of rows
+# shaped like disk.query results.
+#
+# e.g. filterbench.py -r 100000
+
+import argparse
+import random
+import sys
+import time
+
+from middlewared.utils import FilterIndex, filter_list
+
+
+def generate(rows):
+    random.seed(0)
+    return [
+        {
+            'identifier': f'{{serial}}{i:08d}',
+            'name': f'da{i}',
+            'serial': f'{i:08d}',
+            'size': random.choice([None, 2 ** 39, 2 ** 40, 2 ** 41, 2 ** 42]),
+            'rotationrate': random.choice([None, 5400, 7200, 10000]),
+            'enclosure': {'number': i % 64, 'slot': i % 24},
+            'description': random.choice(['', 'spare', 'cache', 'log']),
+        }
+        for i in range(rows)
+    ]
+
+
+CASES = [
+    ('equality', [('name', '=', 'da4242')], {}),
+    ('equality get', [('name', '=', 'da4242')], {'get': True}),
+    ('comparison', [('size', '>=', 2 ** 41)], {}),
+    ('in', [('rotationrate', 'in', [5400, 7200])], {}),
+    ('prefix', [('name', '^', 'da42')], {}),
+    ('regex', [('serial', '~', '99$')], {}),
+    ('nested', [('enclosure.number', '=', 7)], {}),
+    ('or', [['OR', [('description', '=', 'spare'), ('size', '=', None)]]], {}),
+    ('count', [('size', '>=', 2 ** 41)], {'count': True}),
+    ('order by two keys', [], {'order_by': ['-size', 'name']}),
+    ('page', [('size', '!=', None)], {'order_by': ['serial'], 'offset': 1000, 'limit': 50}),
+    ('select', [], {'select': ['name', 'size'], 'limit': 1000}),
+]
+
+
+def bench(rows, filters, options, repeat):
+    start = time.monotonic()
+    for i in range(repeat):
+        filter_list(rows, filters, options)
+    return (time.monotonic() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks of middlewared filter_list.')
+    parser.add_argument('-r', '--rows', type=int, default=100000, help='Rows in the list (default: 100000)')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='Runs of each case (default: 5)')
+    args = parser.parse_args()
+
+    rows = generate(args.rows)
+    indexed = FilterIndex(rows)
+
+    print('%-20s %12s %12s' % ('case', 'list', 'indexed'))
+    for name, filters, options in CASES:
+        plain = bench(rows, filters, options, args.repeat)
+        # First query builds the index
+        filter_list(indexed, filters, options)
+        index = bench(indexed, filters, options, args.repeat)
+        print('%-20s %10.2fms %10.2fms' % (name, plain * 1000, index * 1000))
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/local/bin/python
+# Copyright (c) 2017 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+
+# Benchmark appending to the HA journal as it grows, e.g. while the standby
+# node is down. The journal is written to a temporary file, the real one
+# is not touched.
+#
+# e.g. hajournalbench.py -n 100000 -s 10000
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.extend([
+    '/usr/local/www',
+    '/usr/local/www/freenasUI'
+])
+
+os.environ["DJANGO_SETTINGS_MODULE"] = "freenasUI.settings"
+
+import django
+django.setup()
+
+from freenasUI.freeadmin.sqlite3_ha.base import Journal
+
+QUERY = (
+    'UPDATE "account_bsdusers" SET "bsdusr_full_name" = ?, '
+    '"bsdusr_shell" = ? WHERE "account_bsdusers"."id" = ?'
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HA journal write latency benchmark')
+    parser.add_argument('-n', '--writes', type=int, default=50000, help='Total writes')
+    parser.add_argument('-s', '--step', type=int, default=5000, help='Writes per report line')
+    parser.add_argument('-r', '--replay', action='store_true', help='Time replaying the journal at the end')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        Journal.JOURNAL_FILE = os.path.join(tmpdir, 'ha-journal')
+
+        print('%10s %12s %12s %12s' % ('entries', 'size', 'avg (ms)', 'max (ms)'))
+        written = 0
+        while written < args.writes:
+            latencies = []
+            for i in range(min(args.step, args.writes - written)):
+                start = time.monotonic()
+                with Journal() as j:
+                    j.append([(QUERY, ['User %d' % written, '/bin/csh', written])])
+                latencies.append(time.monotonic() - start)
+                written += 1
+            print('%10d %12d %12.3f %12.3f' % (
+                written,
+                os.stat(Journal.JOURNAL_FILE).st_size,
+                sum(latencies) / len(latencies) * 1000,
+                max(latencies) * 1000,
+            ))
+
+        if args.replay:
+            sent = []
+            start = time.monotonic()
+            with Journal() as j:
+                j.replay(lambda queries: sent.append(len(queries)))
+            print('Replayed %d queries in %d chunks in %.3fs' % (
+                sum(sent), len(sent), time.monotonic() - start,
+            ))
+
+
+if __name__ == '__main__':
+    main()
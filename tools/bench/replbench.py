@@ -0,0 +1,117 @@
+#!/usr/local/bin/python
+# Copyright (c) 2015 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Benchmark the replication stream transport replaying a recorded send
+# stream (e.g. zfs send pool/ds@snap > stream) into a local sink, without
+# going over the network or touching any pool.
+#
+# e.g. replbench.py -c pigz -s 'pigz -d > /dev/null' stream
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+
+from middlewared.stream import BLOCK_SIZE, COMPRESSORS, StreamTransport
+
+
+def human(value):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if value < 1024:
+            return '%.1f %s' % (value, unit)
+        value /= 1024
+    return '%.1f TiB' % value
+
+
+def report(stats, end='\r'):
+    print(
+        '%s in, %s out, %s/s, ratio %.2f, stall %.1fs, throttled %.1fs%s' % (
+            human(stats['bytes_in']),
+            human(stats['bytes_out']),
+            human(stats['rate']),
+            stats['ratio'],
+            stats['stall'],
+            stats['throttled'],
+            ' ' * 8,
+        ),
+        end=end,
+        file=sys.stderr,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded zfs send stream through the replication transport.')
+    parser.add_argument('stream', help='Recorded send stream file')
+    parser.add_argument('-b', '--buffer', type=int, default=64, help='Buffer size in MiB (default: 64)')
+    parser.add_argument('-c', '--compression', choices=sorted(COMPRESSORS), help='Compress blocks in the transport')
+    parser.add_argument('-l', '--limit', type=int, default=0, help='Limit in kB/s (default: unlimited)')
+    parser.add_argument('-t', '--threads', type=int, help='Compression threads')
+    parser.add_argument(
+        '-s', '--sink', default='cat > /dev/null',
+        help='Shell command receiving the stream (default: cat > /dev/null)',
+    )
+    args = parser.parse_args()
+
+    transport = StreamTransport(
+        max(args.buffer * 1024 * 1024 // BLOCK_SIZE, 1),
+        compression=args.compression,
+        limit=args.limit * 1024 if args.limit else None,
+        threads=args.threads,
+    )
+
+    infd = os.open(args.stream, os.O_RDONLY)
+    sink = subprocess.Popen(args.sink, shell=True, stdin=subprocess.PIPE)
+    outfd = sink.stdin.fileno()
+
+    error = []
+
+    def run():
+        try:
+            transport.run(infd, outfd)
+        except Exception as e:
+            error.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    while thread.is_alive():
+        thread.join(1)
+        report(transport.stats.get())
+    sink.stdin.close()
+    os.close(infd)
+    sink.wait()
+
+    stats = transport.stats.get()
+    stats['rate'] = stats['bytes_out'] / stats['elapsed'] if stats['elapsed'] else 0
+    report(stats, end='\n')
+    print('%.2f seconds' % stats['elapsed'], file=sys.stderr)
+    if error:
+        print('Transport failed: %s' % error[0], file=sys.stderr)
+        sys.exit(1)
+    sys.exit(sink.returncode)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/local/bin/python
+# Copyright (c) 2017 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Stand-in for snmpd walking the ZFS subtree through an agent, to measure
+# walk latency without snmpd or a network client.
+#
+# e.g. snmpbench.py -w 10 /usr/local/bin/freenas-snmp/zfs-snmp
+#      snmpbench.py --pass /usr/local/bin/freenas-snmp/zfs-snmp
+
+import argparse
+import subprocess
+import time
+
+BASE_OID = '.1.3.6.1.4.1.25359.1'
+
+
+def in_subtree(oid, base):
+    return oid == base or oid.startswith(base + '.')
+
+
+class PersistAgent(object):
+    """
+    Talks to an agent the way snmpd does for "pass_persist".
+    """
+
+    def __init__(self, command):
+        self.proc = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            encoding='utf8', bufsize=1,
+        )
+        self.proc.stdin.write('PING\n')
+        self.proc.stdin.flush()
+        if self.proc.stdout.readline().strip() != 'PONG':
+            raise RuntimeError('Agent did not answer PING')
+
+    def getnext(self, oid):
+        self.proc.stdin.write('getnext\n%s\n' % oid)
+        self.proc.stdin.flush()
+        oid = self.proc.stdout.readline().strip()
+        if oid == 'NONE':
+            return None
+        typ = self.proc.stdout.readline().strip()
+        value = self.proc.stdout.readline().strip()
+        return oid, typ, value
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+class PassAgent(object):
+    """
+    Runs the agent once per request the way snmpd does for "pass".
+    """
+
+    def __init__(self, command):
+        self.command = command
+
+    def getnext(self, oid):
+        output = subprocess.run(
+            self.command + ['-n', oid], stdout=subprocess.PIPE, encoding='utf8',
+        ).stdout.split('\n')
+        if len(output) < 3 or not output[0]:
+            return None
+        return output[0], output[1], output[2]
+
+    def close(self):
+        pass
+
+
+def walk(agent, base):
+    oids = 0
+    oid = base
+    while True:
+        row = agent.getnext(oid)
+        if row is None or not in_subtree(row[0], base):
+            return oids
+        oid = row[0]
+        oids += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SNMP agent walk latency benchmark')
+    parser.add_argument('agent', nargs='+', help='Agent command line')
+    parser.add_argument('-w', '--walks', type=int, default=5, help='Number of walks')
+    parser.add_argument('-b', '--base', default=BASE_OID, help='Subtree to walk')
+    parser.add_argument('--pass', dest='pass_', action='store_true', help='Use "pass" instead of "pass_persist"')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    agent = (PassAgent if args.pass_ else PersistAgent)(args.agent)
+    print('Agent started in %.3fs' % (time.monotonic() - start))
+
+    try:
+        for i in range(args.walks):
+            start = time.monotonic()
+            oids = walk(agent, args.base)
+            elapsed = time.monotonic() - start
+            print('Walk %d: %d OIDs in %.3fs (%.3f ms/OID)' % (
+                i + 1, oids, elapsed, elapsed / oids * 1000 if oids else 0,
+            ))
+    finally:
+        agent.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/local/bin/python
+# Copyright (c) 2017 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Load test event delivery of middlewared: open a number of local websocket
+# clients subscribed to the same collection, send events to it and measure
+# how long it takes for every client to receive them.
+#
+# e.g. wsbench.py -c 300 -e 2000
+
+import argparse
+import sys
+import threading
+import time
+
+from middlewared.client import Client
+
+COLLECTION = 'wsbench'
+
+
+class Subscriber(object):
+
+    def __init__(self, uri, events):
+        self.events = events
+        self.received = 0
+        self.last = None
+        self.done = threading.Event()
+        self.client = Client(uri=uri)
+        self.client.subscribe(COLLECTION, self.callback)
+
+    def callback(self, mtype, **message):
+        self.received += 1
+        self.last = message.get('id')
+        if self.last == self.events - 1:
+            self.done.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test middlewared event fan-out to websocket clients.')
+    parser.add_argument('-u', '--uri', help='Websocket URI (default: local middlewared)')
+    parser.add_argument('-c', '--clients', type=int, default=200, help='Websocket clients (default: 200)')
+    parser.add_argument('-e', '--events', type=int, default=1000, help='Events to send (default: 1000)')
+    parser.add_argument('-s', '--size', type=int, default=256, help='Bytes of payload per event (default: 256)')
+    parser.add_argument('-t', '--timeout', type=int, default=60, help='Seconds to wait for delivery (default: 60)')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    subscribers = []
+    for i in range(args.clients):
+        subscribers.append(Subscriber(args.uri, args.events))
+    print('%d clients connected in %.2f seconds' % (args.clients, time.monotonic() - start), file=sys.stderr)
+
+    payload = 'x' * args.size
+    with Client(uri=args.uri) as c:
+        start = time.monotonic()
+        for i in range(args.events):
+            c.call('core.event_send', COLLECTION, 'ADDED', {'id': i, 'fields': {'payload': payload}})
+        sent = time.monotonic() - start
+
+        deadline = time.monotonic() + args.timeout
+        for s in subscribers:
+            s.done.wait(max(deadline - time.monotonic(), 0))
+        elapsed = time.monotonic() - start
+
+    received = sum(s.received for s in subscribers)
+    expected = args.clients * args.events
+    print('%d events sent in %.2f seconds' % (args.events, sent), file=sys.stderr)
+    print(
+        '%d of %d deliveries in %.2f seconds, %.0f deliveries/s' % (
+            received, expected, elapsed, received / elapsed if elapsed else 0,
+        ),
+        file=sys.stderr,
+    )
+    late = len([s for s in subscribers if not s.done.is_set()])
+    if late:
+        print('%d clients did not receive the last event' % late, file=sys.stderr)
+
+    for s in subscribers:
+        s.client.close()
+    sys.exit(1 if late else 0)
+
+
+if __name__ == '__main__':
+    main()